@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+Measure how late the event loop runs a 1 ms timer while several peers
+deliver large messages at once, with checksums verified on the event
+loop thread and then in a thread pool (BitcoinPeerProtocol.CHECKSUM_EXECUTOR).
+
+    $ python benchmarks/bench_event_loop_latency.py
+
+The thread pool only helps when there's a spare CPU core to hash on.
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import sys
+import time
+
+# run from anywhere, without installing pycoinnet
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from pycoinnet.peer.BitcoinPeerProtocol import BitcoinPeerProtocol, make_frame
+
+
+MAGIC_HEADER = b"food"
+CHUNK_SIZE = 64*1024
+
+
+class NullTransport(asyncio.Transport):
+    def write(self, data):
+        pass
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def close(self):
+        pass
+
+    def get_extra_info(self, key):
+        class ob:
+            def getpeername(inner_self):
+                return ("127.0.0.1", 8333)
+        return ob()
+
+
+@asyncio.coroutine
+def feed_peer(peer, chunks):
+    # let other peers and the timer run between chunks
+    for chunk in chunks:
+        peer.data_received(chunk)
+        yield from asyncio.sleep(0)
+
+
+@asyncio.coroutine
+def consume_peer(peer, count):
+    next_message = peer.new_get_next_message_f(names=["alert"], raw=True)
+    for i in range(count):
+        yield from next_message()
+
+
+@asyncio.coroutine
+def measure_latency(done_future, interval=0.001):
+    lateness = []
+    while not done_future.done():
+        start = time.time()
+        yield from asyncio.sleep(interval)
+        lateness.append(time.time() - start - interval)
+    return lateness
+
+
+def run(peer_count, frames, executor):
+    blob = b''.join(frames)
+    chunks = [blob[i:i+CHUNK_SIZE] for i in range(0, len(blob), CHUNK_SIZE)]
+    loop = asyncio.get_event_loop()
+    peers = []
+    for i in range(peer_count):
+        peer = BitcoinPeerProtocol(MAGIC_HEADER)
+        peer.CHECKSUM_EXECUTOR = executor
+        peer.connection_made(NullTransport())
+        peers.append(peer)
+    start = time.time()
+    consumers = [asyncio.Task(consume_peer(peer, len(frames))) for peer in peers]
+    done_future = asyncio.Task(asyncio.wait(consumers))
+    latency_task = asyncio.Task(measure_latency(done_future))
+    feeders = [asyncio.Task(feed_peer(peer, chunks)) for peer in peers]
+    loop.run_until_complete(asyncio.wait(feeders + [done_future, latency_task]))
+    elapsed = time.time() - start
+    lateness = sorted(latency_task.result())
+    return elapsed, lateness
+
+
+def report(label, elapsed, lateness):
+    mean = sum(lateness) / len(lateness)
+    p99 = lateness[int(len(lateness) * 0.99)]
+    print("  %-12s %7.3f s total, timer late by %6.2f ms mean, %6.2f ms p99, %6.2f ms max" % (
+        label, elapsed, mean * 1e3, p99 * 1e3, lateness[-1] * 1e3))
+
+
+def main(peer_count=8, block_count=10, block_size=1024*1024):
+    frames = [
+        make_frame(MAGIC_HEADER, "alert", payload=os.urandom(block_size), signature=b'')
+        for i in range(block_count)]
+    print("%d peers each receiving %d messages of %d bytes" % (peer_count, block_count, block_size))
+    report("event loop", *run(peer_count, frames, None))
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    report("thread pool", *run(peer_count, frames, executor))
+    executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""
+Compare the precompiled message codecs in pycoinnet.message against
+the original implementation, which re-split the structure string
+on every call.
+
+    $ python benchmarks/bench_message_codecs.py
+"""
+
+import hashlib
+import io
+import os
+import sys
+import timeit
+
+# run from anywhere, without installing pycoinnet
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from pycoin.serialize import bitcoin_streamer
+from pycoin.tx.Tx import Tx, TxIn, TxOut
+
+from pycoinnet.InvItem import InvItem, ITEM_TYPE_TX
+from pycoinnet.PeerAddress import PeerAddress
+from pycoinnet.message import MESSAGE_STRUCTURES, parse_from_data, pack_from_data
+
+
+def legacy_parse_from_data(message_name, data):
+    the_struct = MESSAGE_STRUCTURES[message_name]
+    struct_items = [s.split(":") for s in the_struct.split()]
+    names = [s[0] for s in struct_items]
+    types = ''.join(s[1] for s in struct_items)
+    return bitcoin_streamer.parse_as_dict(names, types, io.BytesIO(data))
+
+
+def legacy_pack_from_data(message_name, **kwargs):
+    the_struct = MESSAGE_STRUCTURES[message_name]
+    if not the_struct:
+        return b''
+    f = io.BytesIO()
+    for name, type in [t.split(":") for t in the_struct.split(" ")]:
+        if type[0] == '[':
+            bitcoin_streamer.BITCOIN_STREAMER.stream_struct("I", f, len(kwargs[name]))
+            for v in kwargs[name]:
+                if not isinstance(v, (tuple, list)):
+                    v = [v]
+                bitcoin_streamer.BITCOIN_STREAMER.stream_struct(type[1:-1], f, *v)
+        else:
+            bitcoin_streamer.BITCOIN_STREAMER.stream_struct(type, f, kwargs[name])
+    return f.getvalue()
+
+
+def make_hash(i):
+    return hashlib.sha256(("%d" % i).encode()).digest()
+
+
+def sample_messages():
+    tx = Tx(1, [TxIn(make_hash(i), i % 2) for i in range(3)], [TxOut(40000, make_hash(9))])
+    return [
+        ("ping", dict(nonce=1234567)),
+        ("inv", dict(items=[InvItem(ITEM_TYPE_TX, make_hash(i)) for i in range(10)])),
+        ("getheaders", dict(version=1, hashes=[make_hash(i) for i in range(30)], hash_stop=b'\0' * 32)),
+        ("addr", dict(date_address_tuples=[(1392760610, PeerAddress(1, "10.0.0.%d" % i, 8333)) for i in range(10)])),
+        ("tx", dict(tx=tx)),
+    ]
+
+
+def bench(label, f, number):
+    t = min(timeit.repeat(f, number=number, repeat=3))
+    print("  %-8s %8.2f us/call" % (label, t * 1e6 / number))
+    return t
+
+
+def main(number=20000):
+    for message_name, kwargs in sample_messages():
+        data = pack_from_data(message_name, **kwargs)
+        assert data == legacy_pack_from_data(message_name, **kwargs)
+        print("%s (%d bytes)" % (message_name, len(data)))
+        print(" pack")
+        t0 = bench("legacy", lambda: legacy_pack_from_data(message_name, **kwargs), number)
+        t1 = bench("compiled", lambda: pack_from_data(message_name, **kwargs), number)
+        print("  speedup  %8.2fx" % (t0 / t1))
+        print(" parse")
+        t0 = bench("legacy", lambda: legacy_parse_from_data(message_name, data), number)
+        t1 = bench("compiled", lambda: parse_from_data(message_name, data), number)
+        print("  speedup  %8.2fx" % (t0 / t1))
+
+
+if __name__ == '__main__':
+    main()
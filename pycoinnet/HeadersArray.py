@@ -0,0 +1,94 @@
+import hashlib
+import io
+import struct
+
+from pycoin.block import BlockHeader
+from pycoin.serialize.bitcoin_streamer import parse_bc_int
+
+HEADER_SIZE = 80
+HEADER_STRUCT = struct.Struct("<L32s32sLLL")
+# a header in a "headers" message is followed by a tx count, which is
+# always 0 in practice, so each record is normally 81 bytes
+RECORD_STRUCT = struct.Struct("<L32s32sLLLB")
+
+
+def _parse_count(f):
+    # parse_bc_int raises TypeError or struct.error if it runs out of bytes
+    try:
+        return parse_bc_int(f)
+    except (TypeError, struct.error):
+        raise ValueError("headers message is truncated")
+
+
+class HeadersArray(object):
+    """
+    The block headers from a "headers" message, kept as the packed payload
+    plus the offset of each header, rather than as a BlockHeader object per
+    header. The hashes are computed in one pass over the payload.
+
+    Use hash_parent_weight_tuples() to feed BlockChain.add_nodes.
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+        self._hashes = None
+        self._fields = None
+
+    @classmethod
+    def from_payload(self, payload):
+        """
+        Raise ValueError if the payload is malformed.
+        """
+        blob = bytes(payload)
+        f = io.BytesIO(blob)
+        count = _parse_count(f)
+        start = f.tell()
+        end = start + count * RECORD_STRUCT.size
+        if len(blob) == end and all(blob[o] < 253 for o in range(start + HEADER_SIZE, end, RECORD_STRUCT.size)):
+            return self(blob, range(start, end, RECORD_STRUCT.size))
+        # some tx count is more than one byte: walk the records
+        offsets = []
+        for i in range(count):
+            offsets.append(f.tell())
+            f.seek(HEADER_SIZE, io.SEEK_CUR)
+            if f.tell() >= len(blob):
+                raise ValueError("headers message is truncated")
+            _parse_count(f)
+        return self(blob, offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        return BlockHeader(*self._all_fields()[idx])
+
+    def __iter__(self):
+        for fields in self._all_fields():
+            yield BlockHeader(*fields)
+
+    def hashes(self):
+        if self._hashes is None:
+            sha256 = hashlib.sha256
+            view = memoryview(self.blob)
+            self._hashes = [sha256(sha256(view[o:o+HEADER_SIZE]).digest()).digest() for o in self.offsets]
+        return self._hashes
+
+    def _all_fields(self):
+        if self._fields is None:
+            offsets = self.offsets
+            if isinstance(offsets, range) and offsets.step == RECORD_STRUCT.size:
+                blob = self.blob[offsets.start:offsets.stop]
+                self._fields = [t[:-1] for t in RECORD_STRUCT.iter_unpack(blob)]
+            else:
+                self._fields = [HEADER_STRUCT.unpack_from(self.blob, o) for o in offsets]
+        return self._fields
+
+    def previous_block_hashes(self):
+        return [t[1] for t in self._all_fields()]
+
+    def difficulties(self):
+        return [t[4] for t in self._all_fields()]
+
+    def hash_parent_weight_tuples(self):
+        return zip(self.hashes(), self.previous_block_hashes(), self.difficulties())
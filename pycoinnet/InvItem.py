@@ -1,9 +1,16 @@
+import struct
+
 from pycoin.serialize import b2h_rev
 from pycoin.serialize.bitcoin_streamer import parse_struct, stream_struct
 
 ITEM_TYPE_TX, ITEM_TYPE_BLOCK = (1, 2)
 
+INV_ITEM_STRUCT = struct.Struct("<L32s")
+
+
 class InvItem(object):
+    __slots__ = ("item_type", "data")
+
     def __init__(self, item_type, data):
         self.item_type = item_type
         self.data = data
@@ -33,3 +40,20 @@ class InvItem(object):
     @classmethod
     def parse(self, f):
         return self(*parse_struct("L#", f))
+
+    @classmethod
+    def parse_list(self, f, count):
+        """
+        Parse count InvItem objects, as found in inv, getdata and
+        notfound messages, in one pass. Raise ValueError if there aren't
+        that many.
+        """
+        blob = f.read(count * INV_ITEM_STRUCT.size)
+        if len(blob) != count * INV_ITEM_STRUCT.size:
+            raise ValueError("inv item list is truncated")
+        return tuple(self(*t) for t in INV_ITEM_STRUCT.iter_unpack(blob))
+
+    @classmethod
+    def stream_list(self, f, inv_items):
+        pack = INV_ITEM_STRUCT.pack
+        f.write(b''.join(pack(inv_item.item_type, inv_item.data) for inv_item in inv_items))
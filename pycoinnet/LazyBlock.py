@@ -0,0 +1,126 @@
+import io
+import struct
+
+from pycoin.block import Block
+from pycoin.encoding import double_sha256
+from pycoin.serialize.bitcoin_streamer import parse_bc_int
+from pycoin.tx.Tx import Tx
+
+HEADER_SIZE = 80
+HEADER_STRUCT = struct.Struct("<L32s32sLLL")
+
+
+class LazyBlock(Block):
+    """
+    A Block that keeps its serialized bytes and only parses the 80 byte
+    header up front. The transactions are parsed the first time txs is
+    used, and streaming just copies the original bytes.
+
+    Most code that sees a block only wants hash(), previous_block_hash or
+    difficulty, so this skips decoding every transaction of a large block.
+    Nothing checks the transactions until check_txs() is called, so call
+    it before storing or relaying a block from the network.
+    """
+
+    @classmethod
+    def parse(self, f):
+        """
+        Parse a block from the file-like object f. Unlike Block.parse, this
+        consumes the rest of the stream, so f should hold just the block.
+        """
+        return self.from_bin(f.read())
+
+    @classmethod
+    def from_bin(self, blob):
+        if len(blob) < HEADER_SIZE:
+            raise ValueError("block is only %d bytes" % len(blob))
+        block = self.__new__(self)
+        (block.version, block.previous_block_hash, block.merkle_root,
+            block.timestamp, block.difficulty, block.nonce) = HEADER_STRUCT.unpack(blob[:HEADER_SIZE])
+        block._blob = bytes(blob)
+        block._txs = None
+        block._hash = None
+        block._extra_bytes = 0
+        block._txs_checked = False
+        return block
+
+    def __init__(self, *args, **kwargs):
+        self._blob = None
+        self._hash = None
+        self._extra_bytes = 0
+        self._txs_checked = False
+        super(LazyBlock, self).__init__(*args, **kwargs)
+
+    def _parse_txs(self):
+        f = io.BytesIO(self._blob)
+        f.seek(HEADER_SIZE)
+        count = parse_bc_int(f)
+        txs = [Tx.parse(f, is_first_in_block=(i == 0)) for i in range(count)]
+        return txs, len(self._blob) - f.tell()
+
+    @property
+    def txs(self):
+        if self._txs is None:
+            self._txs, self._extra_bytes = self._parse_txs()
+        return self._txs
+
+    @txs.setter
+    def txs(self, txs):
+        # the serialized form no longer matches
+        self._txs = txs
+        self._blob = None
+        self._extra_bytes = 0
+        self._txs_checked = False
+
+    def check_txs(self):
+        """
+        Parse the transactions if they haven't been yet, and check that
+        they fill the block exactly and match the merkle root. Raises
+        ValueError or BadMerkleRootError. Only the first call does any work.
+        """
+        if self._txs_checked:
+            return
+        if self._txs is None:
+            try:
+                self._txs, self._extra_bytes = self._parse_txs()
+            except Exception as ex:
+                raise ValueError("can't parse transactions of block %s: %s" % (self.id(), ex))
+        if self._extra_bytes:
+            raise ValueError("block %s has %d bytes after its transactions" % (self.id(), self._extra_bytes))
+        self.check_merkle_hash()
+        self._txs_checked = True
+
+    def tx_count(self):
+        if self._txs is not None:
+            return len(self._txs)
+        f = io.BytesIO(self._blob)
+        f.seek(HEADER_SIZE)
+        return parse_bc_int(f)
+
+    def is_parsed(self):
+        return self._txs is not None
+
+    def hash(self):
+        if self._hash is None:
+            if self._blob is not None:
+                self._hash = double_sha256(self._blob[:HEADER_SIZE])
+            else:
+                self._hash = super(LazyBlock, self).hash()
+        return self._hash
+
+    def as_bin(self):
+        if self._blob is None:
+            f = io.BytesIO()
+            super(LazyBlock, self).stream(f)
+            self._blob = f.getvalue()
+        return self._blob
+
+    def stream(self, f):
+        f.write(self.as_bin())
+
+    def __str__(self):
+        return "LazyBlock [%s] (previous %s) [tx count: %d]" % (
+            self.id(), self.previous_block_id(), self.tx_count())
+
+    def __repr__(self):
+        return str(self)
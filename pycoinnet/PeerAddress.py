@@ -2,19 +2,54 @@ import binascii
 import ipaddress
 import struct
 
-from pycoin.serialize.bitcoin_streamer import parse_struct
-
 
 IP4_HEADER = binascii.unhexlify("00000000000000000000FFFF")
 
+# services, ip (16 bytes) and port, as found in version and addr messages.
+# The port is big endian, so it's left as bytes here.
+ADDRESS_STRUCT = struct.Struct("<Q16s2s")
+# the same, preceded by a timestamp, as found in addr messages
+DATE_ADDRESS_STRUCT = struct.Struct("<LQ16s2s")
+
+
+def _ip_bin_from_wire(ip_bin):
+    if ip_bin.startswith(IP4_HEADER):
+        return ip_bin[len(IP4_HEADER):]
+    return ip_bin
+
 
 class PeerAddress(object):
+    """
+    A network address. The ipaddress object is only created when
+    ip_address is used; until then just the packed address is kept.
+    """
+    __slots__ = ("services", "_ip_bin", "_ip_address", "port")
+
     def __init__(self, services, ip_int_or_str, port):
         ip_address = ipaddress.ip_address(ip_int_or_str)
         self.services = services
-        self.ip_address = ip_address
+        self._ip_bin = ip_address.packed
+        self._ip_address = ip_address
         self.port = port
 
+    @classmethod
+    def from_bin(self, services, ip_bin, port):
+        """
+        Create a PeerAddress from a 4 or 16 byte packed address.
+        """
+        peer_address = self.__new__(self)
+        peer_address.services = services
+        peer_address._ip_bin = ip_bin
+        peer_address._ip_address = None
+        peer_address.port = port
+        return peer_address
+
+    @property
+    def ip_address(self):
+        if self._ip_address is None:
+            self._ip_address = ipaddress.ip_address(self._ip_bin)
+        return self._ip_address
+
     def __repr__(self):
         return "%s/%d" % (self.ip_address, self.port)
 
@@ -22,24 +57,48 @@ class PeerAddress(object):
         return self.ip_address.exploded
 
     def stream(self, f):
-        f.write(struct.pack("<Q", self.services))
-        ip_bin = self.ip_address.packed
+        f.write(self.as_bin())
+
+    def as_bin(self):
+        ip_bin = self._ip_bin
         if len(ip_bin) < 16:
-            f.write(IP4_HEADER)
-        f.write(ip_bin)
-        f.write(struct.pack("!H", self.port))
+            ip_bin = IP4_HEADER + ip_bin
+        return ADDRESS_STRUCT.pack(self.services, ip_bin, self.port.to_bytes(2, byteorder="big"))
 
     @classmethod
     def parse(self, f):
-        services, ip_bin, port = parse_struct("Q@h", f)
-        if ip_bin.startswith(IP4_HEADER):
-            ip_bin = ip_bin[len(IP4_HEADER):]
-        ip_int = int.from_bytes(ip_bin, byteorder="big")
-        return self(services, ip_int, port)
+        services, ip_bin, port = ADDRESS_STRUCT.unpack(f.read(ADDRESS_STRUCT.size))
+        return self.from_bin(services, _ip_bin_from_wire(ip_bin), int.from_bytes(port, byteorder="big"))
+
+    @classmethod
+    def parse_date_address_tuples(self, f, count):
+        """
+        Parse count (timestamp, PeerAddress) pairs, as found in an addr
+        message, in one pass. Raise ValueError if there aren't that many.
+        """
+        blob = f.read(count * DATE_ADDRESS_STRUCT.size)
+        if len(blob) != count * DATE_ADDRESS_STRUCT.size:
+            raise ValueError("address list is truncated")
+        from_bin = self.from_bin
+        return tuple(
+            (timestamp, from_bin(services, _ip_bin_from_wire(ip_bin), int.from_bytes(port, byteorder="big")))
+            for timestamp, services, ip_bin, port in DATE_ADDRESS_STRUCT.iter_unpack(blob))
+
+    @classmethod
+    def stream_date_address_tuples(self, f, date_address_tuples):
+        f.write(b''.join(
+            struct.pack("<L", timestamp) + peer_address.as_bin()
+            for timestamp, peer_address in date_address_tuples))
 
     def __lt__(self, other):
-        return self.ip_address.packed < other.ip_address.packed
+        return self._ip_bin < other._ip_bin
 
     def __eq__(self, other):
         return self.services == other.services and \
-            self.ip_address == other.ip_address and self.port == other.port
+            self._ip_bin == other._ip_bin and self.port == other.port
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self._ip_bin, self.port))
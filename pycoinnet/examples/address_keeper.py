@@ -73,7 +73,7 @@ class AddressDB(object):
 
 class AddressKeeper:
     def __init__(self, peer, address_db):
-        next_message = peer.new_get_next_message_f(lambda name, data: name == 'addr')
+        next_message = peer.new_get_next_message_f(names=["addr"])
 
         def get_msg_addr():
             peer.send_msg("getaddr")
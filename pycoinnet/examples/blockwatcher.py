@@ -67,31 +67,17 @@ def get_last_processed_block(config_dir):
         last_processed_block = 0
     return last_processed_block
 
-def block_processor(change_q, blockfetcher, config_dir, blockdir, depth):
+@asyncio.coroutine
+def block_processor(block_chain, blockfetcher, config_dir, blockdir, depth):
     last_processed_block = get_last_processed_block(config_dir)
-    block_q = asyncio.Queue()
-    while True:
-        add_remove, block_hash, block_index = yield from change_q.get()
-        if add_remove == "remove":
-            the_other = block_q.pop()
-            if the_other[1:] != (block_hash, block_index):
-                logging.fatal("problem merging! did the block chain fork? %s %s", the_other, block_hash)
-                import sys
-                sys.exit(-1)
-            continue
-        if add_remove != "add":
-            logging.error("something weird from change_q")
-            continue
-        if block_index < last_processed_block:
-            continue
-        item = (blockfetcher.get_block_future(block_hash, block_index), block_hash, block_index)
-        block_q.put_nowait(item)
-        if change_q.qsize() > 0:
-            continue
-        while block_q.qsize() > depth:
-            # we have blocks that are buried and ready to write
-            future, block_hash, block_index = yield from block_q.get()
-            block = yield from asyncio.wait_for(future, timeout=None)
+    change_q = block_chain.new_change_q()
+    # the stream fetches ahead, and backs up if the chain forks below it
+    with blockfetcher.iter_blocks(block_chain, last_processed_block) as stream:
+        while True:
+            # only write blocks that are buried deep enough
+            while stream.next_index >= block_chain.length() - depth:
+                yield from change_q.get()
+            block_index, block = yield from stream.next_block()
             write_block_to_disk(blockdir, block, block_index)
             update_last_processed_block(config_dir, block_index)
 
@@ -191,16 +177,12 @@ def main():
     blockhandler = BlockHandler(inv_collector, block_chain, block_store,
         should_download_f=lambda block_hash, block_index: block_index >= args.fast_forward)
 
-    last_processed_block = max(get_last_processed_block(config_dir), args.fast_forward)
-    update_last_processed_block(config_dir, last_processed_block)
-
-    change_q = asyncio.Queue()
-    from pycoinnet.util.BlockChain import _update_q
-    block_chain.add_change_callback(lambda blockchain, ops: _update_q(change_q, ops))
+    last_processed_block = max(get_last_processed_block(args.config_dir), args.fast_forward)
+    update_last_processed_block(args.config_dir, last_processed_block)
 
     block_processor_task = asyncio.Task(
         block_processor(
-            change_q, blockfetcher, args.config_dir, args.blockdir, args.depth)))
+            block_chain, blockfetcher, args.config_dir, args.blockdir, args.depth))
 
     fast_forward_add_peer = fast_forwarder_add_peer_f(block_chain)
 
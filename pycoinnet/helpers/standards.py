@@ -3,6 +3,7 @@ import logging
 import os
 import time
 
+from pycoinnet.HeadersArray import HeadersArray
 from pycoinnet.PeerAddress import PeerAddress
 
 logging = logging.getLogger("standards")
@@ -96,31 +97,55 @@ def initial_handshake(peer, version_parameters):
     return version_data
 
 
-def install_ping_manager(peer, heartbeat_rate=60, missing_pong_disconnect_timeout=60):
+def _pong_nonce(peer, payload):
+    try:
+        return peer.parse_raw("pong", payload)["nonce"]
+    except Exception:
+        return None
+
+
+def install_ping_manager(peer, heartbeat_rate=60, missing_pong_disconnect_timeout=60, ping_interval=30):
+    """
+    Ping the peer after heartbeat_rate seconds without any message from it,
+    and also every ping_interval seconds, so busy peers get measured too
+    (pass None to only ping on silence). Round trip times are recorded in
+    peer.rtt. A peer that doesn't answer a ping within
+    missing_pong_disconnect_timeout seconds is disconnected.
+    """
     @asyncio.coroutine
     def ping_task(next_message):
+        nonce = None
+        next_ping_time = time.time() + ping_interval if ping_interval else None
         while True:
+            now = time.time()
+            if nonce is None:
+                timeout = heartbeat_rate
+                if next_ping_time is not None:
+                    timeout = min(timeout, next_ping_time - now)
+            else:
+                timeout = end_time - now
             try:
-                yield from asyncio.wait_for(next_message(), timeout=heartbeat_rate)
+                name, payload = yield from asyncio.wait_for(next_message(), timeout=max(0, timeout))
+                # payloads are raw, so only pongs get parsed
+                if name == "pong" and nonce is not None and _pong_nonce(peer, payload) == nonce:
+                    peer.rtt.record(time.time() - ping_time)
+                    nonce = None
                 continue
             except asyncio.TimeoutError:
                 pass
-            # oh oh! no messages
+            if nonce is not None:
+                peer.connection_lost(None)
+                logging.error("remote peer %s didn't answer ping, disconnecting", peer)
+                return
+            # oh oh! no messages, or it's time to measure the round trip
             # send a ping
             nonce = int.from_bytes(os.urandom(8), byteorder="big")
             peer.send_msg("ping", nonce=nonce)
-            end_time = time.time() + missing_pong_disconnect_timeout
-            while True:
-                try:
-                    timeout = end_time - time.time()
-                    name, data = yield from asyncio.wait_for(next_message(), timeout=timeout)
-                    if name == "pong" and data["nonce"] == nonce:
-                        break
-                except asyncio.TimeoutError:
-                    peer.connection_lost(None)
-                    logging.error("remote peer %s didn't answer ping, disconnecting", peer)
-                    return
-    next_message = peer.new_get_next_message_f()
+            ping_time = time.time()
+            end_time = ping_time + missing_pong_disconnect_timeout
+            if ping_interval:
+                next_ping_time = ping_time + ping_interval
+    next_message = peer.new_get_next_message_f(raw=True)
     peer.add_task(ping_task(next_message))
 
 
@@ -131,18 +156,18 @@ def install_pong_manager(peer):
             name, data = yield from next_message()
             assert name == 'ping'
             peer.send_msg("pong", nonce=data["nonce"])
-    next_message = peer.new_get_next_message_f(lambda name, data: name == 'ping')
+    next_message = peer.new_get_next_message_f(names=["ping"])
     peer.add_task(pong_task(next_message))
 
 
-def install_pingpong_manager(peer):
-    install_ping_manager(peer)
+def install_pingpong_manager(peer, ping_interval=30):
+    install_ping_manager(peer, ping_interval=ping_interval)
     install_pong_manager(peer)
 
 
 @asyncio.coroutine
 def get_date_address_tuples(peer):
-    next_message = peer.new_get_next_message_f(lambda name, data: name == 'addr')
+    next_message = peer.new_get_next_message_f(names=["addr"])
     peer.send_msg("getaddr")
     name, data = yield from next_message()
     return data["date_address_tuples"]
@@ -152,7 +177,24 @@ def get_date_address_tuples(peer):
 def get_headers_hashes(peer, after_block_hash):
     hashes = [after_block_hash]
     peer.send_msg(message_name="getheaders", version=1, hashes=hashes, hash_stop=after_block_hash)
-    next_message = peer.new_get_next_message_f(lambda name, data: name == 'headers')
+    next_message = peer.new_get_next_message_f(names=["headers"])
     name, data = yield from next_message()
     headers = [bh for bh, t in data["headers"]]
     return headers
+
+
+@asyncio.coroutine
+def get_headers_array(peer, after_block_hash):
+    """
+    Like get_headers_hashes, but returns a HeadersArray, which decodes the
+    whole reply in bulk instead of building a BlockHeader per header.
+    """
+    next_message = peer.new_get_next_message_f(names=["headers"], raw=True)
+    peer.send_msg(message_name="getheaders", version=1, hashes=[after_block_hash], hash_stop=after_block_hash)
+    name, payload = yield from next_message()
+    try:
+        return peer.parse_raw(name, payload, HeadersArray.from_payload)
+    except ValueError:
+        logging.exception("error parsing headers message from %s", peer)
+        peer.transport.close()
+        raise EOFError
@@ -3,6 +3,7 @@ import asyncio
 from pycoinnet.helpers import standards
 from pycoinnet.peer.BitcoinPeerProtocol import BitcoinPeerProtocol, BitcoinProtocolError
 from pycoinnet.PeerAddress import PeerAddress
+from pycoinnet.peer.tests.helper import make_tx
 
 MAGIC_HEADER = b"food"
 
@@ -87,6 +88,28 @@ def test_ping_pong():
     assert peer1.writ_data[-26:] == peer2.writ_data[-26:]
 
 
+def test_ping_rtt():
+    peer1, peer2 = create_peers()
+
+    f1 = asyncio.Task(standards.initial_handshake(peer1, VERSION_MSG))
+    f2 = asyncio.Task(standards.initial_handshake(peer2, VERSION_MSG_2))
+
+    asyncio.get_event_loop().run_until_complete(asyncio.wait([f1, f2]))
+
+    assert peer1.score() == peer1.rtt.DEFAULT_RTT
+    standards.install_ping_manager(peer1, ping_interval=0.1)
+    standards.install_pong_manager(peer2)
+
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.35))
+    assert peer1.rtt.count >= 2
+    assert peer1.score() < 0.1
+    assert peer1.stats_snapshot()["rtt"]["max"] < 0.1
+
+    # stop pinging
+    peer1.connection_lost(None)
+    peer2.connection_lost(None)
+
+
 def test_missing_pong_disconnect():
     peer1, peer2 = create_peers()
 
@@ -143,3 +166,99 @@ def test_get_date_address_tuples():
 
     date_address_tuples = f2.result()
     assert date_address_tuples == DA_TUPLES
+
+
+def test_get_headers_array():
+    from pycoin.block import BlockHeader
+    from pycoinnet.peer.tests.helper import make_blocks
+
+    peer1, peer2 = create_peers()
+
+    blocks = make_blocks(10)
+    headers = [BlockHeader(b.version, b.previous_block_hash, b.merkle_root, b.timestamp, b.difficulty, b.nonce)
+               for b in blocks]
+
+    @asyncio.coroutine
+    def run_peer1():
+        yield from standards.initial_handshake(peer1, VERSION_MSG)
+        next_message = peer1.new_get_next_message_f(names=["getheaders"])
+        name, data = yield from next_message()
+        peer1.send_msg("headers", headers=[(h, 0) for h in headers])
+        return name, data
+
+    @asyncio.coroutine
+    def run_peer2():
+        yield from standards.initial_handshake(peer2, VERSION_MSG_2)
+        headers_array = yield from standards.get_headers_array(peer2, b'\0' * 32)
+        return headers_array
+
+    f1 = asyncio.Task(run_peer1())
+    f2 = asyncio.Task(run_peer2())
+
+    asyncio.get_event_loop().run_until_complete(asyncio.wait([f1, f2]))
+
+    name, data = f1.result()
+    assert name == 'getheaders'
+    assert data["hashes"] == (b'\0' * 32,)
+
+    headers_array = f2.result()
+    assert headers_array.hashes() == [h.hash() for h in headers]
+
+
+def test_get_headers_array_malformed():
+    import struct
+    from pycoin.encoding import double_sha256
+
+    peer1, peer2 = create_peers()
+    closed = []
+    peer2.transport.close = lambda: closed.append(True)
+    # a good checksum, but it claims two headers and has room for one
+    payload = b'\x02' + b'\0' * 100
+    frame = MAGIC_HEADER + b"headers\0\0\0\0\0" + struct.pack("<L", len(payload)) + double_sha256(payload)[:4] + payload
+
+    @asyncio.coroutine
+    def run_peer1():
+        yield from standards.initial_handshake(peer1, VERSION_MSG)
+        next_message = peer1.new_get_next_message_f(names=["getheaders"])
+        yield from next_message()
+        peer1.send_frame("headers", frame)
+
+    @asyncio.coroutine
+    def run_peer2():
+        yield from standards.initial_handshake(peer2, VERSION_MSG_2)
+        try:
+            yield from standards.get_headers_array(peer2, b'\0' * 32)
+        except EOFError:
+            return "EOF"
+
+    f1 = asyncio.Task(run_peer1())
+    f2 = asyncio.Task(run_peer2())
+    asyncio.get_event_loop().run_until_complete(asyncio.wait([f1, f2], timeout=5))
+    assert f2.result() == "EOF"
+    assert closed == [True]
+
+
+def test_ping_manager_doesnt_parse_other_messages():
+    peer1, peer2 = create_peers()
+
+    f1 = asyncio.Task(standards.initial_handshake(peer1, VERSION_MSG))
+    f2 = asyncio.Task(standards.initial_handshake(peer2, VERSION_MSG_2))
+
+    asyncio.get_event_loop().run_until_complete(asyncio.wait([f1, f2]))
+
+    standards.install_pingpong_manager(peer1, ping_interval=0.1)
+    standards.install_pingpong_manager(peer2)
+
+    for i in range(5):
+        peer2.send_msg("tx", tx=make_tx(i))
+
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.25))
+
+    messages = peer1.stats_snapshot()["messages"]
+    assert messages["tx"]["delivered"] == 5
+    assert messages["tx"]["parsed"] == 0
+    # pongs still get matched up
+    assert peer1.rtt.count >= 1
+
+    peer1.connection_lost(None)
+    peer2.connection_lost(None)
@@ -3,11 +3,12 @@ import logging
 import io
 import struct
 
-from pycoin.block import Block, BlockHeader
+from pycoin.block import BlockHeader
 from pycoin.serialize import bitcoin_streamer
 from pycoin.tx.Tx import Tx
 
 from pycoinnet.InvItem import InvItem
+from pycoinnet.LazyBlock import LazyBlock
 from pycoinnet.PeerAddress import PeerAddress
 
 ### definitions of message structures and types
@@ -18,7 +19,7 @@ from pycoinnet.PeerAddress import PeerAddress
 # [LA]: array of (L, PeerAddress) tuples
 # b: boolean
 # A: PeerAddress object
-# B: Block object
+# B: Block object (a LazyBlock, which parses transactions on demand)
 # T: Tx object
 
 MESSAGE_STRUCTURES = {
@@ -54,13 +55,168 @@ MESSAGE_STRUCTURES = {
 }
 
 
+# fixed-width types that can be decoded with a single precompiled struct.Struct
+FIXED_WIDTH_FORMATS = {
+    'L': "L",
+    'Q': "Q",
+    '#': "32s",
+    '@': "16s",
+}
+
+
+def _split_struct(the_struct):
+    return [tuple(s.split(":")) for s in the_struct.split()]
+
+
+def _parse_f_for_type(c):
+    # types with no registered function fail when used, not at import
+    parse_lookup = bitcoin_streamer.BITCOIN_STREAMER.parse_lookup
+    f = parse_lookup.get(c)
+    if f:
+        return f
+    return lambda s: parse_lookup[c](s)
+
+
+def _stream_f_for_type(c):
+    stream_lookup = bitcoin_streamer.BITCOIN_STREAMER.stream_lookup
+    f = stream_lookup.get(c)
+    if f:
+        return f
+    return lambda s, v: stream_lookup[c](s, v)
+
+
+# array item types with a codec that handles the whole array in one pass
+BULK_ARRAY_CODECS = {
+    'v': (InvItem.parse_list, InvItem.stream_list),
+    'LA': (PeerAddress.parse_date_address_tuples, PeerAddress.stream_date_address_tuples),
+}
+
+
+def _compile_array_parser(subfmt):
+    parse_count = bitcoin_streamer.parse_bc_int
+    if subfmt in BULK_ARRAY_CODECS:
+        parse_list = BULK_ARRAY_CODECS[subfmt][0]
+
+        def parse_bulk_array(f):
+            return parse_list(f, parse_count(f))
+        return parse_bulk_array
+
+    if len(subfmt) == 1 and subfmt in FIXED_WIDTH_FORMATS:
+        the_struct = struct.Struct("<" + FIXED_WIDTH_FORMATS[subfmt])
+        size = the_struct.size
+
+        def parse_fixed_array(f):
+            count = parse_count(f)
+            blob = f.read(size * count)
+            if len(blob) != size * count:
+                raise ValueError("array is truncated")
+            return tuple(t[0] for t in the_struct.iter_unpack(blob))
+        return parse_fixed_array
+
+    parse_fs = [_parse_f_for_type(c) for c in subfmt]
+    if len(parse_fs) == 1:
+        parse_item = parse_fs[0]
+
+        def parse_array(f):
+            return tuple(parse_item(f) for i in range(parse_count(f)))
+        return parse_array
+
+    def parse_tuple_array(f):
+        return tuple(tuple(pf(f) for pf in parse_fs) for i in range(parse_count(f)))
+    return parse_tuple_array
+
+
+def _compile_array_streamer(subfmt):
+    stream_count = bitcoin_streamer.stream_bc_int
+    if subfmt in BULK_ARRAY_CODECS:
+        stream_list = BULK_ARRAY_CODECS[subfmt][1]
+        is_single = (len(subfmt) == 1)
+
+        def stream_bulk_array(f, v):
+            stream_count(f, len(v))
+            if is_single:
+                # like stream_struct, accept items wrapped in a list or tuple
+                v = [item[0] if isinstance(item, (tuple, list)) else item for item in v]
+            stream_list(f, v)
+        return stream_bulk_array
+
+    if len(subfmt) == 1 and subfmt in FIXED_WIDTH_FORMATS:
+        pack = struct.Struct("<" + FIXED_WIDTH_FORMATS[subfmt]).pack
+
+        def stream_fixed_array(f, v):
+            stream_count(f, len(v))
+            # like stream_struct, accept items wrapped in a list or tuple
+            f.write(b''.join(
+                pack(item[0] if isinstance(item, (tuple, list)) else item) for item in v))
+        return stream_fixed_array
+
+    stream_fs = [_stream_f_for_type(c) for c in subfmt]
+
+    def stream_array(f, v):
+        stream_count(f, len(v))
+        for item in v:
+            if not isinstance(item, (tuple, list)):
+                item = [item]
+            for sf, x in zip(stream_fs, item):
+                sf(f, x)
+    return stream_array
+
+
+def _compile_codec(the_struct):
+    """
+    Turn a message structure string into a (parse_f, stream_f) pair.
+
+    The string is split once, here, and runs of adjacent fixed-width
+    fields are collapsed into a single struct.Struct, so neither
+    function does any string work per message.
+
+    parse_f(f) reads from the stream f and returns a dict.
+    stream_f(f, kwargs) writes the fields named in kwargs to f.
+    """
+    steps = []
+    run_names = []
+    run_fmt = []
+
+    def close_run():
+        if run_names:
+            steps.append((tuple(run_names), struct.Struct("<" + "".join(run_fmt)), None, None))
+            del run_names[:]
+            del run_fmt[:]
+
+    for name, the_type in _split_struct(the_struct):
+        if the_type in FIXED_WIDTH_FORMATS:
+            run_names.append(name)
+            run_fmt.append(FIXED_WIDTH_FORMATS[the_type])
+            continue
+        close_run()
+        if the_type[0] == '[':
+            subfmt = the_type[1:-1]
+            steps.append((name, None, _compile_array_parser(subfmt), _compile_array_streamer(subfmt)))
+        else:
+            steps.append((name, None, _parse_f_for_type(the_type), _stream_f_for_type(the_type)))
+    close_run()
+
+    def parse_f(f):
+        d = {}
+        for names, the_struct, parse_item, stream_item in steps:
+            if the_struct is None:
+                d[names] = parse_item(f)
+            else:
+                d.update(zip(names, the_struct.unpack(f.read(the_struct.size))))
+        return d
+
+    def stream_f(f, kwargs):
+        for names, the_struct, parse_item, stream_item in steps:
+            if the_struct is None:
+                stream_item(f, kwargs[names])
+            else:
+                f.write(the_struct.pack(*[kwargs[n] for n in names]))
+
+    return parse_f, stream_f
+
+
 def _make_parser(the_struct=''):
-    def f(message_stream):
-        struct_items = [s.split(":") for s in the_struct.split()]
-        names = [s[0] for s in struct_items]
-        types = ''.join(s[1] for s in struct_items)
-        return bitcoin_streamer.parse_as_dict(names, types, message_stream)
-    return f
+    return _compile_codec(the_struct)[0]
 
 
 def _message_parsers():
@@ -94,7 +250,7 @@ def _make_parse_from_data():
             ("A", (PeerAddress.parse, lambda f, peer_addr: peer_addr.stream(f))),
             ("v", (InvItem.parse, lambda f, inv_item: inv_item.stream(f))),
             ("T", (Tx.parse, lambda f, tx: tx.stream(f))),
-            ("B", (Block.parse, lambda f, block: block.stream(f))),
+            ("B", (LazyBlock.parse, lambda f, block: block.stream(f))),
             ("z", (BlockHeader.parse, lambda f, blockheader: blockheader.stream(f))),
             ("b", (lambda f: struct.unpack("?", f.read(1))[0], lambda f, b: f.write(struct.pack("?", b)))),
         ]
@@ -123,20 +279,34 @@ def _make_parse_from_data():
 parse_from_data = _make_parse_from_data()
 
 
+MESSAGE_STREAMERS = dict((k, _compile_codec(v)[1]) for k, v in MESSAGE_STRUCTURES.items())
+
+
 def pack_from_data(message_name, **kwargs):
-    the_struct = MESSAGE_STRUCTURES[message_name]
-    if not the_struct:
+    stream_f = MESSAGE_STREAMERS[message_name]
+    if not MESSAGE_STRUCTURES[message_name]:
         return b''
     f = io.BytesIO()
-    the_fields = the_struct.split(" ")
-    pairs = [t.split(":") for t in the_fields]
-    for name, type in pairs:
-        if type[0] == '[':
-            bitcoin_streamer.BITCOIN_STREAMER.stream_struct("I", f, len(kwargs[name]))
-            for v in kwargs[name]:
-                if not isinstance(v, (tuple, list)):
-                    v = [v]
-                bitcoin_streamer.BITCOIN_STREAMER.stream_struct(type[1:-1], f, *v)
-        else:
-            bitcoin_streamer.BITCOIN_STREAMER.stream_struct(type, f, kwargs[name])
+    stream_f(f, kwargs)
     return f.getvalue()
+
+
+class LazyMessage(object):
+    """
+    A message payload that isn't parsed until someone asks for it.
+    The parsed dictionary is cached, so it's decoded at most once no
+    matter how many subscribers look at it. If it was already parsed
+    elsewhere, pass the result in as data.
+    """
+    def __init__(self, message_name, payload, data=None):
+        self.message_name = message_name
+        self.payload = payload
+        self._data = data
+
+    def data(self):
+        if self._data is None:
+            self._data = parse_from_data(self.message_name, self.payload)
+        return self._data
+
+    def is_parsed(self):
+        return self._data is not None
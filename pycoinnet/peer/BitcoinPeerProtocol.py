@@ -1,5 +1,6 @@
 import asyncio
 import binascii
+import collections
 import logging
 import struct
 import time
@@ -7,65 +8,186 @@ import weakref
 
 from pycoin import encoding
 
-from pycoinnet.message import parse_from_data, pack_from_data
+from pycoinnet.message import LazyMessage, pack_from_data, parse_from_data
+from pycoinnet.peer.MessageStats import MessageStats
+from pycoinnet.peer.RoundTripTimes import RoundTripTimes
 
 
 class BitcoinProtocolError(Exception):
     pass
 
 
+def make_frame(magic_header, message_name, **kwargs):
+    """
+    Serialize and checksum a message into the bytes sent on the wire.
+    """
+    message_data = pack_from_data(message_name, **kwargs)
+    message_type = message_name.encode("utf8")
+    message_type_padded = (message_type+(b'\0'*12))[:12]
+    message_size = struct.pack("<L", len(message_data))
+    message_checksum = encoding.double_sha256(message_data)[:4]
+    return b"".join([
+        magic_header, message_type_padded, message_size, message_checksum, message_data
+    ])
+
+
+def verify_payload(message_name, payload, transmitted_hash, parse=False):
+    """
+    Raise BitcoinProtocolError if the checksum of payload doesn't match
+    transmitted_hash. If parse is True, return the parsed message.
+
+    This is safe to call from a worker thread: hashlib releases the GIL
+    while hashing large buffers.
+    """
+    actual_hash = encoding.double_sha256(payload)[:4]
+    if actual_hash != transmitted_hash:
+        raise BitcoinProtocolError("checksum is WRONG: %s instead of %s" % (
+            binascii.hexlify(actual_hash), binascii.hexlify(transmitted_hash)))
+    if parse:
+        return parse_from_data(message_name, payload)
+
+
+def _queue_abandoned(peer_ref):
+    # a subscriber queue was garbage collected; it may have been the one
+    # holding up reading
+    peer = peer_ref()
+    if peer and peer._is_reading_paused:
+        asyncio.get_event_loop().call_soon(peer._maybe_resume_reading)
+
+
 class BitcoinPeerProtocol(asyncio.Protocol):
 
     MAX_MESSAGE_SIZE = 2*1024*1024
 
+    # Outgoing messages are queued here while the transport has paused
+    # writing. Once the queue passes SEND_QUEUE_HIGH_WATER bytes, the
+    # SEND_OVERFLOW_POLICY applies: "drop" discards LOW_PRIORITY_MESSAGES
+    # (and disconnects if the queue still reaches SEND_QUEUE_MAX_SIZE),
+    # "disconnect" drops the peer right away. drain() waits until the
+    # queue is back under SEND_QUEUE_LOW_WATER.
+    SEND_QUEUE_HIGH_WATER = 4*1024*1024
+    SEND_QUEUE_LOW_WATER = 1*1024*1024
+    SEND_QUEUE_MAX_SIZE = 16*1024*1024
+    SEND_OVERFLOW_POLICY = "drop"
+    LOW_PRIORITY_MESSAGES = frozenset(["inv", "addr", "getaddr", "mempool", "alert"])
+
+    # Incoming messages: when any subscriber queue holds more than its
+    # high water mark of messages (the maxsize passed to
+    # new_get_next_message_f, or READ_QUEUE_HIGH_WATER), or more than
+    # READ_QUEUE_HIGH_WATER_BYTES of payload, we stop reading from the
+    # transport until every queue is back under half those marks, or the
+    # queues still over them are abandoned and garbage collected.
+    READ_QUEUE_HIGH_WATER = 1000
+    READ_QUEUE_HIGH_WATER_BYTES = 16*1024*1024
+
+    # If CHECKSUM_EXECUTOR is set to a concurrent.futures.Executor (it can
+    # also be set on a single peer), payloads of at least
+    # CHECKSUM_OFFLOAD_THRESHOLD bytes have their checksum verified in it,
+    # instead of on the event loop thread. With PARSE_IN_EXECUTOR, they're
+    # parsed there too. Messages are still delivered in the order received.
+    CHECKSUM_EXECUTOR = None
+    CHECKSUM_OFFLOAD_THRESHOLD = 256*1024
+    PARSE_IN_EXECUTOR = False
+
     def __init__(self, magic_header, *args, **kwargs):
         super(BitcoinPeerProtocol, self).__init__(*args, **kwargs)
         self.magic_header = magic_header
         self.peername = ("(unconnected)", 0)
         self.connection_made_future = asyncio.Future()
         self.connection_lost_future = asyncio.Future()
-        self._run_handle = None
         self.message_queues = weakref.WeakSet()
+        # queues subscribed by message name, and those that need filter_f
+        # called on every message
+        self._queues_by_name = {}
+        self._filtered_queues = weakref.WeakSet()
+        # unconsumed incoming bytes: either the last bytes object passed
+        # to data_received or a bytearray we're accumulating into
+        self._buffer = b''
+        # (message_name, payload, pending, received_at) frames waiting to be
+        # delivered to queues, where pending is None or the future of a
+        # checksum being verified in CHECKSUM_EXECUTOR. _deliver_handle is either the
+        # call_soon handle or the pending future delivery is waiting for.
+        self._frames = collections.deque()
+        self._deliver_handle = None
+        self._is_dispatching = False
+        self._is_eof = False
+        self._is_eof_delivered = False
+        # packets waiting for the transport to resume writing
+        self._is_writable = True
+        self._send_queue = collections.deque()
+        self._send_queue_size = 0
+        self._drain_waiters = []
+        self._is_reading_paused = False
         ## stats
         self.bytes_read = 0
         self.bytes_writ = 0
+        self.messages_dropped = 0
         self.connect_start_time = None
+        self.stats = MessageStats()
+        self.rtt = RoundTripTimes()
         self._tasks = set()
 
-    def new_get_next_message_f(self, filter_f=lambda message_name, data: True, maxsize=0):
-        @asyncio.coroutine
-        def run(self):
-            yield from asyncio.wait_for(self.connection_made_future, timeout=None)
-            while True:
-                try:
-                    message_name, data = yield from self._parse_next_message()
-                except EOFError:
-                    logging.debug("end of stream %s", self)
-                    message_name, data = None, None
-                except Exception:
-                    logging.exception("error in _parse_next_message")
-                    message_name, data = None, None
-                for q in self.message_queues:
-                    if q.filter_f(message_name, data):
-                        q.put_nowait((message_name, data))
-                if message_name is None:
-                    break
+    def new_get_next_message_f(self, filter_f=None, maxsize=0, lazy=False, names=None, raw=False):
+        """
+        Return a coroutine function that yields (message_name, data) tuples
+        for each message accepted by filter_f, and raises EOFError at the end
+        of the stream.
+
+        If names is given, only messages with those names are delivered,
+        and they're routed straight to this queue, without calling a
+        filter for every message. This is the cheapest way to subscribe.
+        filter_f, if also given, is then only consulted for those names.
+
+        If filter_f and names are both None, every message is accepted.
 
-        q = asyncio.Queue(maxsize=maxsize)
+        If lazy is False, filter_f is called as filter_f(message_name, data)
+        with the parsed message. If lazy is True, it's called with the raw
+        payload bytes instead, so the message is only parsed when a
+        subscriber actually gets it. A message nobody accepts is never parsed.
+
+        If raw is True, data is the unparsed payload (a memoryview), for
+        subscribers that decode it themselves.
+
+        If more than maxsize messages (default READ_QUEUE_HIGH_WATER) pile
+        up unread, the peer stops reading from the network until they're
+        consumed.
+        """
+        q = asyncio.Queue()
         q.filter_f = filter_f
+        q.lazy = lazy
+        q.high_water = maxsize or self.READ_QUEUE_HIGH_WATER
+        q.pending_bytes = 0
         self.message_queues.add(q)
+        weakref.finalize(q, _queue_abandoned, weakref.ref(self))
+        if names is None:
+            self._filtered_queues.add(q)
+        else:
+            for name in names:
+                self._queues_by_name.setdefault(name, weakref.WeakSet()).add(q)
 
         def get_next_message():
-            msg_name, data = yield from q.get()
+            msg_name, message = yield from q.get()
             if msg_name is None:
                 raise EOFError
+            self.stats.record_delivery(msg_name, time.time() - message.received_at)
+            q.pending_bytes -= len(message.payload)
+            if self._is_reading_paused:
+                self._maybe_resume_reading()
+            if raw:
+                return msg_name, message.payload
+            try:
+                data = self._message_data(message)
+            except Exception:
+                logging.exception("error parsing %s message from %s", msg_name, self)
+                self.transport.close()
+                raise EOFError
             return msg_name, data
 
-        if self._run_handle:
-            if self._run_handle.done():
-                q.put_nowait((None, None))
-        else:
-            self._run_handle = asyncio.Task(run(self))
+        if self._is_eof_delivered:
+            q.put_nowait((None, None))
+        elif not self._is_dispatching:
+            self._is_dispatching = True
+            self._schedule_delivery()
         return get_next_message
 
     def add_task(self, task):
@@ -77,22 +199,111 @@ class BitcoinPeerProtocol(asyncio.Protocol):
         self._tasks.add(asyncio.async(task))
 
     def send_msg(self, message_name, **kwargs):
-        message_data = pack_from_data(message_name, **kwargs)
-        message_type = message_name.encode("utf8")
-        message_type_padded = (message_type+(b'\0'*12))[:12]
-        message_size = struct.pack("<L", len(message_data))
-        message_checksum = encoding.double_sha256(message_data)[:4]
-        packet = b"".join([
-            self.magic_header, message_type_padded, message_size, message_checksum, message_data
-        ])
-        logging.debug("sending message %s [%d bytes] to %s", message_type.decode("utf8"), len(packet), self)
-        self.bytes_writ += len(packet)
-        self.transport.write(packet)
+        self.send_frame(message_name, make_frame(self.magic_header, message_name, **kwargs))
+
+    def send_frame(self, message_name, frame):
+        """
+        Send a message already built with make_frame. The same frame can
+        be sent to any number of peers on the same network.
+        """
+        logging.debug("sending message %s [%d bytes] to %s", message_name, len(frame), self)
+        self.stats.record_sent(message_name, len(frame))
+        self._send_packet(message_name, frame)
+
+    @asyncio.coroutine
+    def send_msg_and_drain(self, message_name, **kwargs):
+        """
+        Like send_msg, but wait until the outgoing queue has drained
+        below SEND_QUEUE_LOW_WATER before returning.
+        """
+        self.send_msg(message_name, **kwargs)
+        yield from self.drain()
+
+    @asyncio.coroutine
+    def drain(self):
+        """
+        Wait until the transport is writable and no more than
+        SEND_QUEUE_LOW_WATER bytes are waiting to be sent.
+        """
+        while self._needs_drain():
+            future = asyncio.Future()
+            self._drain_waiters.append(future)
+            yield from future
+
+    def send_queue_size(self):
+        return self._send_queue_size
+
+    def stats_snapshot(self):
+        """
+        Return a dictionary of this peer's traffic totals, with per message
+        name counters (see MessageStats) under "messages".
+        """
+        return dict(
+            peer=str(self),
+            connect_start_time=self.connect_start_time,
+            bytes_read=self.bytes_read,
+            bytes_writ=self.bytes_writ,
+            messages_dropped=self.messages_dropped,
+            send_queue_size=self._send_queue_size,
+            rtt=self.rtt.snapshot(),
+            messages=self.stats.snapshot(),
+        )
+
+    def score(self):
+        """
+        How quickly this peer responds, as its expected ping round trip
+        time in seconds (see install_ping_manager). Lower is better.
+        """
+        return self.rtt.score()
+
+    def _needs_drain(self):
+        if self.connection_lost_future.done():
+            return False
+        return not self._is_writable or self._send_queue_size > self.SEND_QUEUE_LOW_WATER
+
+    def _send_packet(self, message_name, packet):
+        if self._is_writable and not self._send_queue:
+            self.bytes_writ += len(packet)
+            self.transport.write(packet)
+            return
+        if self._send_queue_size >= self.SEND_QUEUE_HIGH_WATER:
+            if self.SEND_OVERFLOW_POLICY == "disconnect" or \
+                    self._send_queue_size + len(packet) > self.SEND_QUEUE_MAX_SIZE:
+                logging.error("send queue for %s is %d bytes, disconnecting", self, self._send_queue_size)
+                self._drop_send_queue()
+                self.transport.abort()
+                return
+            if message_name in self.LOW_PRIORITY_MESSAGES:
+                logging.debug("send queue for %s is full, dropping %s message", self, message_name)
+                self.messages_dropped += 1
+                return
+        self._send_queue.append(packet)
+        self._send_queue_size += len(packet)
+
+    def _flush_send_queue(self):
+        # transport.write may call pause_writing, which stops this loop
+        while self._send_queue and self._is_writable:
+            packet = self._send_queue.popleft()
+            self._send_queue_size -= len(packet)
+            self.bytes_writ += len(packet)
+            self.transport.write(packet)
+        if not self._needs_drain():
+            self._wake_drain_waiters()
+
+    def _drop_send_queue(self):
+        self.messages_dropped += len(self._send_queue)
+        self._send_queue.clear()
+        self._send_queue_size = 0
+
+    def _wake_drain_waiters(self):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
 
     def connection_made(self, transport):
         self.connection_made_future.set_result(transport)
         self.transport = transport
-        self.reader = asyncio.StreamReader()
         self._is_writable = True
         self.peername = transport.get_extra_info("socket").getpeername()
         self.connect_start_time = time.time()
@@ -102,57 +313,209 @@ class BitcoinPeerProtocol(asyncio.Protocol):
             self.connection_lost_future.set_exception(exc)
         else:
             self.connection_lost_future.set_result(None)
-        ## TODO: fix this. This is a stupid way of doing it.
-        ## What is the correct way to shut this down?
-        self.reader.feed_eof()
+        self._drop_send_queue()
+        self._wake_drain_waiters()
+        if not self._is_eof:
+            self._is_eof = True
+            self._frames.append((None, None, None, None))
+            self._schedule_delivery()
 
     def data_received(self, data):
         self.bytes_read += len(data)
-        self.reader.feed_data(data)
+        if self._is_eof:
+            return
+        if len(self._buffer) == 0:
+            # the common case: keep the bytes object as is, and hand out
+            # views into it
+            self._buffer = data
+        else:
+            if not isinstance(self._buffer, bytearray):
+                self._buffer = bytearray(self._buffer)
+            self._buffer.extend(data)
+        self._extract_frames()
+        self._schedule_delivery()
 
     def pause_writing(self):
         self._is_writable = False
 
     def resume_writing(self):
         self._is_writable = True
+        self._flush_send_queue()
 
     def is_writable(self):
         return self._is_writable
 
-    @asyncio.coroutine
-    def _parse_next_message(self):
+    def _extract_frames(self):
+        """
+        Pull every complete message out of the buffer and queue it for
+        delivery. Payloads are memoryviews into the received bytes, so
+        they aren't copied.
+        """
+        buf = self._buffer
+        view = memoryview(buf)
+        offset = 0
+        executor = self.CHECKSUM_EXECUTOR
+        now = time.time()
+        try:
+            while True:
+                frame = self._parse_frame(view, offset)
+                if frame is None:
+                    break
+                message_name, payload, transmitted_hash, end = frame
+                self.stats.record_received(message_name, end - offset)
+                offset = end
+                pending = None
+                if executor is not None and len(payload) >= self.CHECKSUM_OFFLOAD_THRESHOLD:
+                    pending = asyncio.get_event_loop().run_in_executor(
+                        executor, verify_payload, message_name, payload,
+                        transmitted_hash, self.PARSE_IN_EXECUTOR)
+                else:
+                    verify_payload(message_name, payload, transmitted_hash)
+                self._frames.append((message_name, payload, pending, now))
+        except Exception:
+            logging.exception("error in _extract_frames")
+            self._is_eof = True
+            self.transport.close()
+            self._frames.append((None, None, None, None))
+        finally:
+            view.release()
+        if self._is_eof:
+            self._buffer = b''
+        elif offset > 0:
+            # slicing copies just the unconsumed tail; the old buffer
+            # lives on in the payload views handed out above
+            self._buffer = buf[offset:]
+
+    def _schedule_delivery(self):
+        # delivery waits for the first subscriber, then takes a single
+        # callback for however many frames arrived in the meantime
+        if self._is_dispatching and self._deliver_handle is None and self._frames:
+            self._deliver_handle = asyncio.get_event_loop().call_soon(self._deliver_frames)
+
+    def _parse_frame(self, view, offset):
+        """
+        Return (message_name, payload, checksum, end_offset) for the message
+        starting at offset, or None if it hasn't been completely received yet.
+        The checksum is not verified here.
+        """
+        magic_size = len(self.magic_header)
+        header_end = offset + magic_size + 20
+        if len(view) < header_end:
+            return None
 
-        # read magic header
-        reader = self.reader
-        blob = yield from reader.readexactly(len(self.magic_header))
+        # check magic header
+        blob = view[offset:offset+magic_size]
         if blob != self.magic_header:
             raise BitcoinProtocolError("bad magic: got %s" % binascii.hexlify(blob))
 
         # read message name
-        message_size_hash_bytes = yield from reader.readexactly(20)
-        message_name_bytes = message_size_hash_bytes[:12]
+        message_size_hash_bytes = view[offset+magic_size:header_end]
+        message_name_bytes = message_size_hash_bytes[:12].tobytes()
         message_name = message_name_bytes.replace(b"\0", b"").decode("utf8")
 
         # get size of message
-        size_bytes = message_size_hash_bytes[12:16]
-        size = int.from_bytes(size_bytes, byteorder="little")
+        size = int.from_bytes(message_size_hash_bytes[12:16], byteorder="little")
         if size > self.MAX_MESSAGE_SIZE:
             raise BitcoinProtocolError("absurdly large message size %d" % size)
 
-        # read the hash, then the message
-        transmitted_hash = message_size_hash_bytes[16:20]
-        message_data = yield from reader.readexactly(size)
+        end = header_end + size
+        if len(view) < end:
+            return None
+        message_data = view[header_end:end]
+        transmitted_hash = message_size_hash_bytes[16:20].tobytes()
+        logging.debug("message %s: %s (%d byte payload)", self, message_name, size)
+        return message_name, message_data, transmitted_hash, end
+
+    def _deliver_frames(self):
+        self._deliver_handle = None
+        while self._frames:
+            message_name, payload, pending, received_at = self._frames[0]
+            if pending is not None and not pending.done():
+                # hold everything behind it until it's verified, to keep order
+                self._deliver_handle = pending
+                pending.add_done_callback(self._frame_verified)
+                return
+            self._frames.popleft()
+            if message_name is not None:
+                try:
+                    data = pending.result() if pending else None
+                    self._dispatch(message_name, payload, data, received_at)
+                    continue
+                except Exception:
+                    logging.exception("error dispatching %s message", message_name)
+                    self._is_eof = True
+                    self._buffer = b''
+                    self.transport.close()
+            logging.debug("end of stream %s", self)
+            self._frames.clear()
+            self._is_eof_delivered = True
+            for q in list(self.message_queues):
+                q.put_nowait((None, None))
+
+    def _frame_verified(self, future):
+        self._deliver_handle = None
+        self._schedule_delivery()
+
+    def parse_raw(self, message_name, payload, parse_f=None):
+        """
+        Parse a payload handed to a raw subscriber, with parse_f(payload) or
+        by default as a message_name message, and count the time it takes
+        in stats like any other parse.
+        """
+        start = time.time()
+        if parse_f:
+            data = parse_f(payload)
+        else:
+            data = parse_from_data(message_name, payload)
+        self.stats.record_parse(message_name, time.time() - start)
+        return data
+
+    def _message_data(self, message):
+        if message.is_parsed():
+            return message.data()
+        start = time.time()
+        data = message.data()
+        self.stats.record_parse(message.message_name, time.time() - start)
+        return data
+
+    def _accepts(self, q, message):
+        if q.filter_f is None:
+            return True
+        if q.lazy:
+            return q.filter_f(message.message_name, message.payload)
+        return q.filter_f(message.message_name, self._message_data(message))
+
+    def _dispatch(self, message_name, payload, data=None, received_at=None):
+        # parsing is deferred until a subscriber wants it (see LazyMessage)
+        message = LazyMessage(message_name, payload, data)
+        message.received_at = received_at
+        queues = [q for q in self._filtered_queues if self._accepts(q, message)]
+        named_queues = self._queues_by_name.get(message_name)
+        if named_queues:
+            queues.extend(q for q in named_queues if self._accepts(q, message))
+        size = len(payload)
+        for q in queues:
+            q.put_nowait((message_name, message))
+            q.pending_bytes += size
+            if q.qsize() > q.high_water or q.pending_bytes > self.READ_QUEUE_HIGH_WATER_BYTES:
+                self._pause_reading()
 
-        # check the hash
-        actual_hash = encoding.double_sha256(message_data)[:4]
-        if actual_hash != transmitted_hash:
-            raise BitcoinProtocolError("checksum is WRONG: %s instead of %s" % (
-                binascii.hexlify(actual_hash), binascii.hexlify(transmitted_hash)))
-        logging.debug("message %s: %s (%d byte payload)", self, message_name, len(message_data))
+    def _pause_reading(self):
+        if not self._is_reading_paused and not self._is_eof:
+            logging.debug("subscribers are backed up, pausing reading from %s", self)
+            self._is_reading_paused = True
+            self.transport.pause_reading()
 
-        # parse the blob into a BitcoinProtocolMessage object
-        data = parse_from_data(message_name, message_data)
-        return message_name, data
+    def _maybe_resume_reading(self):
+        if not self._is_reading_paused:
+            return
+        for q in self.message_queues:
+            if q.qsize() > q.high_water // 2 or q.pending_bytes > self.READ_QUEUE_HIGH_WATER_BYTES // 2:
+                return
+        logging.debug("subscribers caught up, resuming reading from %s", self)
+        self._is_reading_paused = False
+        if not self._is_eof:
+            self.transport.resume_reading()
 
     def __lt__(self, other):
         return self.connect_start_time < other.connect_start_time
@@ -1,74 +1,236 @@
 import asyncio
+import collections
 import logging
-import weakref
+
+from pycoin.encoding import double_sha256
 
 from pycoinnet.InvItem import InvItem, ITEM_TYPE_TX, ITEM_TYPE_BLOCK
 
 
 class Fetcher:
-    def __init__(self, peer):
+    """
+    Fetch txs and blocks from a peer with getdata.
+
+    Requests are pipelined: at most max_in_flight items, and (by estimated
+    size) max_in_flight_bytes of responses, are outstanding at once, and
+    the rest wait in a queue. Requests made within coalesce_window seconds
+    of each other go out in the same getdata. The peer answers in order,
+    so an item is given request_timeout seconds plus the time to receive
+    the bytes outstanding ahead of it (and its own) at min_bytes_per_second.
+    An item not answered by then is given up on, and its fetch returns
+    None, as if the peer had sent notfound.
+
+    Responses are matched to requests by hashing the raw payload, so a tx
+    or block nobody asked for is counted and dropped without being parsed.
+    """
+    MAX_GETDATA_ITEMS = 50000
+    # rough response sizes used for the byte budget
+    EXPECTED_SIZE = {ITEM_TYPE_TX: 500, ITEM_TYPE_BLOCK: 1024*1024}
+    DEFAULT_EXPECTED_SIZE = 500
+
+    def __init__(self, peer, max_in_flight=5000, max_in_flight_bytes=32*1024*1024,
+                 coalesce_window=0.005, request_timeout=60, min_bytes_per_second=100*1024):
         self.peer = peer
-        self.request_q = asyncio.Queue()
-        self.futures = weakref.WeakValueDictionary()
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.coalesce_window = coalesce_window
+        self.request_timeout = request_timeout
+        self.min_bytes_per_second = min_bytes_per_second
 
-        getdata_loop_future = asyncio.Task(self._getdata_loop())
-        next_message = peer.new_get_next_message_f(
-            filter_f=lambda name, data: name in ["tx", "block", "notfound"])
-        peer.add_task(self._fetch_loop(next_message, getdata_loop_future))
+        # inv_item => list of futures, one per caller waiting for it
+        self.futures = {}
+        # items not requested yet
+        self._queue = collections.deque()
+        # items requested, in the order sent, so deadlines are in order too
+        # inv_item => deadline
+        self._in_flight = collections.OrderedDict()
+        self.in_flight_bytes = 0
+        self._flush_handle = None
+        self._deadline_handle = None
+        self._is_closed = False
+
+        ## stats
+        self.items_requested = 0
+        self.items_received = 0
+        self.items_not_found = 0
+        self.items_timed_out = 0
+        self.items_unsolicited = 0
+
+        next_message = peer.new_get_next_message_f(names=["tx", "block", "notfound"], raw=True)
+        peer.add_task(self._fetch_loop(next_message))
 
     def fetch(self, inv_item, timeout=None):
         """
         Return the fetched object or None if the remote says it doesn't have it, or
         times out by exceeding `timeout` seconds.
         """
-        future = self.futures.get(inv_item)
-        if not future:
-            future = asyncio.Future()
-            self.futures[inv_item] = future
-            self.request_q.put_nowait(inv_item)
+        future = self.request(inv_item)
         try:
             return (yield from asyncio.wait_for(future, timeout=timeout))
         except asyncio.TimeoutError:
             return None
 
+    def request(self, inv_item):
+        """
+        Queue a request for inv_item, and return a future for the fetched
+        object, or None. Each caller gets its own future, so cancelling it
+        only withdraws that caller; the item is dropped once nobody wants it.
+        """
+        future = asyncio.Future()
+        if self._is_closed:
+            future.set_result(None)
+            return future
+        waiters = self.futures.get(inv_item)
+        if waiters is None:
+            waiters = self.futures[inv_item] = []
+            self._queue.append(inv_item)
+            self._schedule_flush()
+        waiters.append(future)
+        future.add_done_callback(lambda f: self._forget(inv_item, f))
+        return future
+
     def queue_size(self):
-        pass
-        ## TODO: finish
+        """
+        The number of items waiting to be requested.
+        """
+        return len(self._queue)
 
-    @asyncio.coroutine
-    def _getdata_loop(self):
-        while True:
-            so_far = []
-            inv_item = yield from self.request_q.get()
-            while True:
-                so_far.append(inv_item)
-                if self.request_q.qsize() == 0 or len(so_far) >= 50000:
-                    break
-                inv_item = yield from self.request_q.get()
-            self.peer.send_msg("getdata", items=so_far)
+    def in_flight_count(self):
+        """
+        The number of items requested that the peer hasn't answered yet.
+        """
+        return len(self._in_flight)
+
+    def _forget(self, inv_item, future):
+        # a caller's timeout cancels its future; once no caller is left,
+        # don't keep the item around. If it's still in the queue, _flush
+        # skips it.
+        if not future.cancelled():
+            return
+        waiters = self.futures.get(inv_item)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self.futures[inv_item]
+
+    def _expected_size(self, inv_item):
+        return self.EXPECTED_SIZE.get(inv_item.item_type, self.DEFAULT_EXPECTED_SIZE)
+
+    def _schedule_flush(self):
+        if self._flush_handle is None and self._queue and not self._is_closed:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.coalesce_window, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        now = asyncio.get_event_loop().time()
+        items = []
+        while self._queue and len(self._in_flight) < self.max_in_flight:
+            inv_item = self._queue[0]
+            size = self._expected_size(inv_item)
+            if self._in_flight and self.in_flight_bytes + size > self.max_in_flight_bytes:
+                break
+            self._queue.popleft()
+            if not self.futures.get(inv_item) or inv_item in self._in_flight:
+                continue
+            self.in_flight_bytes += size
+            self._in_flight[inv_item] = self._deadline(now)
+            items.append(inv_item)
+        for i in range(0, len(items), self.MAX_GETDATA_ITEMS):
+            self.peer.send_msg("getdata", items=items[i:i+self.MAX_GETDATA_ITEMS])
+        self.items_requested += len(items)
+        self._schedule_deadline_check()
+
+    def _deadline(self, now):
+        # time to receive everything outstanding, up to and including the
+        # item just added; never before an item requested earlier, which
+        # keeps _in_flight in deadline order
+        deadline = now + self.request_timeout + self.in_flight_bytes / self.min_bytes_per_second
+        if self._in_flight:
+            deadline = max(deadline, next(reversed(self._in_flight.values())))
+        return deadline
+
+    def _schedule_deadline_check(self):
+        if self._deadline_handle is None and self._in_flight:
+            deadline = next(iter(self._in_flight.values()))
+            self._deadline_handle = asyncio.get_event_loop().call_at(deadline, self._expire_requests)
+
+    def _expire_requests(self):
+        self._deadline_handle = None
+        now = asyncio.get_event_loop().time()
+        while self._in_flight:
+            inv_item, deadline = next(iter(self._in_flight.items()))
+            if deadline > now:
+                break
+            logging.debug("%s didn't answer request for %s", self.peer, inv_item)
+            self.items_timed_out += 1
+            self._item_done(inv_item, None)
+        self._schedule_deadline_check()
+
+    def _item_done(self, inv_item, item):
+        """
+        Resolve the fetch for inv_item, and free its request slot. Return
+        False if nobody was waiting for it.
+        """
+        if inv_item in self._in_flight:
+            del self._in_flight[inv_item]
+            self.in_flight_bytes -= self._expected_size(inv_item)
+            self._schedule_flush()
+        waiters = self.futures.pop(inv_item, None)
+        if not waiters:
+            return False
+        for future in waiters:
+            if not future.done():
+                future.set_result(item)
+        return True
+
+    def _close(self):
+        self._is_closed = True
+        for handle in [self._flush_handle, self._deadline_handle]:
+            if handle:
+                handle.cancel()
+        self._flush_handle = self._deadline_handle = None
+        self._queue.clear()
+        self._in_flight.clear()
+        self.in_flight_bytes = 0
+        waiter_lists = list(self.futures.values())
+        self.futures.clear()
+        for waiters in waiter_lists:
+            for future in waiters:
+                if not future.done():
+                    future.set_result(None)
+
+    def _inv_item_for_payload(self, name, payload):
+        # a block's hash covers just its 80 byte header
+        if name == "tx":
+            return InvItem(ITEM_TYPE_TX, double_sha256(payload))
+        return InvItem(ITEM_TYPE_BLOCK, double_sha256(payload[:80]))
+
+    def _parse(self, name, payload):
+        try:
+            return self.peer.parse_raw(name, payload)
+        except Exception:
+            logging.exception("error parsing %s message from %s", name, self.peer)
+            self.peer.transport.close()
+            raise EOFError
 
     @asyncio.coroutine
-    def _fetch_loop(self, next_message, getdata_loop_future):
+    def _fetch_loop(self, next_message):
         try:
             while True:
-                name, data = yield from next_message()
+                name, payload = yield from next_message()
                 if name in ["tx", "block"]:
-                    item = data[name]
-                    the_hash = item.hash()
-                    inv_item = InvItem(ITEM_TYPE_TX if name == 'tx' else ITEM_TYPE_BLOCK, the_hash)
-                    future = self.futures.get(inv_item)
-                    if future:
-                        del self.futures[inv_item]
-                        if not future.done():
-                            future.set_result(item)
-                        else:
-                            logging.info("got %s unsolicited", item.id())
+                    inv_item = self._inv_item_for_payload(name, payload)
+                    if not self.futures.get(inv_item):
+                        self._item_done(inv_item, None)
+                        self.items_unsolicited += 1
+                        logging.debug("got %s unsolicited from %s", inv_item, self.peer)
+                        continue
+                    item = self._parse(name, payload)[name]
+                    self._item_done(inv_item, item)
+                    self.items_received += 1
                 if name == "notfound":
-                    for inv_item in data["items"]:
-                        the_hash = inv_item.data
-                        future = self.futures.get(inv_item)
-                        if future:
-                            del self.futures[inv_item]
-                            future.set_result(None)
+                    for inv_item in self._parse(name, payload)["items"]:
+                        if self._item_done(inv_item, None):
+                            self.items_not_found += 1
         except EOFError:
-            getdata_loop_future.cancel()
+            self._close()
@@ -0,0 +1,46 @@
+import collections
+
+from pycoinnet.peer.BitcoinPeerProtocol import make_frame
+
+
+class FrameCache:
+    """
+    Keep recently built message frames, keyed by the hash of the object
+    they carry, so sending the same block or tx to many peers serializes
+    and checksums it just once.
+
+    Least recently used frames are dropped once the cache holds more than
+    max_bytes.
+    """
+    def __init__(self, max_bytes=32*1024*1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = collections.OrderedDict()
+
+    def frame_for(self, magic_header, message_name, the_hash, **kwargs):
+        key = (magic_header, message_name, the_hash)
+        frame = self._frames.get(key)
+        if frame is not None:
+            self._frames.move_to_end(key)
+            self.hits += 1
+            return frame
+        self.misses += 1
+        frame = make_frame(magic_header, message_name, **kwargs)
+        if len(frame) <= self.max_bytes:
+            self._frames[key] = frame
+            self.size += len(frame)
+            while self.size > self.max_bytes:
+                k, v = self._frames.popitem(last=False)
+                self.size -= len(v)
+        return frame
+
+    def send(self, peer, message_name, the_hash, **kwargs):
+        """
+        Send the message to the peer, using the cached frame if there is one.
+        """
+        peer.send_frame(message_name, self.frame_for(peer.magic_header, message_name, the_hash, **kwargs))
+
+    def __len__(self):
+        return len(self._frames)
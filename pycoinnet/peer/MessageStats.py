@@ -0,0 +1,79 @@
+# the counters kept for each message name, in the order they're stored
+FIELDS = (
+    "received", "bytes_received", "sent", "bytes_sent",
+    "parsed", "parse_time", "delivered", "queue_wait", "queue_wait_max"
+)
+
+RECEIVED, BYTES_RECEIVED, SENT, BYTES_SENT, PARSED, PARSE_TIME, DELIVERED, QUEUE_WAIT, QUEUE_WAIT_MAX = \
+    range(len(FIELDS))
+
+
+class MessageStats:
+    """
+    Traffic and latency counters for one peer, by message name.
+
+    Byte counts include the 24 byte message header. parse_time is the
+    total time spent parsing payloads, and queue_wait the total time from
+    a message being received until a subscriber picked it up (so a
+    message delivered to three subscribers counts three times). All times
+    are in seconds.
+    """
+    def __init__(self):
+        self._by_name = {}
+
+    def _counters(self, message_name):
+        counters = self._by_name.get(message_name)
+        if counters is None:
+            counters = self._by_name[message_name] = [0] * len(FIELDS)
+        return counters
+
+    def record_received(self, message_name, size):
+        counters = self._counters(message_name)
+        counters[RECEIVED] += 1
+        counters[BYTES_RECEIVED] += size
+
+    def record_sent(self, message_name, size):
+        counters = self._counters(message_name)
+        counters[SENT] += 1
+        counters[BYTES_SENT] += size
+
+    def record_parse(self, message_name, elapsed):
+        counters = self._counters(message_name)
+        counters[PARSED] += 1
+        counters[PARSE_TIME] += elapsed
+
+    def record_delivery(self, message_name, wait):
+        counters = self._counters(message_name)
+        counters[DELIVERED] += 1
+        counters[QUEUE_WAIT] += wait
+        if wait > counters[QUEUE_WAIT_MAX]:
+            counters[QUEUE_WAIT_MAX] = wait
+
+    def snapshot(self):
+        """
+        Return a dictionary of message_name => dictionary of counters.
+        """
+        return dict((name, dict(zip(FIELDS, counters))) for name, counters in self._by_name.items())
+
+
+def combine_snapshots(snapshots):
+    """
+    Add up several MessageStats snapshots into one.
+    """
+    combined = {}
+    for snapshot in snapshots:
+        for message_name, counters in snapshot.items():
+            total = combined.setdefault(message_name, dict.fromkeys(FIELDS, 0))
+            for k, v in counters.items():
+                if k == "queue_wait_max":
+                    total[k] = max(total[k], v)
+                else:
+                    total[k] += v
+    return combined
+
+
+def aggregate_stats(peers):
+    """
+    Return the per message name counters of all the given peers added together.
+    """
+    return combine_snapshots(peer.stats.snapshot() for peer in peers)
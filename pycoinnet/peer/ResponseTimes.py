@@ -0,0 +1,50 @@
+import collections
+import math
+
+
+class ResponseTimes:
+    """
+    The mean and standard deviation of the last SAMPLE_COUNT response
+    times (or any other measurement) for one kind of request to one peer.
+    """
+    SAMPLE_COUNT = 32
+
+    def __init__(self):
+        self.samples = collections.deque()
+        self.count = 0
+        self._sum = 0.0
+        self._sum_of_squares = 0.0
+
+    def record(self, value):
+        if len(self.samples) >= self.SAMPLE_COUNT:
+            old = self.samples.popleft()
+            self._sum -= old
+            self._sum_of_squares -= old * old
+        self.samples.append(value)
+        self._sum += value
+        self._sum_of_squares += value * value
+        self.count += 1
+
+    def mean(self):
+        if not self.samples:
+            return None
+        return self._sum / len(self.samples)
+
+    def stddev(self):
+        if not self.samples:
+            return None
+        mean = self.mean()
+        # rounding can take this a hair below zero
+        return math.sqrt(max(0.0, self._sum_of_squares / len(self.samples) - mean * mean))
+
+    def estimate(self, k):
+        """
+        The mean plus k standard deviations: with k=3, most responses
+        should come in sooner than this.
+        """
+        if not self.samples:
+            return None
+        return self.mean() + k * self.stddev()
+
+    def snapshot(self):
+        return dict(mean=self.mean(), stddev=self.stddev(), count=self.count)
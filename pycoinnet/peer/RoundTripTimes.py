@@ -0,0 +1,42 @@
+import collections
+
+
+class RoundTripTimes:
+    """
+    Ping round trip times for one peer: an exponentially weighted moving
+    average, and the min and max of the last RECENT_COUNT samples.
+    """
+    ALPHA = 0.25
+    RECENT_COUNT = 8
+    # what we assume for a peer we haven't timed yet
+    DEFAULT_RTT = 1.0
+
+    def __init__(self):
+        self.ewma = None
+        self.count = 0
+        self.recent = collections.deque(maxlen=self.RECENT_COUNT)
+
+    def record(self, rtt):
+        if self.ewma is None:
+            self.ewma = rtt
+        else:
+            self.ewma += self.ALPHA * (rtt - self.ewma)
+        self.count += 1
+        self.recent.append(rtt)
+
+    def min(self):
+        return min(self.recent) if self.recent else None
+
+    def max(self):
+        return max(self.recent) if self.recent else None
+
+    def score(self):
+        """
+        The expected round trip time in seconds. Lower is better.
+        """
+        if self.ewma is None:
+            return self.DEFAULT_RTT
+        return self.ewma
+
+    def snapshot(self):
+        return dict(ewma=self.ewma, min=self.min(), max=self.max(), count=self.count)
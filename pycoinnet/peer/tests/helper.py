@@ -8,7 +8,8 @@ from pycoinnet.PeerAddress import PeerAddress
 
 from pycoin import ecdsa
 from pycoin.block import Block
-from pycoin.encoding import public_pair_to_sec
+from pycoin.encoding import double_sha256, public_pair_to_sec
+from pycoin.merkle import merkle
 from pycoin.tx.Tx import Tx, TxIn, TxOut
 
 MAGIC_HEADER = b"food"
@@ -144,10 +145,13 @@ def make_tx(i):
     tx = Tx(1, txs_in, txs_out)
     return tx
 
+def merkle_root(txs):
+    return merkle([tx.hash() for tx in txs], double_sha256)
+
 def make_block(i):
     s = i*30000
     txs = [make_tx(i) for i in range(s, s+8)]
-    block = Block(version=1, previous_block_hash=b'\0'*32, merkle_root=b'\0'*32, timestamp=1390000000+i, difficulty=s, nonce=s, txs=txs)
+    block = Block(version=1, previous_block_hash=b'\0'*32, merkle_root=merkle_root(txs), timestamp=1390000000+i, difficulty=s, nonce=s, txs=txs)
     return block
 
 def coinbase_tx(secret_exponent):
@@ -164,7 +168,7 @@ def make_blocks(count, nonce_base=30000, previous_block_hash=b'\0' * 32):
         txs = [COINBASE_TX] # + [make_tx(i) for i in range(s, s+8)]
         nonce = s
         while True:
-            block = Block(version=1, previous_block_hash=previous_block_hash, merkle_root=b'\0'*32, timestamp=1390000000+i*600, difficulty=i, nonce=nonce, txs=txs)
+            block = Block(version=1, previous_block_hash=previous_block_hash, merkle_root=merkle_root(txs), timestamp=1390000000+i*600, difficulty=i, nonce=nonce, txs=txs)
             if block.hash()[-1] == i & 0xff:
                 break
             nonce += 1
@@ -1,6 +1,8 @@
 import asyncio
+import concurrent.futures
+import gc
 
-from pycoinnet.peer.BitcoinPeerProtocol import BitcoinPeerProtocol
+from pycoinnet.peer.BitcoinPeerProtocol import BitcoinPeerProtocol, make_frame
 from pycoinnet.peer.tests.helper import PeerTransport, MAGIC_HEADER, VERSION_MSG_BIN, VERSION_MSG, VERSION_MSG, VERSION_MSG_2, VERACK_MSG_BIN
 
 
@@ -185,3 +187,341 @@ def test_eof():
     asyncio.get_event_loop().run_until_complete(asyncio.wait(tasks))
 
     assert COUNT == 50
+
+def test_lazy_filter():
+    from pycoinnet import message
+
+    parsed = []
+    original_parse_from_data = message.parse_from_data
+
+    def counting_parse_from_data(message_name, data):
+        parsed.append(message_name)
+        return original_parse_from_data(message_name, data)
+
+    message.parse_from_data = counting_parse_from_data
+    try:
+        peer = BitcoinPeerProtocol(MAGIC_HEADER)
+        pt = PeerTransport(None)
+        peer.connection_made(pt)
+
+        seen = []
+        def filter_f(name, data):
+            seen.append((name, data))
+            return name == 'verack'
+
+        next_message = peer.new_get_next_message_f(filter_f, lazy=True)
+
+        peer.data_received(VERSION_MSG_BIN)
+        peer.data_received(VERACK_MSG_BIN)
+        name, data = asyncio.get_event_loop().run_until_complete(asyncio.Task(next_message()))
+        assert (name, data) == ('verack', {})
+        assert seen[0] == ('version', VERSION_MSG_BIN[24:])
+        assert seen[1] == ('verack', b'')
+        # the version message had no taker, so it was never parsed
+        assert parsed == ['verack']
+    finally:
+        message.parse_from_data = original_parse_from_data
+
+def test_framing():
+    peer = BitcoinPeerProtocol(MAGIC_HEADER)
+    pt = PeerTransport(None)
+    peer.connection_made(pt)
+
+    payloads = []
+    next_message = peer.new_get_next_message_f(
+        lambda name, data: payloads.append(data) or True, lazy=True)
+
+    @asyncio.coroutine
+    def async_test(count):
+        t = []
+        for i in range(count):
+            name, data = yield from next_message()
+            t.append((name, data))
+        return t
+
+    # one byte at a time
+    for i in range(len(VERSION_MSG_BIN)):
+        peer.data_received(VERSION_MSG_BIN[i:i+1])
+    # several messages in a single chunk, with a partial one at the end
+    blob = VERACK_MSG_BIN * 3
+    peer.data_received(blob + VERACK_MSG_BIN[:10])
+    peer.data_received(VERACK_MSG_BIN[10:])
+
+    t = asyncio.get_event_loop().run_until_complete(async_test(5))
+    assert t[0] == ('version', VERSION_MSG)
+    assert t[1:] == [('verack', {})] * 4
+    assert peer.bytes_read == len(VERSION_MSG_BIN) + 4 * len(VERACK_MSG_BIN)
+    # payloads are handed out as views, not copies
+    assert all(isinstance(p, memoryview) for p in payloads)
+    assert payloads[0] == VERSION_MSG_BIN[24:]
+
+
+def test_bad_magic():
+    peer = BitcoinPeerProtocol(MAGIC_HEADER)
+    pt = PeerTransport(None)
+    closed = []
+    pt.close = lambda: closed.append(True)
+    peer.connection_made(pt)
+
+    next_message = peer.new_get_next_message_f()
+
+    @asyncio.coroutine
+    def async_test():
+        t = []
+        try:
+            while True:
+                name, data = yield from next_message()
+                t.append(name)
+        except EOFError:
+            pass
+        return t
+
+    peer.data_received(VERACK_MSG_BIN)
+    peer.data_received(b"bad!" + VERACK_MSG_BIN[4:])
+    peer.data_received(VERACK_MSG_BIN)
+    t = asyncio.get_event_loop().run_until_complete(async_test())
+    assert t == ['verack']
+    # the connection is dropped too
+    assert closed == [True]
+
+
+def test_checksum_offload():
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    peer = BitcoinPeerProtocol(MAGIC_HEADER)
+    peer.CHECKSUM_EXECUTOR = executor
+    peer.CHECKSUM_OFFLOAD_THRESHOLD = 1000
+    pt = PeerTransport(None)
+    closed = []
+    pt.close = lambda: closed.append(True)
+    peer.connection_made(pt)
+
+    next_message = peer.new_get_next_message_f()
+
+    @asyncio.coroutine
+    def async_test():
+        t = []
+        try:
+            while True:
+                name, data = yield from next_message()
+                t.append((name, data))
+        except EOFError:
+            pass
+        return t
+
+    def big_frame(i):
+        hashes = [bytes([i]) * 32] * (100 * (i + 1))
+        return make_frame(MAGIC_HEADER, "getheaders", version=i, hashes=hashes, hash_stop=b'\0' * 32)
+
+    # large payloads verified in the pool must not overtake small ones
+    for i in range(5):
+        peer.data_received(make_frame(MAGIC_HEADER, "ping", nonce=i))
+        peer.data_received(big_frame(i))
+    bad_frame = bytearray(big_frame(9))
+    bad_frame[-1] ^= 1
+    peer.data_received(make_frame(MAGIC_HEADER, "ping", nonce=5) + bytes(bad_frame))
+    peer.data_received(make_frame(MAGIC_HEADER, "ping", nonce=6))
+
+    t = asyncio.get_event_loop().run_until_complete(async_test())
+    executor.shutdown()
+    assert [name for name, data in t] == ["ping", "getheaders"] * 5 + ["ping"]
+    for i in range(5):
+        assert t[2*i][1]["nonce"] == i
+        assert t[2*i+1][1]["version"] == i
+        assert len(t[2*i+1][1]["hashes"]) == 100 * (i + 1)
+    assert t[-1][1]["nonce"] == 5
+    # the bad checksum drops the connection
+    assert closed == [True]
+
+
+def test_send_queue():
+    DATA = []
+    def write_f(data):
+        DATA.append(data)
+
+    peer = BitcoinPeerProtocol(MAGIC_HEADER)
+    peer.SEND_QUEUE_HIGH_WATER = 100
+    peer.SEND_QUEUE_LOW_WATER = 50
+    peer.SEND_QUEUE_MAX_SIZE = 1000
+    pt = PeerTransport(write_f)
+    peer.connection_made(pt)
+
+    peer.pause_writing()
+    peer.send_msg("version", **VERSION_MSG)
+    peer.send_msg("verack")
+    assert DATA == []
+    assert peer.send_queue_size() == len(VERSION_MSG_BIN) + len(VERACK_MSG_BIN)
+
+    # we're over the high water mark, so low priority messages get dropped
+    peer.send_msg("getaddr")
+    assert peer.messages_dropped == 1
+    peer.send_msg("verack")
+
+    drain_task = asyncio.Task(peer.drain())
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.01))
+    assert not drain_task.done()
+
+    peer.resume_writing()
+    asyncio.get_event_loop().run_until_complete(asyncio.wait_for(drain_task, timeout=1))
+    assert DATA == [VERSION_MSG_BIN, VERACK_MSG_BIN, VERACK_MSG_BIN]
+    assert peer.send_queue_size() == 0
+    assert peer.bytes_writ == len(VERSION_MSG_BIN) + 2 * len(VERACK_MSG_BIN)
+
+    peer.send_msg("verack")
+    assert len(DATA) == 4
+
+
+def test_send_queue_disconnect():
+    class AbortableTransport(PeerTransport):
+        aborted = False
+        def abort(self):
+            self.aborted = True
+
+    peer = BitcoinPeerProtocol(MAGIC_HEADER)
+    peer.SEND_QUEUE_HIGH_WATER = 100
+    peer.SEND_QUEUE_MAX_SIZE = 300
+    pt = AbortableTransport(None)
+    peer.connection_made(pt)
+
+    peer.pause_writing()
+    peer.send_msg("version", **VERSION_MSG)
+    peer.send_msg("version", **VERSION_MSG)
+    assert not pt.aborted
+    # this one would take the queue over SEND_QUEUE_MAX_SIZE
+    peer.send_msg("version", **VERSION_MSG)
+    assert pt.aborted
+    assert peer.send_queue_size() == 0
+
+    peer = BitcoinPeerProtocol(MAGIC_HEADER)
+    peer.SEND_QUEUE_HIGH_WATER = 100
+    peer.SEND_OVERFLOW_POLICY = "disconnect"
+    pt = AbortableTransport(None)
+    peer.connection_made(pt)
+    peer.pause_writing()
+    peer.send_msg("verack")
+    peer.send_msg("version", **VERSION_MSG)
+    assert not pt.aborted
+    peer.send_msg("verack")
+    assert pt.aborted
+
+def test_read_flow_control():
+    class PausableTransport(PeerTransport):
+        paused = False
+        def pause_reading(self):
+            self.paused = True
+        def resume_reading(self):
+            self.paused = False
+
+    peer = BitcoinPeerProtocol(MAGIC_HEADER)
+    pt = PausableTransport(None)
+    peer.connection_made(pt)
+
+    next_message = peer.new_get_next_message_f(maxsize=10)
+
+    for i in range(15):
+        peer.data_received(VERACK_MSG_BIN)
+    # let the messages get delivered
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.01))
+    assert pt.paused
+
+    @asyncio.coroutine
+    def read(count):
+        for i in range(count):
+            yield from next_message()
+
+    # still more than half the high water mark waiting
+    asyncio.get_event_loop().run_until_complete(read(9))
+    assert pt.paused
+    asyncio.get_event_loop().run_until_complete(read(1))
+    assert not pt.paused
+
+
+def test_read_flow_control_abandoned_subscriber():
+    class PausableTransport(PeerTransport):
+        paused = False
+        def pause_reading(self):
+            self.paused = True
+        def resume_reading(self):
+            self.paused = False
+
+    peer = BitcoinPeerProtocol(MAGIC_HEADER)
+    pt = PausableTransport(None)
+    peer.connection_made(pt)
+
+    next_message = peer.new_get_next_message_f(maxsize=10)
+    next_verack = peer.new_get_next_message_f(names=["verack"])
+
+    for i in range(15):
+        peer.data_received(VERACK_MSG_BIN)
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.01))
+    assert pt.paused
+
+    @asyncio.coroutine
+    def read(count):
+        for i in range(count):
+            yield from next_verack()
+
+    asyncio.get_event_loop().run_until_complete(read(15))
+    # the first subscriber still has a backlog
+    assert pt.paused
+
+    # it goes away without reading
+    del next_message
+    gc.collect()
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.01))
+    assert not pt.paused
+
+    peer.data_received(VERACK_MSG_BIN)
+    asyncio.get_event_loop().run_until_complete(asyncio.wait_for(read(1), timeout=1))
+
+def test_subscribe_by_name():
+    peer = BitcoinPeerProtocol(MAGIC_HEADER)
+    pt = PeerTransport(None)
+    peer.connection_made(pt)
+
+    calls = []
+    def filter_f(name, data):
+        calls.append(name)
+        return True
+
+    next_verack = peer.new_get_next_message_f(names=["verack"])
+    next_version = peer.new_get_next_message_f(names=["version", "getaddr"])
+    next_filtered = peer.new_get_next_message_f(filter_f, names=["verack"], lazy=True)
+
+    peer.data_received(VERSION_MSG_BIN)
+    peer.data_received(VERACK_MSG_BIN)
+    peer.connection_lost(None)
+
+    @asyncio.coroutine
+    def read_all(next_message):
+        t = []
+        try:
+            while True:
+                t.append((yield from next_message()))
+        except EOFError:
+            pass
+        return t
+
+    loop = asyncio.get_event_loop()
+    assert loop.run_until_complete(read_all(next_verack)) == [('verack', {})]
+    assert loop.run_until_complete(read_all(next_version)) == [('version', VERSION_MSG)]
+    assert loop.run_until_complete(read_all(next_filtered)) == [('verack', {})]
+    # the filter only saw the name it subscribed to
+    assert calls == ['verack']
+
+
+def test_oversized_message():
+    peer = BitcoinPeerProtocol(MAGIC_HEADER)
+    pt = PeerTransport(None)
+    closed = []
+    pt.close = lambda: closed.append(True)
+    peer.connection_made(pt)
+
+    next_message = peer.new_get_next_message_f()
+    header = MAGIC_HEADER + b"tx".ljust(12, b"\0") + (peer.MAX_MESSAGE_SIZE + 1).to_bytes(4, byteorder="little")
+    peer.data_received(header + b"\0" * 4)
+    try:
+        asyncio.get_event_loop().run_until_complete(next_message())
+        assert False, "should have raised"
+    except EOFError:
+        pass
+    assert closed == [True]
@@ -146,3 +146,184 @@ def test_fetcher_timeout():
     r = f2.result()
     assert len(r) == 1
     assert r[0] == None
+
+
+def test_fetcher_window():
+    peer1, peer2 = create_peers()
+
+    TX_LIST = [make_tx(i) for i in range(5)]
+    getdatas = []
+
+    @asyncio.coroutine
+    def run_peer1():
+        yield from standards.initial_handshake(peer1, VERSION_MSG)
+        next_message = peer1.new_get_next_message_f(names=["getdata"])
+        tx_db = dict((tx.hash(), tx) for tx in TX_LIST)
+        while True:
+            name, data = yield from next_message()
+            getdatas.append(data["items"])
+            yield from asyncio.sleep(0.05)
+            for inv_item in data["items"]:
+                peer1.send_msg("tx", tx=tx_db[inv_item.data])
+
+    @asyncio.coroutine
+    def run_peer2():
+        yield from standards.initial_handshake(peer2, VERSION_MSG_2)
+        tx_fetcher = Fetcher(peer2, max_in_flight=2)
+        futures = [asyncio.Task(tx_fetcher.fetch(mi(tx.hash()))) for tx in TX_LIST]
+        yield from asyncio.sleep(0)
+        assert tx_fetcher.queue_size() == 5
+        yield from asyncio.sleep(0.01)
+        assert tx_fetcher.queue_size() == 3
+        assert tx_fetcher.in_flight_count() == 2
+        yield from asyncio.wait(futures)
+        assert tx_fetcher.in_flight_count() == 0
+        assert tx_fetcher.in_flight_bytes == 0
+        assert tx_fetcher.items_received == 5
+        return [f.result() for f in futures]
+
+    f1 = asyncio.Task(run_peer1())
+    f2 = asyncio.Task(run_peer2())
+    asyncio.get_event_loop().run_until_complete(asyncio.wait([f2], timeout=5))
+
+    r = f2.result()
+    assert [tx.hash() for tx in r] == [tx.hash() for tx in TX_LIST]
+    # never more than two requested at once
+    assert max(len(items) for items in getdatas) == 2
+    assert sum(len(items) for items in getdatas) == 5
+
+
+def test_fetcher_request_timeout():
+    peer1, peer2 = create_peers()
+
+    TX_LIST = [make_tx(i) for i in range(3)]
+
+    @asyncio.coroutine
+    def run_peer1():
+        # answer only the first item; the peer silently drops the rest
+        yield from standards.initial_handshake(peer1, VERSION_MSG)
+        next_message = peer1.new_get_next_message_f(names=["getdata"])
+        name, data = yield from next_message()
+        peer1.send_msg("tx", tx=TX_LIST[0])
+
+    @asyncio.coroutine
+    def run_peer2():
+        yield from standards.initial_handshake(peer2, VERSION_MSG_2)
+        tx_fetcher = Fetcher(peer2, request_timeout=0.2)
+        futures = [asyncio.Task(tx_fetcher.fetch(mi(tx.hash()))) for tx in TX_LIST]
+        yield from asyncio.wait(futures)
+        assert tx_fetcher.items_timed_out == 2
+        assert tx_fetcher.in_flight_count() == 0
+        assert tx_fetcher.futures == {}
+        return [f.result() for f in futures]
+
+    f1 = asyncio.Task(run_peer1())
+    f2 = asyncio.Task(run_peer2())
+    asyncio.get_event_loop().run_until_complete(asyncio.wait([f2], timeout=5))
+
+    r = f2.result()
+    assert r[0].hash() == TX_LIST[0].hash()
+    assert r[1:] == [None, None]
+
+
+def test_fetcher_request_timeout_scales():
+    peer1, peer2 = create_peers()
+
+    @asyncio.coroutine
+    def run_peer2():
+        yield from standards.initial_handshake(peer2, VERSION_MSG_2)
+        tx_fetcher = Fetcher(peer2, request_timeout=10, min_bytes_per_second=1024*1024)
+        start = asyncio.get_event_loop().time()
+        tx_fetcher.request(mi(make_hash(1)))
+        tx_fetcher.request(InvItem(ITEM_TYPE_BLOCK, make_hash(2)))
+        tx_fetcher.request(mi(make_hash(3)))
+        yield from asyncio.sleep(0.05)
+        return start, list(tx_fetcher._in_flight.values())
+
+    f1 = asyncio.Task(standards.initial_handshake(peer1, VERSION_MSG))
+    start, deadlines = asyncio.get_event_loop().run_until_complete(run_peer2())
+    # a tx alone gets about request_timeout; the block behind it gets an
+    # extra second for its megabyte, and so does the tx behind that
+    assert 10 < deadlines[0] - start < 10.1
+    assert 11 < deadlines[1] - start < 11.1
+    assert deadlines[1] < deadlines[2] < deadlines[1] + 0.01
+    peer2.connection_lost(None)
+
+
+def test_fetcher_unsolicited():
+    peer1, peer2 = create_peers()
+
+    TX_LIST = [make_tx(i) for i in range(3)]
+    @asyncio.coroutine
+    def run_peer1():
+        yield from standards.initial_handshake(peer1, VERSION_MSG)
+        next_message = peer1.new_get_next_message_f(names=["getdata"])
+        name, data = yield from next_message()
+        # two txs nobody asked for, then the one requested
+        peer1.send_msg("tx", tx=TX_LIST[1])
+        peer1.send_msg("tx", tx=TX_LIST[2])
+        peer1.send_msg("tx", tx=TX_LIST[0])
+
+    @asyncio.coroutine
+    def run_peer2():
+        yield from standards.initial_handshake(peer2, VERSION_MSG_2)
+        tx_fetcher = Fetcher(peer2)
+        tx = yield from tx_fetcher.fetch(mi(TX_LIST[0].hash()))
+        return tx, tx_fetcher
+
+    f1 = asyncio.Task(run_peer1())
+    f2 = asyncio.Task(run_peer2())
+    asyncio.get_event_loop().run_until_complete(asyncio.wait([f2], timeout=5))
+
+    tx, tx_fetcher = f2.result()
+    assert tx.hash() == TX_LIST[0].hash()
+    assert tx_fetcher.items_unsolicited == 2
+    assert tx_fetcher.items_received == 1
+    # only the requested tx was parsed, and the parse was counted
+    tx_stats = peer2.stats_snapshot()["messages"]["tx"]
+    assert tx_stats["delivered"] == 3
+    assert tx_stats["parsed"] == 1
+    assert tx_stats["parse_time"] > 0
+
+
+def test_fetcher_shared_request_cancel():
+    peer1, peer2 = create_peers()
+
+    TX_LIST = [make_tx(i) for i in range(2)]
+    getdatas = []
+
+    @asyncio.coroutine
+    def run_peer1():
+        yield from standards.initial_handshake(peer1, VERSION_MSG)
+        next_message = peer1.new_get_next_message_f(names=["getdata"])
+        while True:
+            name, data = yield from next_message()
+            getdatas.append(list(data["items"]))
+            yield from asyncio.sleep(0.1)
+            for tx in TX_LIST:
+                peer1.send_msg("tx", tx=tx)
+
+    @asyncio.coroutine
+    def run_peer2():
+        yield from standards.initial_handshake(peer2, VERSION_MSG_2)
+        tx_fetcher = Fetcher(peer2)
+        # two callers want TX_LIST[0]; one gives up
+        f1 = tx_fetcher.request(mi(TX_LIST[0].hash()))
+        f2 = tx_fetcher.request(mi(TX_LIST[0].hash()))
+        assert f1 is not f2
+        # nobody wants TX_LIST[1] any more by the time it's sent for
+        f3 = tx_fetcher.request(mi(TX_LIST[1].hash()))
+        f1.cancel()
+        f3.cancel()
+        tx = yield from f2
+        return tx, tx_fetcher
+
+    f1 = asyncio.Task(run_peer1())
+    f2 = asyncio.Task(run_peer2())
+    asyncio.get_event_loop().run_until_complete(asyncio.wait([f2], timeout=5))
+
+    tx, tx_fetcher = f2.result()
+    assert tx.hash() == TX_LIST[0].hash()
+    assert getdatas == [[mi(TX_LIST[0].hash())]]
+    assert tx_fetcher.futures == {}
+    f1.cancel()
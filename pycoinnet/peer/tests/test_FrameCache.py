@@ -0,0 +1,44 @@
+from pycoinnet.peer.BitcoinPeerProtocol import BitcoinPeerProtocol, make_frame
+from pycoinnet.peer.FrameCache import FrameCache
+
+from pycoinnet.peer.tests.helper import PeerTransport, MAGIC_HEADER, VERACK_MSG_BIN, make_block
+
+
+def make_peers(count):
+    peers = []
+    for i in range(count):
+        peer = BitcoinPeerProtocol(MAGIC_HEADER)
+        peer.connection_made(PeerTransport(lambda data: None))
+        peers.append(peer)
+    return peers
+
+
+def test_make_frame():
+    assert make_frame(MAGIC_HEADER, "verack") == VERACK_MSG_BIN
+
+
+def test_FrameCache():
+    peers = make_peers(3)
+    blocks = [make_block(i) for i in range(3)]
+    frames = [make_frame(MAGIC_HEADER, "block", block=b) for b in blocks]
+    cache = FrameCache(max_bytes=len(frames[0]) + len(frames[1]))
+
+    for peer in peers:
+        cache.send(peer, "block", blocks[0].hash(), block=blocks[0])
+    assert cache.misses == 1
+    assert cache.hits == 2
+    for peer in peers:
+        assert peer.transport.writ_data == frames[0]
+
+    assert cache.frame_for(MAGIC_HEADER, "block", blocks[1].hash(), block=blocks[1]) == frames[1]
+    assert len(cache) == 2
+    # touch block 0 so block 1 is the least recently used
+    cache.frame_for(MAGIC_HEADER, "block", blocks[0].hash(), block=blocks[0])
+    cache.frame_for(MAGIC_HEADER, "block", blocks[2].hash(), block=blocks[2])
+    assert len(cache) == 2
+    assert cache.size <= cache.max_bytes
+    misses = cache.misses
+    cache.frame_for(MAGIC_HEADER, "block", blocks[0].hash(), block=blocks[0])
+    assert cache.misses == misses
+    cache.frame_for(MAGIC_HEADER, "block", blocks[1].hash(), block=blocks[1])
+    assert cache.misses == misses + 1
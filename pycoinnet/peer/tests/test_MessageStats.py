@@ -0,0 +1,56 @@
+import asyncio
+
+from pycoinnet.peer.MessageStats import MessageStats, aggregate_stats, combine_snapshots
+
+from pycoinnet.peer.tests.helper import create_handshaked_peers, VERSION_MSG_BIN, VERACK_MSG_BIN
+
+
+def test_MessageStats():
+    s1 = MessageStats()
+    s1.record_received("inv", 100)
+    s1.record_received("inv", 50)
+    s1.record_parse("inv", 0.5)
+    s1.record_delivery("inv", 0.25)
+    s1.record_delivery("inv", 1.0)
+    s1.record_sent("getdata", 60)
+    snapshot = s1.snapshot()
+    assert snapshot["inv"]["received"] == 2
+    assert snapshot["inv"]["bytes_received"] == 150
+    assert snapshot["inv"]["parse_time"] == 0.5
+    assert snapshot["inv"]["delivered"] == 2
+    assert snapshot["inv"]["queue_wait"] == 1.25
+    assert snapshot["inv"]["queue_wait_max"] == 1.0
+    assert snapshot["getdata"]["sent"] == 1
+    assert snapshot["getdata"]["bytes_sent"] == 60
+
+    s2 = MessageStats()
+    s2.record_received("inv", 10)
+    s2.record_delivery("inv", 2.0)
+    combined = combine_snapshots([s1.snapshot(), s2.snapshot()])
+    assert combined["inv"]["received"] == 3
+    assert combined["inv"]["bytes_received"] == 160
+    assert combined["inv"]["queue_wait"] == 3.25
+    assert combined["inv"]["queue_wait_max"] == 2.0
+    assert combined["getdata"]["bytes_sent"] == 60
+
+
+def test_peer_stats():
+    peer1, peer2 = create_handshaked_peers()
+
+    # let the watchers pick up what was sent during the handshake
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.01))
+
+    snapshot = peer1.stats_snapshot()
+    assert snapshot["bytes_writ"] == len(VERSION_MSG_BIN) + len(VERACK_MSG_BIN)
+    messages = snapshot["messages"]
+    assert messages["version"]["sent"] == 1
+    assert messages["version"]["bytes_sent"] == len(VERSION_MSG_BIN)
+    assert messages["version"]["received"] == 1
+    assert messages["verack"]["bytes_received"] == len(VERACK_MSG_BIN)
+    # the handshake and the message watcher both got the version message
+    assert messages["version"]["delivered"] == 2
+    assert messages["version"]["parsed"] == 1
+
+    total = aggregate_stats([peer1, peer2])
+    assert total["version"]["sent"] == 2
+    assert total["verack"]["received"] == 2
@@ -0,0 +1,18 @@
+from pycoinnet.peer.ResponseTimes import ResponseTimes
+
+
+def test_ResponseTimes():
+    rt = ResponseTimes()
+    assert rt.mean() is None
+    assert rt.estimate(3) is None
+    for v in [0.1, 0.3, 0.1, 0.3]:
+        rt.record(v)
+    assert abs(rt.mean() - 0.2) < 1e-9
+    assert abs(rt.stddev() - 0.1) < 1e-9
+    assert abs(rt.estimate(3) - 0.5) < 1e-9
+    # old samples fall out
+    for i in range(ResponseTimes.SAMPLE_COUNT):
+        rt.record(0.05)
+    assert abs(rt.mean() - 0.05) < 1e-9
+    assert rt.stddev() < 1e-6
+    assert rt.snapshot()["count"] == ResponseTimes.SAMPLE_COUNT + 4
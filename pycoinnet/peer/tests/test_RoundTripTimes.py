@@ -0,0 +1,19 @@
+from pycoinnet.peer.RoundTripTimes import RoundTripTimes
+
+
+def test_RoundTripTimes():
+    rtt = RoundTripTimes()
+    assert rtt.score() == RoundTripTimes.DEFAULT_RTT
+    assert rtt.min() is None
+    rtt.record(0.2)
+    assert rtt.score() == 0.2
+    rtt.record(0.6)
+    assert abs(rtt.score() - 0.3) < 1e-9
+    assert rtt.min() == 0.2
+    assert rtt.max() == 0.6
+    for i in range(RoundTripTimes.RECENT_COUNT):
+        rtt.record(0.1)
+    # old samples fall out of the min and max, but not the average
+    assert rtt.max() == 0.1
+    assert 0.1 < rtt.score() < 0.2
+    assert rtt.snapshot()["count"] == RoundTripTimes.RECENT_COUNT + 2
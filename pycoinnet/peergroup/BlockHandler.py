@@ -30,7 +30,22 @@ from pycoinnet.util.debug_help import asyncio
 import io
 import logging
 
+from pycoin.block import BadMerkleRootError
+
 from pycoinnet.InvItem import InvItem, ITEM_TYPE_BLOCK
+from pycoinnet.peer.FrameCache import FrameCache
+
+
+def _check_block_txs(block):
+    """
+    Check the transactions of block match its merkle root, parsing them
+    first if it's a LazyBlock that hasn't been parsed. Raises ValueError or
+    BadMerkleRootError.
+    """
+    if hasattr(block, "check_txs"):
+        block.check_txs()
+    else:
+        block.check_merkle_hash()
 
 
 # TODO: move to pycoin
@@ -49,6 +64,8 @@ class BlockHandler:
         self.inv_collector = inv_collector
         self.block_chain = block_chain
         self.block_store = block_store
+        # recently requested blocks tend to be requested by many peers
+        self.frame_cache = FrameCache()
         self.q = inv_collector.new_inv_item_queue()
         self._watch_invcollector_task = asyncio.Task(self._watch_invcollector(block_validator))
         #asyncio.Task(self._watch_block_chain(block_chain.new_change_q(), should_download_f))
@@ -114,25 +131,28 @@ class BlockHandler:
                             continue
                         block = self.block_store.get(inv_item.data)
                         if block:
-                            blocks_found.append(block)
+                            blocks_found.append((inv_item.data, block))
                         else:
                             not_found.append(inv_item)
                     if not_found:
                         logging.debug("could not find %d blocks", len(not_found))
                         peer.send_msg("notfound", items=not_found)
                     logging.debug("sending %d blocks", len(blocks_found))
-                    for block in blocks_found:
+                    for the_hash, block in blocks_found:
                         logging.debug("sending block %s", block.id())
-                        peer.send_msg("block", block=block)
+                        self.frame_cache.send(peer, "block", the_hash, block=block)
+                        # don't pile blocks up in memory for a slow peer
+                        yield from peer.drain()
 
-        next_message = peer.new_get_next_message_f(
-            lambda name, data: name in ['getheaders', 'getblocks', 'getdata'])
+        next_message = peer.new_get_next_message_f(names=['getheaders', 'getblocks', 'getdata'])
         peer.add_task(_run_handle_get(next_message))
 
     def add_block(self, block):
         """
         Add a block and advertise it to peers so it can propogate throughout the network.
+        Raises BadMerkleRootError or ValueError if its transactions don't check out.
         """
+        _check_block_txs(block)
         the_hash = block.hash()
         if the_hash not in self.block_store:
             self.block_store[the_hash] = block
@@ -140,8 +160,18 @@ class BlockHandler:
 
     @asyncio.coroutine
     def _watch_invcollector(self, block_validator):
+        def validate(block):
+            # nothing else checks a LazyBlock's transactions, so do it
+            # before the block is stored or advertised
+            try:
+                _check_block_txs(block)
+            except (ValueError, BadMerkleRootError) as ex:
+                logging.error("rejecting block: %s", ex)
+                return False
+            return block_validator(block)
+
         while True:
             inv_item = yield from self.q.get()
             if inv_item.item_type != ITEM_TYPE_BLOCK:
                 continue
-            self.inv_collector.fetch_validate_store_item_async(inv_item, self.block_store, block_validator)
+            self.inv_collector.fetch_validate_store_item_async(inv_item, self.block_store, validate)
@@ -1,105 +1,460 @@
 
 # this provides the following API:
 
-# add_peer(peer, last_known_block)
-# get_block(block_hash, expected_index)
+# add_peer(peer, fetcher, last_block_index)
+# get_block_future(block_hash, block_index)
+# get_block(block_hash, block_index)
+# release(block_hash)
+# iter_blocks(block_chain, start_index, end_index)
 
-# get_blocks(hash_list, expected_index)
-
-# it goes to the list of known peers who have the blocks in question
-
-#manages block peers
-# fetch block
+# Blocks are downloaded from every peer at once. Only blocks within
+# WINDOW_SIZE of the lowest one still missing are requested, so blocks
+# arriving out of order can't pile up without bound. Each peer takes the
+# lowest unassigned blocks it has (by the last_block_index it reported),
+# in batches sized to take about TARGET_BATCH_SECONDS at the rate in bytes
+# per second it has been delivering. If the lowest missing block,
+# which holds the window back, is outstanding for more than
+# STALL_TIMEOUT seconds, it's handed to another peer. Peers much slower
+# than the rest (see slow_peers) are kept SLOW_PEER_LEAD blocks clear of
+# the lowest missing block, so they can't hold the window back.
 
 import asyncio
+import heapq
 import logging
 import time
-import weakref
 
 from pycoinnet.InvItem import InvItem, ITEM_TYPE_BLOCK
-from pycoinnet.peer.Fetcher import Fetcher
+
+
+class BlockRequest:
+    """
+    A block someone has asked for, and who we've asked for it.
+    """
+    __slots__ = ("block_hash", "block_index", "future", "peer", "assigned_at", "excluded_peers", "ref_count")
+
+    def __init__(self, block_hash, block_index):
+        self.block_hash = block_hash
+        self.block_index = block_index
+        self.future = asyncio.Future()
+        # how many get_block_future calls haven't been released
+        self.ref_count = 0
+        self.peer = None
+        self.assigned_at = None
+        # peers that didn't come through with this block
+        self.excluded_peers = set()
+
+
+class PeerState:
+    """
+    What the Blockfetcher knows about one peer.
+    """
+    def __init__(self, peer, fetcher, last_block_index):
+        self.peer = peer
+        self.fetcher = fetcher
+        self.last_block_index = last_block_index
+        # bytes per second, as a moving average
+        self.rate = None
+        self.bytes_fetched = 0
+        self.blocks_fetched = 0
+        self.stalls = 0
+
+    def snapshot(self):
+        return dict(
+            bytes_per_second=self.rate, bytes_fetched=self.bytes_fetched,
+            blocks_fetched=self.blocks_fetched, stalls=self.stalls,
+            last_block_index=self.last_block_index)
+
+
+class BlockStream:
+    """
+    Blocks of a BlockChain, from start_index up to (not including)
+    end_index, in order. Call next_block() to get the next
+    (block_index, block), or None past end_index.
+
+    Up to max_blocks blocks (and, once they arrive, max_bytes of them)
+    are fetched ahead. A block is let go as soon as it's returned.
+    Prefetches for blocks a reorg takes off the best chain are released.
+    If the reorg goes below the next index, the stream backs up to the
+    fork, so the caller sees the new blocks at those indices.
+
+    Until close() is called, the stream keeps its prefetched blocks
+    wanted and the block chain keeps queueing changes for it, so always
+    close it, or use it as a context manager:
+
+        with blockfetcher.iter_blocks(block_chain, start_index) as stream:
+            ...
+    """
+    def __init__(self, blockfetcher, block_chain, start_index, end_index=None,
+                 max_blocks=64, max_bytes=64*1024*1024):
+        self.blockfetcher = blockfetcher
+        self.block_chain = block_chain
+        self.next_index = start_index
+        self.end_index = end_index
+        self.max_blocks = max_blocks
+        self.max_bytes = max_bytes
+        # block_index => (block_hash, future)
+        self._prefetched = {}
+        self._change_q = block_chain.new_change_q()
+        self._change_task = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Release the prefetched blocks, and stop following the block chain.
+        """
+        for block_hash, future in self._prefetched.values():
+            self._release(block_hash, future)
+        self._prefetched.clear()
+        if self._change_task:
+            self._change_task.cancel()
+        self.block_chain.change_queues.discard(self._change_q)
+
+    def _is_done(self):
+        return self.end_index is not None and self.next_index >= self.end_index
+
+    def _handle_change(self, op, block_hash, block_index):
+        if op == "remove":
+            self.next_index = min(self.next_index, block_index)
+        entry = self._prefetched.get(block_index)
+        if op == "remove" or (entry and entry[0] != block_hash):
+            self._drop_from(block_index)
+
+    def _drop_from(self, block_index):
+        for idx in [idx for idx in self._prefetched if idx >= block_index]:
+            block_hash, future = self._prefetched.pop(idx)
+            self._release(block_hash, future)
+
+    def _release(self, block_hash, future):
+        # other callers may be waiting for the same block, so don't cancel it
+        if not future.done():
+            self.blockfetcher.release(block_hash)
+
+    def _handle_changes(self):
+        if self._change_task and self._change_task.done():
+            self._handle_change(*self._change_task.result())
+            self._change_task = None
+        while self._change_q.qsize() > 0:
+            self._handle_change(*self._change_q.get_nowait())
+
+    def _buffered_bytes(self):
+        return sum(len(f.result().as_bin()) for h, f in self._prefetched.values() if f.done() and not f.cancelled())
+
+    def _prefetch(self):
+        limit = self.block_chain.length()
+        if self.end_index is not None:
+            limit = min(limit, self.end_index)
+        limit = min(limit, self.next_index + self.max_blocks)
+        buffered_bytes = self._buffered_bytes()
+        for idx in range(self.next_index, limit):
+            if idx in self._prefetched:
+                continue
+            # the next block is always fetched, or we'd never get past it
+            if idx > self.next_index and buffered_bytes >= self.max_bytes:
+                break
+            block_hash = self.block_chain.hash_for_index(idx)
+            self._prefetched[idx] = (block_hash, self.blockfetcher.get_block_future(block_hash, idx))
+
+    @asyncio.coroutine
+    def next_block(self):
+        while True:
+            self._handle_changes()
+            if self._is_done():
+                return None
+            entry = self._prefetched.get(self.next_index)
+            if entry and entry[1].cancelled():
+                # someone else gave up on it; ask for it again
+                del self._prefetched[self.next_index]
+            self._prefetch()
+            entry = self._prefetched.get(self.next_index)
+            if entry and entry[1].done() and not entry[1].cancelled():
+                del self._prefetched[self.next_index]
+                block_index = self.next_index
+                self.next_index += 1
+                # keep fetching ahead while the caller works on this one
+                self._prefetch()
+                return block_index, entry[1].result()
+            # wait for the block, or for the chain to change
+            if self._change_task is None:
+                self._change_task = asyncio.Task(self._change_q.get())
+            futures = [self._change_task]
+            if entry:
+                futures.append(entry[1])
+            yield from asyncio.wait(futures, return_when=asyncio.FIRST_COMPLETED)
 
 
 class Blockfetcher:
+    WINDOW_SIZE = 1024
+    MAX_BATCH_SIZE = 128
+    # size batches so they take about this long
+    TARGET_BATCH_SECONDS = 5
+    # the batch size in bytes for a peer we haven't measured yet
+    INITIAL_BATCH_BYTES = 1024*1024
+    # the block size we assume until we've seen some
+    INITIAL_BLOCK_SIZE = 256*1024
+    RATE_ALPHA = 0.5
+    BLOCK_SIZE_ALPHA = 0.1
+    # slow_peers() lists peers slower than this fraction of the median rate
+    SLOW_PEER_FRACTION = 0.1
+    # how far above the lowest missing block slow peers are kept
+    SLOW_PEER_LEAD = 16
+    STALL_TIMEOUT = 15
+    STALL_CHECK_INTERVAL = 1
+    # how long a peer waits after a batch it didn't deliver any of
+    RETRY_DELAY = 1
+
     def __init__(self):
-        self.block_hash_priority_queue = asyncio.PriorityQueue()
+        # block_hash => BlockRequest, for every block not yet fetched
+        self._requests = {}
+        # (block_index, block_hash) of blocks no peer is working on
+        self._unassigned = []
+        # (block_index, block_hash) of every unfinished block; entries
+        # for finished ones are dropped lazily
+        self._missing = []
+        self._peers = {}
+        # peer => future, for peers waiting for something to do
+        self._idle_peers = {}
+        self._stall_task = None
+        # moving average of the size of recently fetched blocks
+        self.average_block_size = self.INITIAL_BLOCK_SIZE
 
     def add_peer(self, peer, fetcher, last_block_index):
         peer.add_task(self.fetch_from_peer(peer, fetcher, last_block_index))
 
     def get_block_future(self, block_hash, block_index):
-        future = asyncio.Future()
-        item = (block_index, InvItem(ITEM_TYPE_BLOCK, block_hash), future)
-        self.block_hash_priority_queue.put_nowait(item)
-        return future
+        request = self._requests.get(block_hash)
+        if request is None:
+            request = BlockRequest(block_hash, block_index)
+            self._requests[block_hash] = request
+            request.future.add_done_callback(lambda f: self._request_done(request))
+            heapq.heappush(self._missing, (block_index, block_hash))
+            self._unassign(request)
+        request.ref_count += 1
+        return request.future
+
+    def release(self, block_hash):
+        """
+        Say you no longer want a block you called get_block_future for. Once
+        nobody wants it, it's no longer fetched, and its future is cancelled.
+        """
+        request = self._requests.get(block_hash)
+        if request is None:
+            return
+        request.ref_count -= 1
+        if request.ref_count <= 0:
+            request.future.cancel()
 
     def get_block(self, block_hash, block_index):
         future = self.get_block_future(block_hash, block_index)
         block = asyncio.wait_for(future, timeout=None)
         return block
 
-    # for each peer, a loop:
-    #   pull an item out of priority queue
-    #   if we should have it, add it to temp list
-    #   repeat until N blocks or queue empty
-    #   attempt to fetch N blocks
-    #     reset after no progress after X seconds
-    #   on failure, replace back in queue (noting this peer doesn't have it)
-    #   on success
-    #     if less than X/3 seconds used, double N
+    def iter_blocks(self, block_chain, start_index, end_index=None, **kwargs):
+        """
+        Return a BlockStream of the blocks of block_chain from start_index.
+        Close it when you're done with it.
+        """
+        return BlockStream(self, block_chain, start_index, end_index, **kwargs)
+
+    def peer_states(self):
+        return list(self._peers.values())
+
+    def peer_rates(self):
+        """
+        Return a dictionary of peer => throughput stats (see PeerState.snapshot).
+        """
+        return dict((peer, ps.snapshot()) for peer, ps in self._peers.items())
+
+    def slow_peers(self, fraction=None):
+        """
+        Return the peers delivering blocks at less than fraction (default
+        SLOW_PEER_FRACTION) of the median rate, slowest first. They're
+        only given blocks SLOW_PEER_LEAD above the lowest missing one, and
+        they're the ones to disconnect to make room for better ones.
+        """
+        if fraction is None:
+            fraction = self.SLOW_PEER_FRACTION
+        rates = sorted(ps.rate for ps in self._peers.values() if ps.rate is not None)
+        if len(rates) < 2:
+            return []
+        threshold = rates[len(rates) // 2] * fraction
+        slow = [ps for ps in self._peers.values() if ps.rate is not None and ps.rate < threshold]
+        return [ps.peer for ps in sorted(slow, key=lambda ps: ps.rate)]
+
+    def lowest_missing_index(self):
+        while self._missing:
+            block_index, block_hash = self._missing[0]
+            if block_hash in self._requests:
+                return block_index
+            heapq.heappop(self._missing)
+        return None
+
+    def _request_done(self, request):
+        if self._requests.get(request.block_hash) is request:
+            del self._requests[request.block_hash]
+        # the window may have moved
+        self._wake_idle_peers()
+
+    def _unassign(self, request):
+        request.peer = None
+        heapq.heappush(self._unassigned, (request.block_index, request.block_hash))
+        self._wake_idle_peers()
+
+    def _peer_priority(self, peer):
+        # peers we've measured, by throughput, then the others by ping time
+        rate = self._peers[peer].rate
+        if rate is None:
+            return (1, peer.score())
+        return (0, -rate)
+
+    def _wake_idle_peers(self):
+        # the fastest peers get first pick of the lowest blocks
+        idle_peers = sorted(self._idle_peers.items(), key=lambda pair: self._peer_priority(pair[0]))
+        self._idle_peers = {}
+        for peer, future in idle_peers:
+            if not future.done():
+                future.set_result(None)
+
+    def _is_excluded(self, request, peer):
+        # if everyone has let us down on this block, everyone gets another try
+        return peer in request.excluded_peers and not request.excluded_peers.issuperset(self._peers)
+
+    def _batch_size(self, peer_state):
+        if peer_state.rate is None:
+            batch_bytes = self.INITIAL_BATCH_BYTES
+        else:
+            batch_bytes = peer_state.rate * self.TARGET_BATCH_SECONDS
+        return max(1, min(self.MAX_BATCH_SIZE, int(batch_bytes / self.average_block_size)))
+
+    def _pick_batch(self, peer_state):
+        lowest_index = self.lowest_missing_index()
+        if lowest_index is None:
+            return []
+        limit = min(lowest_index + self.WINDOW_SIZE, peer_state.last_block_index + 1)
+        min_index = lowest_index
+        slow_peers = self.slow_peers()
+        if peer_state.peer in slow_peers and any(
+                ps.last_block_index >= lowest_index for ps in self._peers.values() if ps.peer not in slow_peers):
+            # leave the blocks holding the window back to faster peers
+            min_index = lowest_index + self.SLOW_PEER_LEAD
+        count = self._batch_size(peer_state)
+        batch = []
+        skipped = []
+        while self._unassigned and len(batch) < count:
+            block_index, block_hash = self._unassigned[0]
+            if block_index >= limit:
+                break
+            heapq.heappop(self._unassigned)
+            request = self._requests.get(block_hash)
+            if request is None or request.peer is not None:
+                continue
+            if block_index < min_index or self._is_excluded(request, peer_state.peer):
+                skipped.append((block_index, block_hash))
+                continue
+            request.peer = peer_state.peer
+            batch.append(request)
+        for item in skipped:
+            heapq.heappush(self._unassigned, item)
+        return batch
+
+    @asyncio.coroutine
+    def _wait_for_work(self, peer):
+        future = asyncio.Future()
+        self._idle_peers[peer] = future
+        yield from asyncio.wait([future, peer.connection_lost_future], return_when=asyncio.FIRST_COMPLETED)
+        if self._idle_peers.get(peer) is future:
+            del self._idle_peers[peer]
+
+    def _fetch_done(self, peer, request, task):
+        block = task.result()
+        if block:
+            if not request.future.done():
+                request.future.set_result(block)
+            return
+        request.excluded_peers.add(peer)
+        if request.peer is peer and not request.future.done():
+            self._unassign(request)
+
+    @asyncio.coroutine
+    def _fetch_batch(self, peer_state, batch):
+        peer = peer_state.peer
+        start_time = time.time()
+        tasks = []
+        for request in batch:
+            request.assigned_at = start_time
+            task = asyncio.Task(peer_state.fetcher.fetch(InvItem(ITEM_TYPE_BLOCK, request.block_hash)))
+            # hand each block over as soon as it arrives
+            task.add_done_callback(lambda t, request=request: self._fetch_done(peer, request, t))
+            tasks.append(task)
+        pending = tasks
+        while pending:
+            done, pending = yield from asyncio.wait(pending, timeout=self.STALL_CHECK_INTERVAL)
+            # stop waiting for blocks that were given to another peer
+            pending = [t for t, r in zip(tasks, batch) if t in pending and r.peer is peer]
+        elapsed = max(time.time() - start_time, 1e-3)
+        blocks = [task.result() for task in tasks if task.done() and task.result()]
+        size = 0
+        for block in blocks:
+            block_size = len(block.as_bin())
+            size += block_size
+            self.average_block_size += self.BLOCK_SIZE_ALPHA * (block_size - self.average_block_size)
+        peer_state.blocks_fetched += len(blocks)
+        peer_state.bytes_fetched += size
+        rate = size / elapsed
+        if peer_state.rate is None:
+            peer_state.rate = rate
+        else:
+            peer_state.rate += self.RATE_ALPHA * (rate - peer_state.rate)
+        logging.debug("fetched %d of %d blocks (%d bytes) in %f s from %s",
+                      len(blocks), len(batch), size, elapsed, peer)
+        return len(blocks)
 
     @asyncio.coroutine
     def fetch_from_peer(self, peer, fetcher, last_block_index):
-        missing = set()
-        per_loop = 1
-        loop_timeout = 30
-        while True:
-            items_to_try = []
-            items_to_not_try = []
-            while True:
-                item = yield from self.block_hash_priority_queue.get()
-                if item in missing or item[0] > last_block_index:
-                    items_to_not_try.append(item)
+        peer_state = PeerState(peer, fetcher, last_block_index)
+        self._peers[peer] = peer_state
+        if self._stall_task is None:
+            self._stall_task = asyncio.Task(self._watch_for_stalls())
+        try:
+            while not peer.connection_lost_future.done():
+                batch = self._pick_batch(peer_state)
+                if batch:
+                    fetched = yield from self._fetch_batch(peer_state, batch)
+                    if fetched == 0:
+                        yield from asyncio.sleep(self.RETRY_DELAY)
                 else:
-                    items_to_try.append(item)
-                if self.block_hash_priority_queue.empty():
-                    break
-                if len(items_to_try) >= per_loop or item[0] > last_block_index:
-                    break
-            for item in items_to_not_try:
-                self.block_hash_priority_queue.put_nowait(item)
-            start_time = time.time()
-            futures = []
-            for item in items_to_try:
-                if item[-1].done():
-                    continue
-                future = asyncio.Task(fetcher.fetch(item[1]))
-
-                def make_cb(the_future):
-                    def cb(f):
-                        if not the_future.done():
-                            the_future.set_result(f.result())
-                    return cb
-
-                future.add_done_callback(make_cb(item[-1]))
-                futures.append(future)
-            if len(futures) == 0:
-                logging.debug("no fetchable blocks, sleeping")
-                yield from asyncio.sleep(10)
-                continue
-            done, pending = yield from asyncio.wait(futures, timeout=loop_timeout)
-            finish_time = time.time() - start_time
-            logging.debug("time elapsed %f s for %s", finish_time, peer)
-            if len(pending) > 0:
-                logging.debug("unfinished, decreasing loop count from %d", per_loop)
-                per_loop = int(per_loop * 0.5 + 1)
-                done, pending = yield from asyncio.wait(futures, timeout=loop_timeout)
-            else:
-                if finish_time * 3 < loop_timeout and len(items_to_try) >= per_loop:
-                    logging.debug("increasing loop count from %d", per_loop)
-                    per_loop = min(1000, int(0.8 + 1.4 * per_loop))
-            logging.debug("loop count now %d for %s", per_loop, peer)
-            for item in items_to_try:
-                if not item[-1].done():
-                    self.block_hash_priority_queue.put(item)
-                    missing.add(item)
+                    yield from self._wait_for_work(peer)
+        finally:
+            del self._peers[peer]
+            self._idle_peers.pop(peer, None)
+            for request in list(self._requests.values()):
+                if request.peer is peer:
+                    self._unassign(request)
+
+    def _check_for_stall(self):
+        lowest_index = self.lowest_missing_index()
+        if lowest_index is None:
+            return
+        request = self._requests[self._missing[0][1]]
+        peer = request.peer
+        if peer is None or time.time() - request.assigned_at < self.STALL_TIMEOUT:
+            return
+        if not any(p is not peer and ps.last_block_index >= lowest_index for p, ps in self._peers.items()):
+            return
+        logging.info("%s is holding up block %d, asking another peer", peer, lowest_index)
+        peer_state = self._peers.get(peer)
+        if peer_state:
+            peer_state.stalls += 1
+        request.excluded_peers.add(peer)
+        self._unassign(request)
+
+    @asyncio.coroutine
+    def _watch_for_stalls(self):
+        while self._peers:
+            yield from asyncio.sleep(self.STALL_CHECK_INTERVAL)
+            self._check_for_stall()
+        self._stall_task = None
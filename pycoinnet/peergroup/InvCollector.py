@@ -6,47 +6,78 @@ Listen to peers and queue when new InvItem objects are seen.
 Allow them to be fetched.
 
 Advertise objects that are fetched (to peers that haven't told us they have it).
+
+Who announced what is kept for INV_ITEM_MAX_AGE seconds, for at most
+INV_ITEM_MAX_COUNT hashes, and dropped for a peer when it disconnects.
+
+For each peer, we also remember the last KNOWN_INVENTORY_SIZE or so hashes
+it announced to us or we announced to it, and don't announce those again.
+Announcements to a peer are held for a random time averaging
+TRICKLE_INTERVAL seconds, then sent, shuffled, in as few inv messages as
+possible.
 """
 
 import asyncio
 import logging
+import random
 import time
 import weakref
 
 from pycoinnet.peer.Fetcher import Fetcher
+from pycoinnet.peergroup.RequestScheduler import RequestScheduler, fastest_peer
+from pycoinnet.util.InFlightRegistry import InFlightRegistry
+from pycoinnet.util.InvItemIndex import InvItemIndex
+from pycoinnet.util.RollingHashSet import RollingHashSet
 
 
 class InvCollector:
-    def __init__(self, tx_store={}, block_store={}):
-        self.inv_item_db = {}
-        # key: InvItem; value: dictionary of peers to timestamps
+    INV_ITEM_MAX_COUNT = 200000
+    INV_ITEM_MAX_AGE = 3600
+    KNOWN_INVENTORY_SIZE = 50000
+    TRICKLE_INTERVAL = 0.5
+    MAX_INV_ITEMS = 50000
+
+    def __init__(self, tx_store={}, block_store={}, peer_selection_f=fastest_peer):
+        self.inv_item_db = InvItemIndex(
+            max_count=self.INV_ITEM_MAX_COUNT, max_age=self.INV_ITEM_MAX_AGE,
+            did_drop_hash_f=lambda the_hash: self.request_scheduler.hash_dropped(the_hash))
+        # key: hash; value: dictionary of peers to timestamps
 
         self.fetchers_by_peer = {}
+        # key: peer; value: RollingHashSet of hashes it knows we have
+        self.known_inventory_by_peer = {}
         self.advertise_queues = weakref.WeakSet()
         self.inv_item_queues = weakref.WeakSet()
-        self.inv_item_peers_q = {}
+        self.in_flight = InFlightRegistry()
+        self.request_scheduler = RequestScheduler(self.fetchers_by_peer, self.inv_item_db, peer_selection_f)
 
     def add_peer(self, peer):
         """
         Add a peer whose inv messages we want to monitor.
         """
         self.fetchers_by_peer[peer] = Fetcher(peer)
+        known_inventory = RollingHashSet(self.KNOWN_INVENTORY_SIZE)
+        self.known_inventory_by_peer[peer] = known_inventory
         q = asyncio.Queue()
         self.advertise_queues.add(q)
 
         @asyncio.coroutine
         def _advertise_to_peer(peer, q):
             while True:
-                items = []
-                while True:
-                    inv_item = yield from q.get()
-                    if peer not in self.inv_item_db.get(inv_item.data, []):
-                        items.append(inv_item)
-                    if q.qsize() == 0:
-                        break
-                # advertise the presence of the item!
-                if len(items) > 0:
-                    peer.send_msg("inv", items=items)
+                items = [(yield from q.get())]
+                if self.TRICKLE_INTERVAL > 0:
+                    yield from asyncio.sleep(random.uniform(0, 2 * self.TRICKLE_INTERVAL))
+                while q.qsize() > 0:
+                    items.append(q.get_nowait())
+                to_send = []
+                for inv_item in items:
+                    if inv_item.data not in known_inventory:
+                        known_inventory.add(inv_item.data)
+                        to_send.append(inv_item)
+                # advertise the presence of the items!
+                random.shuffle(to_send)
+                for i in range(0, len(to_send), self.MAX_INV_ITEMS):
+                    peer.send_msg("inv", items=to_send[i:i+self.MAX_INV_ITEMS])
 
         @asyncio.coroutine
         def _watch_peer(peer, next_message, advertise_task):
@@ -56,6 +87,7 @@ class InvCollector:
                     if name == 'inv':
                         for inv_item in data["items"]:
                             logging.debug("noting %s available from %s", inv_item, peer)
+                            known_inventory.add(inv_item.data)
                             self._register_inv_item(inv_item, peer)
                     if name == 'notfound':
                         for inv_item in data["items"]:
@@ -63,13 +95,16 @@ class InvCollector:
                             self._unregister_inv_item(inv_item, peer)
             except EOFError:
                 del self.fetchers_by_peer[peer]
+                self.inv_item_db.remove_peer(peer)
+                self.request_scheduler.remove_peer(peer)
+                del self.known_inventory_by_peer[peer]
                 advertise_task.cancel()
                 for q in self.inv_item_queues:
                     q.put_nowait(None)
 
         advertise_task = asyncio.Task(_advertise_to_peer(peer, q))
 
-        next_message = peer.new_get_next_message_f(lambda name, data: name in ("inv", "notfound"))
+        next_message = peer.new_get_next_message_f(names=["inv", "notfound"])
         peer.add_task(_watch_peer(peer, next_message, advertise_task))
 
     def fetcher_for_peer(self, peer):
@@ -86,95 +121,81 @@ class InvCollector:
 
     @asyncio.coroutine
     def fetch(self, inv_item, peer_timeout=10):
-        # create the queue of peers that have this inv_item available
-        q = asyncio.Queue()
-        items = sorted(self.inv_item_db[inv_item.data].items(), key=lambda pair: pair[-1])
-        for peer, when in items:
-            q.put_nowait(peer)
-        # make the queue available to the object so if more peers
-        # announce they have it, they can be queried
-        self.inv_item_peers_q[inv_item.data] = q
-
-        # this is the set of futures that we are trying to fetch the item from
-        pending_fetchers = set()
-
-        # this async method delays a specific amount of time, then
-        # fetches a new peer from the queue
-        @asyncio.coroutine
-        def _wait_for_timeout_and_peer(q, initial_delay=0):
-            yield from asyncio.sleep(initial_delay)
-            while True:
-                peer = yield from q.get()
-                fetcher = self.fetchers_by_peer.get(peer)
-                if fetcher:
-                    break
-            logging.debug("requesting %s from %s", inv_item, peer)
-            return asyncio.Task(fetcher.fetch(inv_item))
-
-        # the loop works like this:
-        #   request the item from a peer
-        #   wait 10 s or for response (either notfound or found)
-        #   if found, done
-        #   if notfound or time out, get another peer
-
-        most_recent_fetcher = None
-
-        while True:
-            if most_recent_fetcher is None and q.qsize() > 0:
-                most_recent_fetcher = yield from _wait_for_timeout_and_peer(q)
-                timer_future = asyncio.Task(_wait_for_timeout_and_peer(q, initial_delay=peer_timeout))
-
-            futures = pending_fetchers.union(set([timer_future]))
-
-            if most_recent_fetcher:
-                futures.add(most_recent_fetcher)
-
-            done, pending_fetchers = \
-                yield from asyncio.wait(list(futures), return_when=asyncio.FIRST_COMPLETED)
-
-            # is it time to try a new fetcher?
-            if timer_future in done:
-                # we timed out, so we need to queue up another peer
-                most_recent_fetcher = timer_future.result()
-                logging.debug("timeout, need to request from a new peer, %s", inv_item)
-                timer_future = asyncio.Task(_wait_for_timeout_and_peer(q, initial_delay=peer_timeout))
-                # we have a new peer available as the result of get_fetcher_future
-                continue
-
-            # is the most recent done?
-            if most_recent_fetcher and most_recent_fetcher.done():
-                r = most_recent_fetcher.result()
-                if r:
-                    return r
-                # we got a "notfound" from this one
-                # queue up another peer
-                logging.debug("got a notfound, need to try a new peer for %s", inv_item)
-                timer_future.cancel()
-                pending_fetchers.discard(timer_future)
-                most_recent_fetcher = None
-                timer_future = asyncio.Task(_wait_for_timeout_and_peer(q, initial_delay=0))
-                # we have a new peer available as the result of timer_future
-                continue
-
-            # one or more fetchers is done
-            # if any of them have a non-None result, we're golden
-            for f in done:
-                r = f.result()
-                if r:
-                    logging.info("Got %s", r)
-                    return r
-            # otherwise, we just continue trying, using the new pending_fetchers
+        """
+        Return the item once a peer that announced it sends it. If a peer
+        doesn't answer in time (at most peer_timeout seconds), another peer
+        is asked too. Return None if no peer turns out to have it.
+        """
+        return (yield from self.request_scheduler.fetch(inv_item, peer_timeout=peer_timeout))
 
     def fetch_validate_store_item_async(self, inv_item, item_store, validator_f):
-        def _run():
-            item = item_store.get(inv_item.data)
-            if item:
-                return
-            item = yield from self.fetch(inv_item)
-            if item and validator_f(item):
+        """
+        Fetch, validate and store inv_item, unless it's in item_store already.
+        Return a future for the item, or None. If this is already under way
+        for inv_item, return the future for that instead of starting again.
+
+        validator_f(item) returns True if the item is valid, or a coroutine
+        or future that does.
+
+        This is driven by callbacks on the request's future, so no task is
+        created per item, except to run a validator_f coroutine.
+        """
+        def _start():
+            future = asyncio.Future()
+            if item_store.get(inv_item.data):
+                future.set_result(None)
+                return future
+            fetch_future = self.request_scheduler.request(inv_item)
+
+            def _fetched(f):
+                if future.done() or f.cancelled():
+                    return
+                item = f.result()
+                if not item:
+                    future.set_result(None)
+                    return
+                try:
+                    is_valid = validator_f(item)
+                except Exception as ex:
+                    future.set_exception(ex)
+                    return
+                if asyncio.iscoroutine(is_valid) or isinstance(is_valid, asyncio.Future):
+                    is_valid = asyncio.async(is_valid)
+                    is_valid.add_done_callback(lambda v: _validated(item, v))
+                else:
+                    _store(item, is_valid)
+
+            def _validated(item, f):
+                if future.done():
+                    return
+                if f.cancelled():
+                    future.cancel()
+                elif f.exception():
+                    future.set_exception(f.exception())
+                else:
+                    _store(item, f.result())
+
+            def _store(item, is_valid):
+                if not is_valid:
+                    future.set_result(None)
+                    return
                 item_store[item.hash()] = item
+                if item.hash() not in item_store:
+                    # a bounded store (like a Mempool) turned it away, so
+                    # don't advertise what we can't serve
+                    future.set_result(None)
+                    return
                 self.advertise_item(inv_item)
-        return asyncio.Task(_run())
+                future.set_result(item)
+
+            def _done(f):
+                if f.cancelled():
+                    fetch_future.cancel()
+
+            fetch_future.add_done_callback(_fetched)
+            future.add_done_callback(_done)
+            return future
+        return self.in_flight.get_or_start(inv_item.data, _start)
 
     def advertise_item(self, inv_item):
         """
@@ -184,18 +205,33 @@ class InvCollector:
         for q in self.advertise_queues:
             q.put_nowait(inv_item)
 
+    def memory_usage(self):
+        """
+        Return a dictionary describing how much is being remembered.
+        """
+        r = self.inv_item_db.memory_usage()
+        r["fetch_count"] = self.request_scheduler.request_count()
+        r["fetcher_count"] = len(self.fetchers_by_peer)
+        return r
+
+    def in_flight_stats(self):
+        """
+        Return a dictionary of counts of items fetched, and of duplicate
+        fetches avoided by sharing one under way.
+        """
+        r = self.in_flight.stats()
+        r["fetches_started"] = self.request_scheduler.requests_started
+        r["fetches_joined"] = self.request_scheduler.requests_joined
+        return r
+
     def _register_inv_item(self, inv_item, peer):
         the_hash = inv_item.data
-        if the_hash not in self.inv_item_db:
+        when = time.time()
+        if self.inv_item_db.add(the_hash, peer, when):
             # it's new!
-            self.inv_item_db[the_hash] = {}
             for q in self.inv_item_queues:
                 q.put_nowait(inv_item)
-        self.inv_item_db[the_hash][peer] = time.time()
-        if the_hash in self.inv_item_peers_q:
-            self.inv_item_peers_q[the_hash].put_nowait(peer)
+        self.request_scheduler.peer_announced(inv_item, peer)
 
     def _unregister_inv_item(self, inv_item, peer):
-        the_hash = inv_item.data
-        if the_hash in self.inv_item_db:
-            del self.inv_item_db[the_hash][peer]
+        self.inv_item_db.remove(inv_item.data, peer)
@@ -0,0 +1,343 @@
+"""
+RequestScheduler.py
+
+Fetch inventory items from whichever peers announced them.
+
+One request is kept per hash, however many callers want it. Each request
+is sent to one peer at a time, picked by peer_selection_f from the peers
+that announced the item and have fewer than MAX_IN_FLIGHT_PER_PEER of our
+requests outstanding. If that peer says notfound, the next one is tried
+right away; if it hasn't answered in time, another peer is asked too,
+and the first answer wins. If every peer that announced it has said
+notfound or gone away, and no other peer announces it within
+peer_timeout seconds (or its hash expires from inv_item_db), the request
+gives up and returns None.
+
+How long is "in time" depends on the peer and the item type: the mean
+plus TIMEOUT_STDDEVS standard deviations of its recent response times,
+and for blocks, per byte times the average block size. Until a peer has
+answered MIN_SAMPLES requests of a type, or if the estimate is longer,
+the caller's peer_timeout is used.
+
+Requests go through each peer's Fetcher, which batches them into shared
+getdata messages. Timeouts are kept in one heap with one timer handle, so
+no tasks or timers are created per request.
+"""
+
+import asyncio
+import collections
+import heapq
+import logging
+
+from pycoinnet.InvItem import ITEM_TYPE_BLOCK
+from pycoinnet.peer.ResponseTimes import ResponseTimes
+
+
+def fastest_peer(inv_item, candidates):
+    """
+    The default peer_selection_f: given a list of (peer, when_announced)
+    tuples, pick the peer with the lowest ping time, breaking ties by
+    who announced first.
+    """
+    return min(candidates, key=lambda c: (c[0].score(), c[1]))[0]
+
+
+class InvRequest:
+    __slots__ = ("inv_item", "future", "peer_timeout", "attempts", "tried_peers", "waiters", "give_up_at")
+
+    def __init__(self, inv_item, peer_timeout):
+        self.inv_item = inv_item
+        self.future = asyncio.Future()
+        self.peer_timeout = peer_timeout
+        # peer => (future from that peer's Fetcher, time requested)
+        self.attempts = {}
+        self.tried_peers = set()
+        # one future per caller
+        self.waiters = []
+        # when to give up, if no peer is left to ask
+        self.give_up_at = None
+
+
+class RequestScheduler:
+    MAX_IN_FLIGHT_PER_PEER = 1000
+    TIMEOUT_STDDEVS = 3
+    MIN_SAMPLES = 5
+    MIN_PEER_TIMEOUT = 0.2
+    BLOCK_SIZE_ALPHA = 0.1
+
+    def __init__(self, fetchers_by_peer, inv_item_db, peer_selection_f=fastest_peer):
+        self.fetchers_by_peer = fetchers_by_peer
+        self.inv_item_db = inv_item_db
+        self.peer_selection_f = peer_selection_f
+        # key: hash; value: InvRequest
+        self._requests = {}
+        # requests that need a peer
+        # key: hash; value: InvRequest
+        self._waiting = collections.OrderedDict()
+        # requests that could go to a peer once it has a free slot, oldest first
+        # key: peer; value: OrderedDict of hash to InvRequest
+        self._waiting_for_slot = {}
+        # key: peer; value: count of requests outstanding
+        self._in_flight_by_peer = {}
+        # heap of (deadline, sequence, hash, peer); peer is None for the
+        # deadline of a request that has no peer left to ask
+        self._deadlines = []
+        self._deadline_sequence = 0
+        self._timer_handle = None
+        self._timer_when = None
+        # key: peer; value: dictionary of item type to ResponseTimes
+        self._response_times = {}
+        self.average_block_size = None
+
+        ## stats
+        self.requests_started = 0
+        self.requests_joined = 0
+        self.requests_sent = 0
+        self.requests_retried = 0
+        self.requests_timed_out = 0
+        self.requests_given_up = 0
+
+    @asyncio.coroutine
+    def fetch(self, inv_item, peer_timeout=10):
+        """
+        Return the item, once a peer sends it, or None if no peer has it.
+        """
+        return (yield from self.request(inv_item, peer_timeout=peer_timeout))
+
+    def request(self, inv_item, peer_timeout=10):
+        """
+        Return a future for the item, or None if no peer has it. Each caller
+        gets its own future; cancelling it withdraws only that caller, and
+        the request is dropped once no caller is left.
+        """
+        request = self._requests.get(inv_item.data)
+        if request is None:
+            request = InvRequest(inv_item, peer_timeout)
+            self._requests[inv_item.data] = request
+            request.future.add_done_callback(lambda f: self._request_done(request))
+            self.requests_started += 1
+            self._schedule(request)
+        else:
+            self.requests_joined += 1
+        future = asyncio.Future()
+        request.waiters.append(future)
+        future.add_done_callback(lambda f: self._waiter_done(request, f))
+        return future
+
+    def in_flight_count(self, peer):
+        return self._in_flight_by_peer.get(peer, 0)
+
+    def request_count(self):
+        return len(self._requests)
+
+    def peer_timeout(self, peer, item_type, peer_timeout=None):
+        """
+        How many seconds to give peer to answer a request for an item of
+        item_type before asking another peer too. If we don't know yet,
+        return peer_timeout.
+        """
+        times = self._response_times.get(peer, {}).get(item_type)
+        if times is None or len(times.samples) < self.MIN_SAMPLES:
+            return peer_timeout
+        estimate = times.estimate(self.TIMEOUT_STDDEVS)
+        if item_type == ITEM_TYPE_BLOCK:
+            estimate *= self.average_block_size
+        estimate = max(self.MIN_PEER_TIMEOUT, estimate)
+        if peer_timeout is not None:
+            estimate = min(estimate, peer_timeout)
+        return estimate
+
+    def response_time_snapshot(self):
+        """
+        Return a dictionary of peer to a dictionary of item type to the
+        response time statistics for it, including the timeout we use.
+        Block times are per byte.
+        """
+        r = {}
+        for peer, times_by_type in self._response_times.items():
+            r[peer] = {}
+            for item_type, times in times_by_type.items():
+                d = times.snapshot()
+                d["timeout"] = self.peer_timeout(peer, item_type)
+                r[peer][item_type] = d
+        return r
+
+    def remove_peer(self, peer):
+        """
+        Forget what we know about peer.
+        """
+        self._response_times.pop(peer, None)
+
+    def _record_response(self, peer, inv_item, item, seconds):
+        item_type = inv_item.item_type
+        if item_type == ITEM_TYPE_BLOCK:
+            size = len(item.as_bin())
+            if self.average_block_size is None:
+                self.average_block_size = size
+            else:
+                self.average_block_size += self.BLOCK_SIZE_ALPHA * (size - self.average_block_size)
+            seconds /= size
+        times_by_type = self._response_times.setdefault(peer, {})
+        if item_type not in times_by_type:
+            times_by_type[item_type] = ResponseTimes()
+        times_by_type[item_type].record(seconds)
+
+    def peer_announced(self, inv_item, peer):
+        """
+        Call when peer announces inv_item, so a request waiting for a
+        peer that has it can go out.
+        """
+        request = self._waiting.get(inv_item.data)
+        if request:
+            self._schedule(request)
+
+    def hash_dropped(self, the_hash):
+        """
+        Call when inv_item_db forgets the_hash, so a request waiting for a
+        peer to announce it gives up.
+        """
+        request = self._waiting.get(the_hash)
+        if request and not request.attempts and not request.future.done():
+            request.future.set_result(None)
+
+    def _candidates(self, request):
+        """
+        Return a list of (peer, when) for the peers we could ask, and a list
+        of the peers we could ask if they had a free slot.
+        """
+        candidates = []
+        full_peers = []
+        for peer, when in self.inv_item_db.get(request.inv_item.data, {}).items():
+            if peer in request.tried_peers or peer not in self.fetchers_by_peer:
+                continue
+            if self.in_flight_count(peer) >= self.MAX_IN_FLIGHT_PER_PEER:
+                full_peers.append(peer)
+                continue
+            candidates.append((peer, when))
+        return candidates, full_peers
+
+    def _schedule(self, request):
+        """
+        Send request to another peer. If there's none available, wait
+        for one to announce the item or to free up a slot.
+        """
+        the_hash = request.inv_item.data
+        candidates, full_peers = self._candidates(request)
+        if not candidates:
+            self._waiting[the_hash] = request
+            for peer in full_peers:
+                self._waiting_for_slot.setdefault(peer, collections.OrderedDict())[the_hash] = request
+            if not request.attempts and not full_peers and request.give_up_at is None:
+                # nobody left to ask: give another peer a while to announce it
+                request.give_up_at = asyncio.get_event_loop().time() + request.peer_timeout
+                self._push_deadline(request.give_up_at, the_hash, None)
+            return False
+        self._waiting.pop(the_hash, None)
+        request.give_up_at = None
+        peer = self.peer_selection_f(request.inv_item, candidates)
+        logging.debug("requesting %s from %s", request.inv_item, peer)
+        if request.tried_peers:
+            self.requests_retried += 1
+        self.requests_sent += 1
+        request.tried_peers.add(peer)
+        self._in_flight_by_peer[peer] = self.in_flight_count(peer) + 1
+        future = self.fetchers_by_peer[peer].request(request.inv_item)
+        now = asyncio.get_event_loop().time()
+        request.attempts[peer] = (future, now)
+        future.add_done_callback(lambda f: self._attempt_done(request, peer, f))
+        deadline = now + self.peer_timeout(peer, request.inv_item.item_type, request.peer_timeout)
+        self._push_deadline(deadline, the_hash, peer)
+        return True
+
+    def _attempt_done(self, request, peer, future):
+        self._in_flight_by_peer[peer] -= 1
+        if self._in_flight_by_peer[peer] == 0:
+            del self._in_flight_by_peer[peer]
+        self._slot_freed(peer)
+        attempt_future, requested_at = request.attempts.get(peer, (None, None))
+        if attempt_future is not future:
+            return
+        del request.attempts[peer]
+        item = None if future.cancelled() else future.result()
+        if item:
+            seconds = asyncio.get_event_loop().time() - requested_at
+            self._record_response(peer, request.inv_item, item, seconds)
+        if request.future.done():
+            return
+        if item:
+            request.future.set_result(item)
+            return
+        # notfound, or the peer went away
+        logging.debug("got a notfound, need to try a new peer for %s", request.inv_item)
+        self._schedule(request)
+
+    def _waiter_done(self, request, future):
+        if not future.cancelled() or future not in request.waiters:
+            return
+        request.waiters.remove(future)
+        if not request.waiters:
+            request.future.cancel()
+
+    def _request_done(self, request):
+        item = None if request.future.cancelled() else request.future.result()
+        waiters = request.waiters
+        request.waiters = []
+        for future in waiters:
+            if not future.done():
+                future.set_result(item)
+        if self._requests.get(request.inv_item.data) is request:
+            del self._requests[request.inv_item.data]
+        self._waiting.pop(request.inv_item.data, None)
+        attempts = list(request.attempts.values())
+        request.attempts.clear()
+        # these futures are ours alone, so other users of the peers'
+        # Fetchers still get the item
+        for future, requested_at in attempts:
+            future.cancel()
+
+    def _slot_freed(self, peer):
+        # give the slot to the oldest request waiting for it
+        q = self._waiting_for_slot.get(peer)
+        while q:
+            the_hash, request = q.popitem(last=False)
+            if self._waiting.get(the_hash) is request and self._schedule(request):
+                break
+        if q is not None and not q:
+            del self._waiting_for_slot[peer]
+
+    def _push_deadline(self, deadline, the_hash, peer):
+        self._deadline_sequence += 1
+        heapq.heappush(self._deadlines, (deadline, self._deadline_sequence, the_hash, peer))
+        self._schedule_timer()
+
+    def _schedule_timer(self):
+        if self._deadlines:
+            deadline = self._deadlines[0][0]
+            if self._timer_handle:
+                if self._timer_when <= deadline:
+                    return
+                self._timer_handle.cancel()
+            self._timer_when = deadline
+            self._timer_handle = asyncio.get_event_loop().call_at(deadline, self._check_deadlines)
+
+    def _check_deadlines(self):
+        self._timer_handle = self._timer_when = None
+        now = asyncio.get_event_loop().time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, sequence, the_hash, peer = heapq.heappop(self._deadlines)
+            request = self._requests.get(the_hash)
+            if request is None or request.future.done():
+                continue
+            if peer is None:
+                if request.give_up_at is not None and request.give_up_at <= now and not request.attempts:
+                    logging.debug("no peer has %s, giving up", request.inv_item)
+                    self.requests_given_up += 1
+                    request.future.set_result(None)
+                continue
+            if peer not in request.attempts:
+                continue
+            # leave this one going, but ask someone else too
+            logging.debug("timeout, need to request %s from a new peer", request.inv_item)
+            self.requests_timed_out += 1
+            self._schedule(request)
+        self._schedule_timer()
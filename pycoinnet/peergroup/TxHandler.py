@@ -4,6 +4,9 @@ TxHandler
 This class should be instantiated once per client.
 
 It takes an InvCollector and a TxStore, and an optional Tx validator.
+The TxStore can be a dict, or a pycoinnet.util.Mempool.Mempool to keep
+its size bounded. The validator can be a coroutine, like the validate
+method of a TxValidationPipeline, which validates in other processes.
 
 When a new Tx object is noted by the InvCollector, this object will
 fetch it, validate it, then store it in the TxStore and tell the
@@ -19,6 +22,7 @@ import asyncio
 import logging
 
 from pycoinnet.InvItem import InvItem, ITEM_TYPE_TX
+from pycoinnet.peer.FrameCache import FrameCache
 
 
 class TxHandler:
@@ -26,6 +30,7 @@ class TxHandler:
         self.inv_collector = inv_collector
         self.q = inv_collector.new_inv_item_queue()
         self.tx_store = tx_store
+        self.frame_cache = FrameCache(max_bytes=4*1024*1024)
         self._validator_handle = asyncio.Task(self._run(tx_validator))
 
     def add_peer(self, peer):
@@ -45,19 +50,19 @@ class TxHandler:
                         continue
                     tx = self.tx_store.get(inv_item.data)
                     if tx:
-                        txs_found.append(tx)
+                        txs_found.append((inv_item.data, tx))
                     else:
                         not_found.append(inv_item)
                 if not_found:
                     peer.send_msg("notfound", items=not_found)
-                for tx in txs_found:
-                    peer.send_msg("tx", tx=tx)
+                for the_hash, tx in txs_found:
+                    self.frame_cache.send(peer, "tx", the_hash, tx=tx)
 
         @asyncio.coroutine
         def _run_mempool(next_message):
             try:
                 name, data = yield from next_message()
-                inv_items = [InvItem(ITEM_TYPE_TX, tx.hash()) for tx in self.tx_store.values()]
+                inv_items = [InvItem(ITEM_TYPE_TX, the_hash) for the_hash in self.tx_store.keys()]
                 logging.debug("sending inv of %d item(s) in response to mempool", len(inv_items))
                 if len(inv_items) > 0:
                     peer.send_msg("inv", items=inv_items)
@@ -65,21 +70,25 @@ class TxHandler:
             except EOFError:
                 pass
 
-        next_getdata = peer.new_get_next_message_f(lambda name, data: name == 'getdata')
+        next_getdata = peer.new_get_next_message_f(names=["getdata"])
         peer.add_task(_run_getdata(next_getdata))
-        next_mempool = peer.new_get_next_message_f(lambda name, data: name == 'mempool')
+        next_mempool = peer.new_get_next_message_f(names=["mempool"])
         peer.add_task(_run_mempool(next_mempool))
         peer.send_msg("mempool")
 
     def add_tx(self, tx):
         """
         Add a transaction to the mempool and advertise it to peers so it can
-        propogate throughout the network.
+        propogate throughout the network. Return False if the mempool
+        didn't keep it (a Mempool evicts txs with too low a fee rate).
         """
         the_hash = tx.hash()
         if the_hash not in self.tx_store:
             self.tx_store[the_hash] = tx
+            if the_hash not in self.tx_store:
+                return False
             self.inv_collector.advertise_item(InvItem(ITEM_TYPE_TX, the_hash))
+        return True
 
     @asyncio.coroutine
     def _run(self, tx_validator):
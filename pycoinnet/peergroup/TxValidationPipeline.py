@@ -0,0 +1,134 @@
+"""
+TxValidationPipeline.py
+
+Validate transactions in a pool of processes, so script and signature
+checking doesn't hold up the event loop.
+
+validate(tx) is a coroutine that returns True or False, so it can be
+used as a TxHandler tx_validator:
+
+    pipeline = TxValidationPipeline(check_tx)
+    tx_handler = TxHandler(inv_collector, tx_store, tx_validator=pipeline.validate)
+
+Each tx is streamed to bytes and shipped, with unspents_f(tx) (the
+previous outputs it spends, or whatever else check_tx needs), to a
+worker process, which parses it and calls check_tx(tx, unspents).
+check_tx and the unspents have to be picklable, so check_tx must be a
+module-level function.
+
+Txs are sent in batches of up to max_batch_size, with at most
+max_batches_in_flight batches (by default, one per core) being worked on
+at once. At most max_queue_size txs wait for a batch; past that,
+validate waits for room.
+"""
+
+import asyncio
+import io
+import logging
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+from pycoin.tx.Tx import Tx
+
+
+def _check_tx_batch(check_tx, batch):
+    # this runs in a worker process
+    results = []
+    for tx_bytes, unspents in batch:
+        try:
+            tx = Tx.parse(io.BytesIO(tx_bytes))
+            results.append(bool(check_tx(tx, unspents)))
+        except Exception:
+            logging.exception("problem validating tx")
+            results.append(False)
+    return results
+
+
+def _tx_bytes(tx):
+    f = io.BytesIO()
+    tx.stream(f)
+    return f.getvalue()
+
+
+class TxValidationPipeline:
+    def __init__(self, check_tx, unspents_f=lambda tx: None, executor=None,
+                 max_batch_size=100, max_queue_size=10000, max_batches_in_flight=None):
+        self.check_tx = check_tx
+        self.unspents_f = unspents_f
+        self.max_batch_size = max_batch_size
+        if max_batches_in_flight is None:
+            max_batches_in_flight = os.cpu_count() or 1
+        self._owns_executor = executor is None
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=max_batches_in_flight)
+        self.executor = executor
+        self._queue = asyncio.Queue(maxsize=max_queue_size)
+        self._batch_semaphore = asyncio.Semaphore(max_batches_in_flight)
+
+        ## stats
+        self.batch_count = 0
+        self.tx_count = 0
+        self.invalid_count = 0
+
+        self._run_task = asyncio.Task(self._run())
+
+    @asyncio.coroutine
+    def validate(self, tx):
+        """
+        Return True if tx is valid.
+        """
+        future = asyncio.Future()
+        yield from self._queue.put((tx, future))
+        return (yield from future)
+
+    def queue_size(self):
+        return self._queue.qsize()
+
+    def close(self):
+        self._run_task.cancel()
+        if self._owns_executor:
+            self.executor.shutdown(wait=False)
+
+    @asyncio.coroutine
+    def _run(self):
+        while True:
+            # wait for a free worker first, so txs pile up into bigger
+            # batches while they're all busy
+            yield from self._batch_semaphore.acquire()
+            items = [(yield from self._queue.get())]
+            while len(items) < self.max_batch_size and self._queue.qsize() > 0:
+                items.append(self._queue.get_nowait())
+            batch = []
+            futures = []
+            for tx, future in items:
+                if future.cancelled():
+                    # nobody's waiting for this one any more
+                    continue
+                try:
+                    batch.append((_tx_bytes(tx), self.unspents_f(tx)))
+                    futures.append(future)
+                except Exception:
+                    logging.exception("can't prepare %s for validation", tx)
+                    if not future.done():
+                        future.set_result(False)
+            if not batch:
+                self._batch_semaphore.release()
+                continue
+            self.batch_count += 1
+            task = asyncio.Task(self._validate_batch(batch, futures))
+            task.add_done_callback(lambda f: self._batch_semaphore.release())
+
+    @asyncio.coroutine
+    def _validate_batch(self, batch, futures):
+        try:
+            results = yield from asyncio.get_event_loop().run_in_executor(
+                self.executor, _check_tx_batch, self.check_tx, batch)
+        except Exception:
+            logging.exception("problem validating batch of %d tx(s)", len(batch))
+            results = [False] * len(batch)
+        self.tx_count += len(results)
+        self.invalid_count += results.count(False)
+        for future, is_valid in zip(futures, results):
+            if not future.done():
+                future.set_result(is_valid)
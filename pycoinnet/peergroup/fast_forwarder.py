@@ -8,7 +8,7 @@ import logging
 import time
 
 from pycoinnet.InvItem import InvItem, ITEM_TYPE_BLOCK
-from pycoinnet.helpers.standards import get_headers_hashes
+from pycoinnet.helpers.standards import get_headers_array
 
 
 def fast_forwarder_add_peer_f(blockchain):
@@ -22,7 +22,7 @@ def fast_forwarder_add_peer_f(blockchain):
 
     @asyncio.coroutine
     def _fetch_missing(peer, blockchain):
-        next_message = peer.new_get_next_message_f(lambda msg, data: msg == 'block')
+        next_message = peer.new_get_next_message_f(names=["block"])
         ops = []
         for h in blockchain.chain_finder.missing_parents():
             peer.send_msg("getdata", items=[InvItem(ITEM_TYPE_BLOCK, h)])
@@ -45,7 +45,7 @@ def fast_forwarder_add_peer_f(blockchain):
                 start_time = time.time()
                 h = blockchain.last_block_hash()
                 try:
-                    headers = yield from asyncio.wait_for(get_headers_hashes(peer, h), timeout=10)
+                    headers = yield from asyncio.wait_for(get_headers_array(peer, h), timeout=10)
                 except EOFError:
                     # this peer is dead... so don't put it back in the queue
                     continue
@@ -62,7 +62,7 @@ def fast_forwarder_add_peer_f(blockchain):
                 rate_dict["records"] += len(headers)
                 priority = - rate_dict["records"] / rate_dict["total_seconds"]
                 # let's make sure we actually extend the chain
-                ops = blockchain.add_nodes((h.hash(), h.previous_block_hash, h.difficulty) for h in headers)
+                ops = blockchain.add_nodes(headers.hash_parent_weight_tuples())
                 ## this hack is necessary because the stupid default client
                 # does not send the genesis block!
                 try:
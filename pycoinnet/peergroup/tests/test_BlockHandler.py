@@ -1,5 +1,7 @@
 from pycoinnet.util.debug_help import asyncio
 
+from pycoin.block import BadMerkleRootError
+
 from pycoinnet.helpers import standards
 
 from pycoinnet.peer.tests.helper import create_handshaked_peers, handshake_peers, make_blocks, MAGIC_HEADER, create_peers_tcp
@@ -48,6 +50,42 @@ def test_BlockHandler_simple():
         assert len(r) == 2
 
 
+def test_BlockHandler_bad_merkle_root():
+    peer1_2, peer2_1 = create_handshaked_peers(ip1="127.0.0.1", ip2="127.0.0.2")
+
+    good_block, bad_block = make_blocks(2)
+    bad_block.merkle_root = b'\1' * 32
+
+    @asyncio.coroutine
+    def run_client(peer, block_list):
+        block_store = {}
+        inv_collector = InvCollector()
+        block_handler = BlockHandler(inv_collector, BlockChain(), block_store)
+        inv_collector.add_peer(peer)
+        block_handler.add_peer(peer)
+        for block in block_list:
+            inv_collector.advertise_item(InvItem(ITEM_TYPE_BLOCK, block.hash()))
+            block_store[block.hash()] = block
+        # both blocks are advertised together; give the bad one time to arrive too
+        while len(block_list) == 0 and good_block.hash() not in block_store:
+            yield from asyncio.sleep(0.1)
+        yield from asyncio.sleep(0.2)
+        return block_store, block_handler
+
+    f1 = asyncio.Task(run_client(peer1_2, []))
+    f2 = asyncio.Task(run_client(peer2_1, [bad_block, good_block]))
+    asyncio.get_event_loop().run_until_complete(asyncio.wait([f1, f2], timeout=5.0))
+
+    block_store, block_handler = f1.result()
+    assert list(block_store.keys()) == [good_block.hash()]
+    try:
+        block_handler.add_block(bad_block)
+        assert False, "add_block accepted a bad block"
+    except BadMerkleRootError:
+        pass
+    assert bad_block.hash() not in block_store
+
+
 def make_add_peer(fast_forward_add_peer, blockfetcher, block_handler, inv_collector, block_chain, block_store):
     def add_peer(peer, other_last_block_index):
         fast_forward_add_peer(peer, other_last_block_index)
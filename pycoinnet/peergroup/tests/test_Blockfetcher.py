@@ -0,0 +1,268 @@
+from pycoinnet.util.debug_help import asyncio
+import io
+
+from pycoinnet.peer.Fetcher import Fetcher
+from pycoinnet.peer.tests.helper import create_handshaked_peers, make_blocks, make_hash
+from pycoinnet.peergroup.Blockfetcher import Blockfetcher, PeerState
+from pycoinnet.util.BlockChain import BlockChain
+
+
+def serve_blocks(peer, blocks, delay=0, on_getdata=None, ignore=()):
+    """
+    Answer getdata requests for blocks, after delay seconds, except for
+    the block hashes in ignore, which are silently dropped.
+    """
+    block_db = dict((b.hash(), b) for b in blocks)
+
+    @asyncio.coroutine
+    def _run():
+        next_message = peer.new_get_next_message_f(names=["getdata"])
+        while True:
+            name, data = yield from next_message()
+            if on_getdata:
+                on_getdata(data["items"])
+            yield from asyncio.sleep(delay)
+            for inv_item in data["items"]:
+                if inv_item.data in block_db and inv_item.data not in ignore:
+                    peer.send_msg("block", block=block_db[inv_item.data])
+    peer.add_task(_run())
+
+
+def add_peer(blockfetcher, blocks, last_block_index, ip, **kwargs):
+    local_peer, remote_peer = create_handshaked_peers(ip1="127.0.0.1", ip2=ip)
+    serve_blocks(remote_peer, blocks, **kwargs)
+    blockfetcher.add_peer(local_peer, Fetcher(local_peer), last_block_index)
+    return local_peer
+
+
+def wait_for_blocks(futures, timeout=5):
+    done, pending = asyncio.get_event_loop().run_until_complete(asyncio.wait(futures, timeout=timeout))
+    assert len(pending) == 0
+    return [f.result() for f in futures]
+
+
+def test_Blockfetcher_simple():
+    BLOCKS = make_blocks(20)
+    blockfetcher = Blockfetcher()
+    # only the last peer has every block
+    for i, last_block_index in enumerate([9, 14, 19]):
+        add_peer(blockfetcher, BLOCKS, last_block_index, "127.0.0.%d" % (i+2))
+    futures = [blockfetcher.get_block_future(b.hash(), idx) for idx, b in enumerate(BLOCKS)]
+    r = wait_for_blocks(futures)
+    assert [b.hash() for b in r] == [b.hash() for b in BLOCKS]
+    states = blockfetcher.peer_states()
+    assert sum(ps.blocks_fetched for ps in states) == len(BLOCKS)
+    assert all(ps.blocks_fetched > 0 for ps in states)
+    assert blockfetcher.lowest_missing_index() is None
+
+
+def test_Blockfetcher_window():
+    BLOCKS = make_blocks(20)
+    hashes = [b.hash() for b in BLOCKS]
+    blockfetcher = Blockfetcher()
+    blockfetcher.WINDOW_SIZE = 4
+    requested = []
+
+    def on_getdata(items):
+        lowest_index = blockfetcher.lowest_missing_index()
+        for inv_item in items:
+            idx = hashes.index(inv_item.data)
+            assert lowest_index <= idx < lowest_index + 4
+            requested.append(idx)
+
+    add_peer(blockfetcher, BLOCKS, 19, "127.0.0.2", on_getdata=on_getdata)
+    futures = [blockfetcher.get_block_future(b.hash(), idx) for idx, b in enumerate(BLOCKS)]
+    r = wait_for_blocks(futures)
+    assert [b.hash() for b in r] == hashes
+    assert sorted(requested) == list(range(20))
+
+
+def test_Blockfetcher_stall():
+    BLOCKS = make_blocks(10)
+    blockfetcher = Blockfetcher()
+    blockfetcher.STALL_TIMEOUT = 0.3
+    blockfetcher.STALL_CHECK_INTERVAL = 0.1
+    blockfetcher.WINDOW_SIZE = 5
+    # the first peer gets block 0 but never sends it, holding up the window
+    stuck_peer = add_peer(blockfetcher, BLOCKS, 9, "127.0.0.2", ignore=set([BLOCKS[0].hash()]))
+    futures = [blockfetcher.get_block_future(b.hash(), idx) for idx, b in enumerate(BLOCKS)]
+    add_peer(blockfetcher, BLOCKS, 9, "127.0.0.3", delay=0.01)
+    r = wait_for_blocks(futures)
+    assert [b.hash() for b in r] == [b.hash() for b in BLOCKS]
+    stuck_state = [ps for ps in blockfetcher.peer_states() if ps.peer is stuck_peer][0]
+    assert stuck_state.stalls == 1
+
+
+def block_size(block):
+    f = io.BytesIO()
+    block.stream(f)
+    return len(f.getvalue())
+
+
+def test_Blockfetcher_rates():
+    BLOCKS = make_blocks(10)
+    blockfetcher = Blockfetcher()
+    peers = [add_peer(blockfetcher, BLOCKS, 9, "127.0.0.%d" % (i+2)) for i in range(3)]
+    futures = [blockfetcher.get_block_future(b.hash(), idx) for idx, b in enumerate(BLOCKS)]
+    wait_for_blocks(futures)
+    rates = blockfetcher.peer_rates()
+    assert set(rates.keys()) == set(peers)
+    assert sum(r["bytes_fetched"] for r in rates.values()) == sum(block_size(b) for b in BLOCKS)
+    assert sum(r["blocks_fetched"] for r in rates.values()) == len(BLOCKS)
+    # these blocks are tiny, so the estimate has come down
+    assert blockfetcher.average_block_size < blockfetcher.INITIAL_BLOCK_SIZE
+
+    for peer, rate in zip(peers, [1e6, 2e6, 1e4]):
+        [ps for ps in blockfetcher.peer_states() if ps.peer is peer][0].rate = rate
+    assert blockfetcher.slow_peers() == [peers[2]]
+    # batches are sized to take TARGET_BATCH_SECONDS at the peer's rate
+    blockfetcher.average_block_size = 1000
+    fast_state = [ps for ps in blockfetcher.peer_states() if ps.peer is peers[1]][0]
+    assert blockfetcher._batch_size(fast_state) == blockfetcher.MAX_BATCH_SIZE
+    slow_state = [ps for ps in blockfetcher.peer_states() if ps.peer is peers[2]][0]
+    assert blockfetcher._batch_size(slow_state) == 50
+
+
+def test_Blockfetcher_slow_peer():
+    def setup(last_block_indices, start=0):
+        blockfetcher = Blockfetcher()
+        blockfetcher.average_block_size = 1e4
+        states = []
+        for rate, last_block_index in zip([1e6, 2e6, 1e4], last_block_indices):
+            ps = PeerState(object(), None, last_block_index)
+            ps.rate = rate
+            blockfetcher._peers[ps.peer] = ps
+            states.append(ps)
+        for idx in range(start, start+100):
+            blockfetcher.get_block_future(make_hash(idx), idx)
+        return blockfetcher, states
+
+    blockfetcher, states = setup([99, 99, 99])
+    assert blockfetcher.slow_peers() == [states[2].peer]
+    # the slow peer is kept clear of the bottom of the window
+    batch = blockfetcher._pick_batch(states[2])
+    assert [r.block_index for r in batch] == list(range(16, 21))
+    batch = blockfetcher._pick_batch(states[0])
+    assert [r.block_index for r in batch][:16] == list(range(16))
+
+    # with nobody else to get them from, the slow peer gets them
+    blockfetcher, states = setup([50, 50, 199], start=100)
+    batch = blockfetcher._pick_batch(states[2])
+    assert [r.block_index for r in batch] == list(range(100, 105))
+
+
+def test_Blockfetcher_iter_blocks():
+    BLOCKS = make_blocks(20)
+    hashes = [b.hash() for b in BLOCKS]
+    block_chain = BlockChain()
+    block_chain.add_headers(BLOCKS)
+    blockfetcher = Blockfetcher()
+    streams = []
+
+    def on_getdata(items):
+        for inv_item in items:
+            assert hashes.index(inv_item.data) < streams[0].next_index + 4
+
+    add_peer(blockfetcher, BLOCKS, 19, "127.0.0.2", on_getdata=on_getdata)
+    stream = blockfetcher.iter_blocks(block_chain, 2, 18, max_blocks=4)
+    streams.append(stream)
+
+    @asyncio.coroutine
+    def _run():
+        r = []
+        while True:
+            v = yield from stream.next_block()
+            if v is None:
+                return r
+            r.append(v)
+            assert len(stream._prefetched) <= 4
+    r = asyncio.get_event_loop().run_until_complete(asyncio.wait_for(_run(), timeout=5))
+    assert [idx for idx, b in r] == list(range(2, 18))
+    assert [b.hash() for idx, b in r] == hashes[2:18]
+    stream.close()
+    assert len(block_chain.change_queues) == 0
+
+
+def test_Blockfetcher_iter_blocks_reorg():
+    BLOCKS = make_blocks(10)
+    FORK = make_blocks(10, nonce_base=70000, previous_block_hash=BLOCKS[4].hash())
+    block_chain = BlockChain()
+    block_chain.add_headers(BLOCKS)
+    blockfetcher = Blockfetcher()
+    add_peer(blockfetcher, BLOCKS + FORK, 19, "127.0.0.2")
+    stream = blockfetcher.iter_blocks(block_chain, 0, 15, max_blocks=3)
+
+    @asyncio.coroutine
+    def _run(count):
+        r = []
+        for i in range(count):
+            r.append((yield from stream.next_block()))
+        return r
+    loop = asyncio.get_event_loop()
+    r = loop.run_until_complete(asyncio.wait_for(_run(7), timeout=5))
+    assert [b.hash() for idx, b in r] == [b.hash() for b in BLOCKS[:7]]
+    old_futures = [f for h, f in stream._prefetched.values()]
+    assert len(old_futures) == 3
+
+    # the fork replaces blocks 5 and up, including two we've seen
+    block_chain.add_headers(FORK)
+    assert block_chain.length() == 15
+    r = loop.run_until_complete(asyncio.wait_for(_run(10), timeout=5))
+    assert [idx for idx, b in r] == list(range(5, 15))
+    assert [b.hash() for idx, b in r] == [b.hash() for b in FORK]
+    assert all(f.cancelled() for f in old_futures)
+    assert loop.run_until_complete(stream.next_block()) is None
+    stream.close()
+
+
+def test_Blockfetcher_iter_blocks_shared():
+    BLOCKS = make_blocks(11)
+    block_chain = BlockChain()
+    block_chain.add_headers(BLOCKS)
+    blockfetcher = Blockfetcher()
+    add_peer(blockfetcher, BLOCKS, 10, "127.0.0.2", delay=0.02)
+    stream_1 = blockfetcher.iter_blocks(block_chain, 0, 11, max_blocks=5)
+    stream_2 = blockfetcher.iter_blocks(block_chain, 0, 11, max_blocks=5)
+    loop = asyncio.get_event_loop()
+
+    @asyncio.coroutine
+    def _run(stream, count):
+        r = []
+        for i in range(count):
+            r.append((yield from stream.next_block()))
+        return r
+
+    r = loop.run_until_complete(asyncio.wait_for(_run(stream_1, 2), timeout=5))
+    assert [idx for idx, b in r] == [0, 1]
+    # another consumer is waiting on one of the blocks stream_1 has asked for
+    future = blockfetcher.get_block_future(BLOCKS[4].hash(), 4)
+    # stream_1 giving up on its prefetches doesn't take them from the others
+    stream_1.close()
+    r = loop.run_until_complete(asyncio.wait_for(_run(stream_2, 11), timeout=5))
+    assert [b.hash() for idx, b in r] == [b.hash() for b in BLOCKS]
+    assert loop.run_until_complete(asyncio.wait_for(future, timeout=5)).hash() == BLOCKS[4].hash()
+    stream_2.close()
+
+    # once nobody wants it, a block is no longer fetched
+    future = blockfetcher.get_block_future(b'\1' * 32, 20)
+    blockfetcher.release(b'\1' * 32)
+    assert future.cancelled()
+    loop.run_until_complete(asyncio.sleep(0))
+    assert blockfetcher.lowest_missing_index() is None
+
+
+def test_Blockfetcher_iter_blocks_context_manager():
+    BLOCKS = make_blocks(10)
+    block_chain = BlockChain()
+    block_chain.add_headers(BLOCKS)
+    blockfetcher = Blockfetcher()
+    # no peers, so nothing arrives
+    with blockfetcher.iter_blocks(block_chain, 0, max_blocks=5) as stream:
+        task = asyncio.Task(stream.next_block())
+        asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.01))
+        assert len(stream._prefetched) == 5
+        assert len(blockfetcher._requests) == 5
+        task.cancel()
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0))
+    assert len(blockfetcher._requests) == 0
+    assert len(block_chain.change_queues) == 0
@@ -1,4 +1,5 @@
 from pycoinnet.util.debug_help import asyncio
+import time
 
 from pycoinnet.peer.tests.helper import create_handshaked_peers, make_tx
 from pycoinnet.peergroup.InvCollector import InvCollector
@@ -241,6 +242,310 @@ def test_TxCollector_retry():
     assert set(tx.hash() for tx in r) == set(tx.hash() for tx in TX_LIST)
 
 
+def test_fetch_prefers_fastest_peer():
+    peer1_2, peer2 = create_handshaked_peers()
+    peer1_3, peer3 = create_handshaked_peers(ip1="127.0.0.1", ip2="127.0.0.3")
+
+    # peer 3 answers pings quicker, so should be asked first
+    peer1_2.rtt.record(0.5)
+    peer1_3.rtt.record(0.05)
+
+    tx = make_tx(1)
+    getdata_from = []
+
+    @asyncio.coroutine
+    def run_remote_peer(peer, name):
+        next_message = peer.new_get_next_message_f(names=["getdata"])
+        peer.send_msg("inv", items=[InvItem(ITEM_TYPE_TX, tx.hash())])
+        while True:
+            t = yield from next_message()
+            getdata_from.append(name)
+            peer.send_msg("tx", tx=tx)
+
+    @asyncio.coroutine
+    def run_local_peer(peer_list):
+        inv_collector = InvCollector()
+        for peer in peer_list:
+            inv_collector.add_peer(peer)
+        inv_item_q = inv_collector.new_inv_item_queue()
+        inv_item = yield from inv_item_q.get()
+        # give both peers time to announce it
+        yield from asyncio.sleep(0.1)
+        v = yield from inv_collector.fetch(inv_item)
+        return v
+
+    remote_tasks = [asyncio.Task(run_remote_peer(peer2, "peer2")), asyncio.Task(run_remote_peer(peer3, "peer3"))]
+    f = asyncio.Task(run_local_peer([peer1_2, peer1_3]))
+    done, pending = asyncio.get_event_loop().run_until_complete(asyncio.wait([f], timeout=3.0))
+    assert done.pop().result().hash() == tx.hash()
+    assert getdata_from == ["peer3"]
+
+
+def test_forget_disconnected_peer():
+    peer1_2, peer2 = create_handshaked_peers()
+    peer1_3, peer3 = create_handshaked_peers(ip1="127.0.0.1", ip2="127.0.0.3")
+    inv_collector = InvCollector()
+    inv_collector.add_peer(peer1_2)
+    inv_collector.add_peer(peer1_3)
+
+    TX_LIST = [make_tx(i) for i in range(5)]
+    peer2.send_msg("inv", items=[InvItem(ITEM_TYPE_TX, tx.hash()) for tx in TX_LIST])
+    peer3.send_msg("inv", items=[InvItem(ITEM_TYPE_TX, tx.hash()) for tx in TX_LIST[:2]])
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.1))
+    r = inv_collector.memory_usage()
+    assert r["hash_count"] == 5
+    assert r["peer_entry_count"] == 7
+    assert r["peer_count"] == 2
+
+    peer1_2.connection_lost(None)
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.1))
+    r = inv_collector.memory_usage()
+    assert r["peer_entry_count"] == 2
+    assert r["peer_count"] == 1
+    assert r["fetcher_count"] == 1
+    assert set(inv_collector.inv_item_db.get(TX_LIST[0].hash())) == set([peer1_3])
+    peer1_3.connection_lost(None)
+
+
+def test_trickle_announcements():
+    peer1_2, peer2 = create_handshaked_peers()
+    inv_collector = InvCollector()
+    inv_collector.TRICKLE_INTERVAL = 0.05
+    inv_collector.add_peer(peer1_2)
+    TX_LIST = [make_tx(i) for i in range(10)]
+    INV_ITEMS = [InvItem(ITEM_TYPE_TX, tx.hash()) for tx in TX_LIST]
+    next_message = peer2.new_get_next_message_f(names=["inv"])
+
+    # the peer tells us about the first two, so we won't announce those
+    peer2.send_msg("inv", items=INV_ITEMS[:2])
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.05))
+    for inv_item in INV_ITEMS:
+        inv_collector.advertise_item(inv_item)
+    name, data = asyncio.get_event_loop().run_until_complete(asyncio.wait_for(next_message(), timeout=1))
+    assert set(data["items"]) == set(INV_ITEMS[2:])
+
+    # nothing new to say about these
+    for inv_item in INV_ITEMS:
+        inv_collector.advertise_item(inv_item)
+    inv_collector.advertise_item(InvItem(ITEM_TYPE_TX, make_tx(10).hash()))
+    name, data = asyncio.get_event_loop().run_until_complete(asyncio.wait_for(next_message(), timeout=1))
+    assert list(data["items"]) == [InvItem(ITEM_TYPE_TX, make_tx(10).hash())]
+    peer1_2.connection_lost(None)
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.01))
+    assert inv_collector.known_inventory_by_peer == {}
+
+
+def test_fetch_in_flight_limit_and_policy():
+    peer1_2, peer2 = create_handshaked_peers()
+    peer1_3, peer3 = create_handshaked_peers(ip1="127.0.0.1", ip2="127.0.0.3")
+    TX_LIST = [make_tx(i) for i in range(20)]
+    tx_db = dict((tx.hash(), tx) for tx in TX_LIST)
+    outstanding = dict(peer2=0, peer3=0)
+    max_outstanding = dict(peer2=0, peer3=0)
+
+    @asyncio.coroutine
+    def run_remote_peer(peer, name):
+        next_message = peer.new_get_next_message_f(names=["getdata"])
+        peer.send_msg("inv", items=[InvItem(ITEM_TYPE_TX, tx.hash()) for tx in TX_LIST])
+        while True:
+            name_, data = yield from next_message()
+            outstanding[name] += len(data["items"])
+            max_outstanding[name] = max(max_outstanding[name], outstanding[name])
+            yield from asyncio.sleep(0.02)
+            for inv_item in data["items"]:
+                outstanding[name] -= 1
+                peer.send_msg("tx", tx=tx_db[inv_item.data])
+
+    # always pick the peer at .3, if it's a candidate
+    def prefer_peer3(inv_item, candidates):
+        for peer, when in candidates:
+            if peer is peer1_3:
+                return peer
+        return candidates[0][0]
+
+    inv_collector = InvCollector(peer_selection_f=prefer_peer3)
+    inv_collector.request_scheduler.MAX_IN_FLIGHT_PER_PEER = 5
+    inv_collector.add_peer(peer1_2)
+    inv_collector.add_peer(peer1_3)
+    remote_tasks = [asyncio.Task(run_remote_peer(peer2, "peer2")), asyncio.Task(run_remote_peer(peer3, "peer3"))]
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.sleep(0.1))
+    futures = [asyncio.Task(inv_collector.fetch(InvItem(ITEM_TYPE_TX, tx.hash()))) for tx in TX_LIST]
+    loop.run_until_complete(asyncio.wait(futures, timeout=3))
+    assert [f.result().hash() for f in futures] == [tx.hash() for tx in TX_LIST]
+    # the first five went to peer3, the next five to peer2 as peer3 was full
+    assert max_outstanding == dict(peer2=5, peer3=5)
+    scheduler = inv_collector.request_scheduler
+    assert scheduler.requests_sent == 20
+    assert scheduler.request_count() == 0
+    assert scheduler._in_flight_by_peer == {}
+    for peer in [peer1_2, peer1_3]:
+        peer.connection_lost(None)
+
+
+def test_adaptive_peer_timeout():
+    peer1_2, peer2 = create_handshaked_peers()
+    peer1_3, peer3 = create_handshaked_peers(ip1="127.0.0.1", ip2="127.0.0.3")
+    peer1_2.rtt.record(0.01)
+    TX_LIST = [make_tx(i) for i in range(8)]
+    tx_db = dict((tx.hash(), tx) for tx in TX_LIST)
+
+    @asyncio.coroutine
+    def run_remote_peer(peer, stall_on):
+        # answers quickly, except for stall_on, which it never sends
+        next_message = peer.new_get_next_message_f(names=["getdata"])
+        peer.send_msg("inv", items=[InvItem(ITEM_TYPE_TX, tx.hash()) for tx in TX_LIST])
+        while True:
+            name, data = yield from next_message()
+            yield from asyncio.sleep(0.01)
+            for inv_item in data["items"]:
+                if inv_item.data != stall_on:
+                    peer.send_msg("tx", tx=tx_db[inv_item.data])
+
+    inv_collector = InvCollector()
+    inv_collector.add_peer(peer1_2)
+    inv_collector.add_peer(peer1_3)
+    remote_tasks = [
+        asyncio.Task(run_remote_peer(peer2, TX_LIST[-1].hash())),
+        asyncio.Task(run_remote_peer(peer3, None))]
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.sleep(0.1))
+    scheduler = inv_collector.request_scheduler
+    for tx in TX_LIST[:-1]:
+        v = loop.run_until_complete(inv_collector.fetch(InvItem(ITEM_TYPE_TX, tx.hash())))
+        assert v.hash() == tx.hash()
+    # peer2 is quick, so we won't wait anything like peer_timeout for it
+    timeout = scheduler.peer_timeout(peer1_2, ITEM_TYPE_TX, peer_timeout=10)
+    assert scheduler.MIN_PEER_TIMEOUT <= timeout < 1
+    assert scheduler.peer_timeout(peer1_3, ITEM_TYPE_TX, peer_timeout=10) == 10
+    stats = scheduler.response_time_snapshot()[peer1_2][ITEM_TYPE_TX]
+    assert stats["count"] == 7
+    assert stats["timeout"] == timeout
+
+    # peer2 stalls on this one, so peer3 is asked long before 10 s
+    start = loop.time()
+    v = loop.run_until_complete(asyncio.wait_for(
+        inv_collector.fetch(InvItem(ITEM_TYPE_TX, TX_LIST[-1].hash()), peer_timeout=10), timeout=2))
+    assert v.hash() == TX_LIST[-1].hash()
+    assert loop.time() - start < timeout + 0.5
+    assert scheduler.requests_timed_out == 1
+    for peer in [peer1_2, peer1_3]:
+        peer.connection_lost(None)
+
+
+def test_fetch_validate_store_dedup():
+    peer1_2, peer2 = create_handshaked_peers()
+    tx = make_tx(1)
+    inv_item = InvItem(ITEM_TYPE_TX, tx.hash())
+    getdata_count = []
+
+    @asyncio.coroutine
+    def run_remote_peer(peer):
+        next_message = peer.new_get_next_message_f(names=["getdata"])
+        peer.send_msg("inv", items=[inv_item])
+        while True:
+            name, data = yield from next_message()
+            getdata_count.append(len(data["items"]))
+            yield from asyncio.sleep(0.05)
+            peer.send_msg("tx", tx=tx)
+
+    inv_collector = InvCollector()
+    inv_collector.add_peer(peer1_2)
+    remote_task = asyncio.Task(run_remote_peer(peer2))
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.sleep(0.1))
+    tx_store = {}
+    validated = []
+
+    def validator(tx):
+        validated.append(tx)
+        return True
+    futures = [inv_collector.fetch_validate_store_item_async(inv_item, tx_store, validator) for i in range(3)]
+    fetch_task = asyncio.Task(inv_collector.fetch(inv_item))
+    assert futures[0] is futures[1] is futures[2]
+    # driven by callbacks, not a task per item
+    assert not isinstance(futures[0], asyncio.Task)
+    loop.run_until_complete(asyncio.wait(futures + [fetch_task], timeout=2))
+    assert futures[0].result().hash() == tx.hash()
+    assert fetch_task.result().hash() == tx.hash()
+    assert list(tx_store.keys()) == [tx.hash()]
+    assert len(validated) == 1
+    assert getdata_count == [1]
+    stats = inv_collector.in_flight_stats()
+    assert stats["started_count"] == 1
+    assert stats["duplicate_count"] == 2
+    assert stats["duplicate_bytes"] > 0
+    assert stats["fetches_started"] == 1
+    assert stats["fetches_joined"] == 1
+    assert stats["in_flight_count"] == 0
+    peer1_2.connection_lost(None)
+
+
+def test_fetch_gives_up_when_no_peer_has_it():
+    peer1_2, peer2 = create_handshaked_peers()
+    tx = make_tx(1)
+    inv_item = InvItem(ITEM_TYPE_TX, tx.hash())
+
+    @asyncio.coroutine
+    def run_remote_peer(peer):
+        next_message = peer.new_get_next_message_f(names=["getdata"])
+        peer.send_msg("inv", items=[inv_item])
+        while True:
+            name, data = yield from next_message()
+            peer.send_msg("notfound", items=data["items"])
+
+    inv_collector = InvCollector()
+    inv_collector.add_peer(peer1_2)
+    remote_task = asyncio.Task(run_remote_peer(peer2))
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.sleep(0.1))
+    scheduler = inv_collector.request_scheduler
+
+    # the only peer says notfound, and nobody else announces it
+    fetch_task = asyncio.Task(inv_collector.fetch(inv_item, peer_timeout=0.2))
+    loop.run_until_complete(asyncio.wait([fetch_task], timeout=2))
+    assert fetch_task.result() is None
+    assert scheduler.request_count() == 0
+    assert len(scheduler._waiting) == 0
+    assert scheduler.requests_given_up == 1
+
+    # a request waiting for a peer gives up when the hash expires
+    future = inv_collector.fetch_validate_store_item_async(inv_item, {}, lambda tx: True)
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert len(scheduler._waiting) == 1
+    inv_collector.inv_item_db.expire(now=time.time() + 2 * inv_collector.INV_ITEM_MAX_AGE)
+    loop.run_until_complete(asyncio.wait([future], timeout=2))
+    assert future.result() is None
+    assert scheduler.request_count() == 0
+    assert len(scheduler._waiting) == 0
+    assert inv_collector.in_flight_stats()["in_flight_count"] == 0
+    peer1_2.connection_lost(None)
+
+
+def test_fetch_validate_store_cancel():
+    peer1_2, peer2 = create_handshaked_peers()
+    tx = make_tx(1)
+    inv_item = InvItem(ITEM_TYPE_TX, tx.hash())
+
+    # announce, but never answer
+    peer2.send_msg("inv", items=[inv_item])
+    inv_collector = InvCollector()
+    inv_collector.add_peer(peer1_2)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.sleep(0.1))
+
+    future = inv_collector.fetch_validate_store_item_async(inv_item, {}, lambda tx: True)
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert inv_collector.request_scheduler.request_count() == 1
+    assert inv_collector.fetcher_for_peer(peer1_2).futures != {}
+    future.cancel()
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert inv_collector.request_scheduler.request_count() == 0
+    assert inv_collector.fetcher_for_peer(peer1_2).futures == {}
+    assert inv_collector.in_flight_stats()["in_flight_count"] == 0
+    peer1_2.connection_lost(None)
+
+
 import logging
 asyncio.tasks._DEBUG = True
 logging.basicConfig(
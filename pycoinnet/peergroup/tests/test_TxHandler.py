@@ -3,6 +3,7 @@ from pycoinnet.util.debug_help import asyncio
 from pycoinnet.peer.tests.helper import create_handshaked_peers, make_tx
 from pycoinnet.peergroup.InvCollector import InvCollector
 from pycoinnet.peergroup.TxHandler import TxHandler
+from pycoinnet.util.Mempool import Mempool
 
 from pycoinnet.peer.BitcoinPeerProtocol import BitcoinPeerProtocol
 
@@ -41,6 +42,68 @@ def test_TxHandler_simple():
         assert set(tx.hash() for tx in r.values()) == set(tx.hash() for tx in TX_LIST)
 
 
+def test_TxHandler_coroutine_validator():
+    peer1_2, peer2_1 = create_handshaked_peers(ip1="127.0.0.1", ip2="127.0.0.2")
+    TX_LIST = [make_tx(i) for i in range(10)]
+    bad_hashes = set(tx.hash() for tx in TX_LIST[::3])
+
+    @asyncio.coroutine
+    def tx_validator(tx):
+        yield from asyncio.sleep(0.01)
+        return tx.hash() not in bad_hashes
+
+    tx_store_1 = {}
+    inv_collector_1 = InvCollector()
+    tx_handler_1 = TxHandler(inv_collector_1, tx_store_1, tx_validator=tx_validator)
+    tx_store_2 = {}
+    inv_collector_2 = InvCollector()
+    tx_handler_2 = TxHandler(inv_collector_2, tx_store_2)
+    for tx in TX_LIST:
+        tx_handler_2.add_tx(tx)
+    for inv_collector, tx_handler, peer in [(inv_collector_1, tx_handler_1, peer1_2), (inv_collector_2, tx_handler_2, peer2_1)]:
+        inv_collector.add_peer(peer)
+        tx_handler.add_peer(peer)
+
+    @asyncio.coroutine
+    def wait_for_txs():
+        while len(tx_store_1) < 6:
+            yield from asyncio.sleep(0.1)
+    asyncio.get_event_loop().run_until_complete(asyncio.wait_for(wait_for_txs(), timeout=5))
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.1))
+    assert set(tx_store_1.keys()) == set(tx.hash() for tx in TX_LIST) - bad_hashes
+
+
+def test_TxHandler_mempool_rejects():
+    peer1_2, peer2_1 = create_handshaked_peers(ip1="127.0.0.1", ip2="127.0.0.2")
+    TX_LIST = [make_tx(i) for i in range(2)]
+
+    # too small to hold any tx
+    mempool = Mempool(max_bytes=10)
+    inv_collector_1 = InvCollector()
+    advertised = []
+    inv_collector_1.advertise_item = advertised.append
+    tx_handler_1 = TxHandler(inv_collector_1, mempool)
+    assert not tx_handler_1.add_tx(TX_LIST[0])
+
+    tx_store_2 = {}
+    inv_collector_2 = InvCollector()
+    tx_handler_2 = TxHandler(inv_collector_2, tx_store_2)
+    assert tx_handler_2.add_tx(TX_LIST[1])
+    for inv_collector, tx_handler, peer in [(inv_collector_1, tx_handler_1, peer1_2), (inv_collector_2, tx_handler_2, peer2_1)]:
+        inv_collector.add_peer(peer)
+        tx_handler.add_peer(peer)
+
+    @asyncio.coroutine
+    def wait_for_fetch():
+        while inv_collector_1.in_flight.started_count == 0 or len(inv_collector_1.in_flight) > 0:
+            yield from asyncio.sleep(0.05)
+    asyncio.get_event_loop().run_until_complete(asyncio.wait_for(wait_for_fetch(), timeout=5))
+    # fetched, but the mempool turned it away, so it's not advertised
+    assert inv_collector_1.fetcher_for_peer(peer1_2).items_received == 1
+    assert len(mempool) == 0
+    assert advertised == []
+
+
 import logging
 asyncio.tasks._DEBUG = True
 logging.basicConfig(
@@ -0,0 +1,72 @@
+from pycoinnet.util.debug_help import asyncio
+
+from concurrent.futures import ProcessPoolExecutor
+
+from pycoinnet.peer.tests.helper import make_tx
+from pycoinnet.peergroup.TxValidationPipeline import TxValidationPipeline
+
+
+def check_tx(tx, unspents):
+    # runs in a worker process
+    return unspents == tx.id()
+
+
+def test_TxValidationPipeline():
+    TX_LIST = [make_tx(i) for i in range(25)]
+    bad_ids = set(tx.id() for tx in TX_LIST[::5])
+
+    def unspents_f(tx):
+        return None if tx.id() in bad_ids else tx.id()
+
+    executor = ProcessPoolExecutor(max_workers=2)
+    pipeline = TxValidationPipeline(
+        check_tx, unspents_f=unspents_f, executor=executor,
+        max_batch_size=4, max_queue_size=8, max_batches_in_flight=2)
+
+    @asyncio.coroutine
+    def run():
+        tasks = [asyncio.Task(pipeline.validate(tx)) for tx in TX_LIST]
+        yield from asyncio.sleep(0)
+        # the queue is bounded
+        assert pipeline.queue_size() <= 8
+        return (yield from asyncio.gather(*tasks))
+
+    r = asyncio.get_event_loop().run_until_complete(asyncio.wait_for(run(), timeout=30))
+    assert r == [tx.id() not in bad_ids for tx in TX_LIST]
+    assert pipeline.tx_count == 25
+    assert pipeline.invalid_count == 5
+    assert 7 <= pipeline.batch_count < 25
+    pipeline.close()
+    executor.shutdown()
+
+
+def test_TxValidationPipeline_cancelled():
+    TX_LIST = [make_tx(i) for i in range(5)]
+    prepared = []
+
+    def unspents_f(tx):
+        prepared.append(tx.id())
+        return tx.id()
+
+    executor = ProcessPoolExecutor(max_workers=1)
+    pipeline = TxValidationPipeline(
+        check_tx, unspents_f=unspents_f, executor=executor,
+        max_batch_size=1, max_batches_in_flight=1)
+
+    @asyncio.coroutine
+    def run():
+        tasks = [asyncio.Task(pipeline.validate(tx)) for tx in TX_LIST]
+        yield from asyncio.sleep(0)
+        # the first is being worked on; give up on the rest
+        for task in tasks[1:]:
+            task.cancel()
+        r = yield from tasks[0]
+        yield from asyncio.sleep(0.1)
+        return r
+
+    assert asyncio.get_event_loop().run_until_complete(asyncio.wait_for(run(), timeout=30))
+    assert prepared == [TX_LIST[0].id()]
+    assert pipeline.tx_count == 1
+    assert pipeline.batch_count == 1
+    pipeline.close()
+    executor.shutdown()
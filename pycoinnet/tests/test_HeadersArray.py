@@ -0,0 +1,57 @@
+from pycoin.block import BlockHeader
+
+from pycoinnet.HeadersArray import HeadersArray
+from pycoinnet.message import pack_from_data
+from pycoinnet.util.BlockChain import BlockChain
+
+from pycoinnet.peer.tests.helper import make_blocks
+
+
+def headers_for_blocks(blocks):
+    return [BlockHeader(b.version, b.previous_block_hash, b.merkle_root, b.timestamp, b.difficulty, b.nonce)
+            for b in blocks]
+
+
+def test_HeadersArray():
+    headers = headers_for_blocks(make_blocks(20))
+    payload = pack_from_data("headers", headers=[(h, 0) for h in headers])
+    headers_array = HeadersArray.from_payload(memoryview(payload))
+    assert len(headers_array) == 20
+    assert headers_array.hashes() == [h.hash() for h in headers]
+    assert headers_array.previous_block_hashes() == [h.previous_block_hash for h in headers]
+    assert headers_array.difficulties() == [h.difficulty for h in headers]
+    assert [h.hash() for h in headers_array] == [h.hash() for h in headers]
+    assert headers_array[5].hash() == headers[5].hash()
+
+    bc1 = BlockChain()
+    bc1.add_nodes(headers_array.hash_parent_weight_tuples())
+    bc2 = BlockChain()
+    bc2.add_headers(headers)
+    assert bc1.length() == bc2.length() == 20
+    assert bc1.last_block_hash() == bc2.last_block_hash() == headers[-1].hash()
+
+
+def test_HeadersArray_long_tx_count():
+    headers = headers_for_blocks(make_blocks(3))
+    # a tx count that needs more than one byte forces the slow path
+    payload = pack_from_data("headers", headers=[(headers[0], 0), (headers[1], 300), (headers[2], 0)])
+    headers_array = HeadersArray.from_payload(payload)
+    assert headers_array.hashes() == [h.hash() for h in headers]
+    assert headers_array.difficulties() == [h.difficulty for h in headers]
+
+
+def test_HeadersArray_empty():
+    headers_array = HeadersArray.from_payload(b'\0')
+    assert len(headers_array) == 0
+    assert list(headers_array.hash_parent_weight_tuples()) == []
+
+
+def test_HeadersArray_truncated():
+    headers = headers_for_blocks(make_blocks(2))
+    payload = pack_from_data("headers", headers=[(h, 0) for h in headers])
+    for bad_payload in [b'', b'\x02' + b'\0' * 100, b'\x01' + b'\0' * 80 + b'\xfd', payload[:-1], payload[:-82]]:
+        try:
+            HeadersArray.from_payload(bad_payload)
+            assert False, "expected ValueError for %r" % bad_payload
+        except ValueError:
+            pass
@@ -0,0 +1,75 @@
+import io
+
+from pycoin.block import Block, BadMerkleRootError
+
+from pycoinnet.LazyBlock import LazyBlock
+from pycoinnet.message import parse_from_data, pack_from_data
+
+from pycoinnet.peer.tests.helper import make_block
+
+
+def block_bin(block):
+    f = io.BytesIO()
+    block.stream(f)
+    return f.getvalue()
+
+
+def test_LazyBlock():
+    block = make_block(2)
+    blob = block_bin(block)
+    lazy_block = LazyBlock.parse(io.BytesIO(blob))
+    assert not lazy_block.is_parsed()
+    assert lazy_block.hash() == block.hash()
+    assert lazy_block.previous_block_hash == block.previous_block_hash
+    assert lazy_block.difficulty == block.difficulty
+    assert lazy_block.tx_count() == len(block.txs)
+    assert not lazy_block.is_parsed()
+
+    # streaming copies the original bytes without parsing anything
+    assert block_bin(lazy_block) == blob
+    assert not lazy_block.is_parsed()
+
+    assert [tx.hash() for tx in lazy_block.txs] == [tx.hash() for tx in block.txs]
+    assert lazy_block.is_parsed()
+
+
+def test_LazyBlock_init():
+    block = make_block(3)
+    lazy_block = LazyBlock(
+        block.version, block.previous_block_hash, block.merkle_root,
+        block.timestamp, block.difficulty, block.nonce, block.txs)
+    assert lazy_block.hash() == block.hash()
+    assert block_bin(lazy_block) == block_bin(block)
+
+
+def test_LazyBlock_check_txs():
+    block = make_block(5)
+    blob = block_bin(block)
+    lazy_block = LazyBlock.from_bin(blob)
+    lazy_block.check_txs()
+    assert lazy_block.is_parsed()
+    lazy_block.check_txs()
+
+    def fails(blob, exception):
+        try:
+            LazyBlock.from_bin(blob).check_txs()
+        except exception:
+            return True
+        return False
+
+    # merkle root doesn't match
+    assert fails(blob[:36] + b'\1' * 32 + blob[68:], BadMerkleRootError)
+    # junk after the last tx
+    assert fails(blob + b'\0', ValueError)
+    # truncated tx
+    assert fails(blob[:-1], ValueError)
+
+
+def test_block_message():
+    block = make_block(4)
+    d = parse_from_data("block", pack_from_data("block", block=block))
+    lazy_block = d["block"]
+    assert isinstance(lazy_block, LazyBlock)
+    assert not lazy_block.is_parsed()
+    assert lazy_block.hash() == block.hash()
+    assert block_bin(Block.parse(io.BytesIO(block_bin(lazy_block)))) == block_bin(block)
@@ -0,0 +1,105 @@
+import io
+
+from pycoinnet.InvItem import InvItem, ITEM_TYPE_TX, ITEM_TYPE_BLOCK
+from pycoinnet.PeerAddress import PeerAddress
+from pycoinnet.message import _compile_codec, parse_from_data, pack_from_data
+
+from pycoinnet.peer.tests.helper import make_hash, make_tx, make_block
+
+
+def test_compile_codec_fixed_width_run():
+    parse_f, stream_f = _compile_codec("version:L nonce:Q hash:# flags:L")
+    d = dict(version=1, nonce=2**63, hash=make_hash(1), flags=7)
+    f = io.BytesIO()
+    stream_f(f, d)
+    data = f.getvalue()
+    assert len(data) == 4 + 8 + 32 + 4
+    assert parse_f(io.BytesIO(data)) == d
+
+
+def test_round_trip_simple():
+    for name, kwargs in [
+        ("ping", dict(nonce=1234567)),
+        ("pong", dict(nonce=0)),
+        ("getheaders", dict(version=1, hashes=(make_hash(1), make_hash(2)), hash_stop=b'\0' * 32)),
+        ("inv", dict(items=tuple(InvItem(ITEM_TYPE_TX, make_hash(i)) for i in range(20)))),
+        ("getdata", dict(items=(InvItem(ITEM_TYPE_BLOCK, make_hash(3)),))),
+        ("notfound", dict(items=())),
+    ]:
+        data = pack_from_data(name, **kwargs)
+        assert parse_from_data(name, data) == kwargs
+
+
+def test_empty_messages():
+    for name in ["verack", "getaddr", "mempool", "filterclear"]:
+        assert pack_from_data(name) == b''
+        assert parse_from_data(name, b'') == {}
+
+
+def test_addr():
+    tuples = tuple((1392760610 + i, PeerAddress(1, "10.0.0.%d" % i, 8333)) for i in range(5))
+    data = pack_from_data("addr", date_address_tuples=tuples)
+    assert len(data) == 1 + 5 * 30
+    d = parse_from_data("addr", data)
+    assert d == dict(date_address_tuples=tuples)
+
+
+def test_tx_and_block():
+    tx = make_tx(5)
+    d = parse_from_data("tx", pack_from_data("tx", tx=tx))
+    assert d["tx"].hash() == tx.hash()
+    block = make_block(1)
+    d = parse_from_data("block", pack_from_data("block", block=block))
+    assert d["block"].hash() == block.hash()
+    assert [t.hash() for t in d["block"].txs] == [t.hash() for t in block.txs]
+
+
+def test_bulk_inv_and_addr():
+    items = tuple(InvItem(ITEM_TYPE_TX if i % 2 else ITEM_TYPE_BLOCK, make_hash(i)) for i in range(1000))
+    data = pack_from_data("inv", items=items)
+    assert len(data) == 3 + 36 * 1000
+    assert parse_from_data("inv", data) == dict(items=items)
+
+    tuples = tuple((i, PeerAddress(i, "10.1.%d.%d" % (i // 256, i % 256), 8000 + i)) for i in range(600))
+    tuples += ((5, PeerAddress(1, "2001:db8::1", 18333)),)
+    data = pack_from_data("addr", date_address_tuples=tuples)
+    d = parse_from_data("addr", data)
+    assert d == dict(date_address_tuples=tuples)
+    # the ipaddress objects are only made on demand
+    pa = d["date_address_tuples"][-1][1]
+    assert pa._ip_address is None
+    assert pa.host() == "2001:0db8:0000:0000:0000:0000:0000:0001"
+    assert d["date_address_tuples"][3][1].host() == "10.1.0.3"
+    assert d["date_address_tuples"][3][1].port == 8003
+
+
+def test_truncated_arrays():
+    items = tuple(InvItem(ITEM_TYPE_TX, make_hash(i)) for i in range(3))
+    data = pack_from_data("inv", items=items)
+    try:
+        parse_from_data("inv", data[:-36])
+        assert False, "should have raised"
+    except ValueError:
+        pass
+
+    tuples = tuple((i, PeerAddress(1, "10.0.0.%d" % i, 8333)) for i in range(3))
+    data = pack_from_data("addr", date_address_tuples=tuples)
+    try:
+        parse_from_data("addr", data[:-30])
+        assert False, "should have raised"
+    except ValueError:
+        pass
+
+    data = pack_from_data("getheaders", version=1, hashes=[make_hash(i) for i in range(3)], hash_stop=make_hash(4))
+    try:
+        parse_from_data("getheaders", data[:-64])
+        assert False, "should have raised"
+    except ValueError:
+        pass
+
+
+def test_wrapped_array_items():
+    hashes = [make_hash(i) for i in range(3)]
+    data = pack_from_data("getheaders", version=1, hashes=hashes, hash_stop=make_hash(4))
+    assert pack_from_data("getheaders", version=1, hashes=[(h,) for h in hashes], hash_stop=make_hash(4)) == data
+    assert parse_from_data("getheaders", data)["hashes"] == tuple(hashes)
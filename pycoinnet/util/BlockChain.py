@@ -1,26 +1,64 @@
+import asyncio
+import collections
 import logging
 import weakref
 
-from asyncio import Queue
-
 from pycoinnet.util.ChainFinder import ChainFinder
 
 ZERO_HASH = b'\0' * 32
 
 
-def _update_q(q, ops):
-    # first, we meld out complimentary adds and removes
-    while len(ops) > 0:
-        op = ops[0]
-        if op[0] != 'remove':
-            break
-        last = q.pop()
-        if op[1:] != last[1:]:
-            q.put_nowait(last)
-            break
-        ops = ops[1:]
-    for op in ops:
-        q.put_nowait(op)
+class ChangeQueue:
+    """
+    The ("add"/"remove", the_hash, the_index) changes to a BlockChain, for
+    one consumer, with the asyncio.Queue methods consumers use. A remove
+    that undoes the newest pending add cancels it out instead of being
+    queued.
+    """
+    def __init__(self):
+        self._ops = collections.deque()
+        self._not_empty = asyncio.Event()
+
+    def qsize(self):
+        return len(self._ops)
+
+    def empty(self):
+        return not self._ops
+
+    def put_nowait(self, op):
+        self._ops.append(op)
+        self._not_empty.set()
+
+    def get_nowait(self):
+        if not self._ops:
+            raise asyncio.QueueEmpty()
+        op = self._ops.popleft()
+        if not self._ops:
+            self._not_empty.clear()
+        return op
+
+    @asyncio.coroutine
+    def get(self):
+        while not self._ops:
+            yield from self._not_empty.wait()
+        return self.get_nowait()
+
+    def update(self, ops):
+        # first, we meld out complimentary adds and removes
+        while len(ops) > 0:
+            op = ops[0]
+            if op[0] != 'remove' or not self._ops:
+                break
+            if op[1:] != self._ops[-1][1:]:
+                break
+            self._ops.pop()
+            ops = ops[1:]
+        for op in ops:
+            self._ops.append(op)
+        if self._ops:
+            self._not_empty.set()
+        else:
+            self._not_empty.clear()
 
 
 class BlockChain:
@@ -70,7 +108,7 @@ class BlockChain:
         return self.hash_to_index_lookup.get(the_hash)
 
     def new_change_q(self):
-        q = Queue()
+        q = ChangeQueue()
         self.change_queues.add(q)
         return q
 
@@ -166,6 +204,6 @@ class BlockChain:
             ops.append(op)
             self.hash_to_index_lookup[size-idx-1] = h
         for q in self.change_queues:
-            _update_q(q, ops)
+            q.update(ops)
 
         return ops
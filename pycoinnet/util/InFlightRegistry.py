@@ -0,0 +1,75 @@
+"""
+InFlightRegistry.py
+
+Keep at most one future per hash for work that's under way, so everyone
+who wants the same item waits for the same fetch.
+
+Futures are dropped once they're done. Counts are kept of how many
+futures were started, and how many callers (and, once the item arrived,
+bytes) joined one already under way instead of starting their own.
+"""
+
+import io
+
+
+def _item_size(item):
+    # a LazyBlock keeps its serialized bytes, so don't stream it again
+    as_bin = getattr(item, "as_bin", None)
+    if as_bin:
+        return len(as_bin())
+    f = io.BytesIO()
+    item.stream(f)
+    return len(f.getvalue())
+
+
+class InFlightRegistry:
+    def __init__(self):
+        # key: hash; value: future
+        self.futures = {}
+        # key: hash; value: count of callers that joined its future
+        self._joined_counts = {}
+
+        ## stats
+        self.started_count = 0
+        self.duplicate_count = 0
+        self.duplicate_bytes = 0
+
+    def __contains__(self, the_hash):
+        return the_hash in self.futures
+
+    def __len__(self):
+        return len(self.futures)
+
+    def get_or_start(self, the_hash, start_f):
+        """
+        Return the future for the_hash. If there isn't one, call start_f to
+        create it. The future's result should be the item, or None.
+        """
+        future = self.futures.get(the_hash)
+        if future:
+            self.duplicate_count += 1
+            self._joined_counts[the_hash] += 1
+            return future
+        future = start_f()
+        self.futures[the_hash] = future
+        self._joined_counts[the_hash] = 0
+        self.started_count += 1
+        future.add_done_callback(lambda f: self._forget(the_hash, f))
+        return future
+
+    def _forget(self, the_hash, future):
+        if self.futures.get(the_hash) is not future:
+            return
+        del self.futures[the_hash]
+        joined_count = self._joined_counts.pop(the_hash)
+        if joined_count == 0 or future.cancelled() or future.exception():
+            return
+        item = future.result()
+        if item:
+            # sized once, however many joined
+            self.duplicate_bytes += joined_count * _item_size(item)
+
+    def stats(self):
+        return dict(
+            in_flight_count=len(self.futures), started_count=self.started_count,
+            duplicate_count=self.duplicate_count, duplicate_bytes=self.duplicate_bytes)
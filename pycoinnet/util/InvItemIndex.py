@@ -0,0 +1,129 @@
+"""
+InvItemIndex.py
+
+Remember which peers have announced which hashes, and when.
+
+Entries expire max_age seconds after the hash was last announced, and
+once there are more than max_count hashes, the least recently announced
+ones are dropped, and did_drop_hash_f(the_hash) is called if it's set.
+Everything a peer announced can be dropped at once when it disconnects.
+"""
+
+import collections
+import sys
+import time
+
+
+class InvItemIndex:
+    def __init__(self, max_count=200000, max_age=3600, did_drop_hash_f=None):
+        self.max_count = max_count
+        self.max_age = max_age
+        self.did_drop_hash_f = did_drop_hash_f
+        # key: hash; value: dictionary of peers to timestamps
+        # ordered from least to most recently announced
+        self._peers_by_hash = collections.OrderedDict()
+        # key: hash; value: time last announced
+        self._last_seen = {}
+        # key: peer; value: set of hashes it announced
+        self._hashes_by_peer = {}
+
+        ## stats
+        self.expired_count = 0
+        self.evicted_count = 0
+
+    def __contains__(self, the_hash):
+        return the_hash in self._peers_by_hash
+
+    def __len__(self):
+        return len(self._peers_by_hash)
+
+    def get(self, the_hash, default=None):
+        """
+        Return a dictionary of peers to the time each announced the_hash.
+        """
+        return self._peers_by_hash.get(the_hash, default)
+
+    def add(self, the_hash, peer, when=None):
+        """
+        Note that peer announced the_hash. Return True if the hash is new.
+        """
+        if when is None:
+            when = time.time()
+        self.expire(when)
+        peers = self._peers_by_hash.get(the_hash)
+        is_new = peers is None
+        if is_new:
+            peers = self._peers_by_hash[the_hash] = {}
+            while len(self._peers_by_hash) > self.max_count:
+                self._drop(next(iter(self._peers_by_hash)))
+                self.evicted_count += 1
+        else:
+            self._peers_by_hash.move_to_end(the_hash)
+        peers[peer] = when
+        self._last_seen[the_hash] = when
+        self._hashes_by_peer.setdefault(peer, set()).add(the_hash)
+        return is_new
+
+    def remove(self, the_hash, peer):
+        """
+        Forget that peer announced the_hash.
+        """
+        peers = self._peers_by_hash.get(the_hash)
+        if peers:
+            peers.pop(peer, None)
+        self._forget_hash_for_peer(the_hash, peer)
+
+    def remove_peer(self, peer):
+        """
+        Forget everything peer announced.
+        """
+        for the_hash in self._hashes_by_peer.pop(peer, []):
+            peers = self._peers_by_hash.get(the_hash)
+            if peers:
+                peers.pop(peer, None)
+
+    def expire(self, now=None):
+        """
+        Drop hashes not announced in the last max_age seconds.
+        """
+        if now is None:
+            now = time.time()
+        cutoff = now - self.max_age
+        while self._peers_by_hash:
+            the_hash = next(iter(self._peers_by_hash))
+            if self._last_seen[the_hash] > cutoff:
+                break
+            self._drop(the_hash)
+            self.expired_count += 1
+
+    def _drop(self, the_hash):
+        peers = self._peers_by_hash.pop(the_hash)
+        del self._last_seen[the_hash]
+        for peer in peers:
+            self._forget_hash_for_peer(the_hash, peer)
+        if self.did_drop_hash_f:
+            self.did_drop_hash_f(the_hash)
+
+    def _forget_hash_for_peer(self, the_hash, peer):
+        hashes = self._hashes_by_peer.get(peer)
+        if hashes is not None:
+            hashes.discard(the_hash)
+            if not hashes:
+                del self._hashes_by_peer[peer]
+
+    def memory_usage(self):
+        """
+        Return a dictionary of entry counts, and a rough estimate of the
+        bytes used by the containers and the entries in them.
+        """
+        peer_entry_count = sum(len(peers) for peers in self._peers_by_hash.values())
+        size = sys.getsizeof(self._peers_by_hash) + sys.getsizeof(self._last_seen)
+        size += sys.getsizeof(self._hashes_by_peer)
+        for the_hash, peers in self._peers_by_hash.items():
+            size += sys.getsizeof(the_hash) + sys.getsizeof(peers)
+        for hashes in self._hashes_by_peer.values():
+            size += sys.getsizeof(hashes)
+        return dict(
+            hash_count=len(self._peers_by_hash), peer_count=len(self._hashes_by_peer),
+            peer_entry_count=peer_entry_count, approximate_bytes=size,
+            expired_count=self.expired_count, evicted_count=self.evicted_count)
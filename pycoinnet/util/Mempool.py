@@ -0,0 +1,141 @@
+"""
+Mempool.py
+
+A dictionary of transaction hash to Tx, usable as a TxHandler tx_store,
+that keeps its memory use bounded.
+
+Each tx's size and fee are worked out once, when it's added. Once the
+txs add up to more than max_bytes, the ones with the lowest fee per
+byte are evicted, and txs older than max_age seconds are expired.
+
+The fee comes from fee_f(tx), or can be given to add. The default fee_f
+says 0, so with no fees known, the oldest txs go first.
+
+Adding and removing are O(log n). Evictions are found with a heap of fee
+rates; entries for txs removed some other way are skipped when they come
+up, and the heap is rebuilt when they outnumber the live ones.
+"""
+
+import collections
+import collections.abc
+import heapq
+import io
+import time
+
+
+class MempoolEntry:
+    __slots__ = ("tx", "size", "fee", "fee_rate", "added_at", "sequence")
+
+    def __init__(self, tx, size, fee, added_at, sequence):
+        self.tx = tx
+        self.size = size
+        self.fee = fee
+        self.fee_rate = fee / size
+        self.added_at = added_at
+        self.sequence = sequence
+
+
+def _tx_size(tx):
+    f = io.BytesIO()
+    tx.stream(f)
+    return len(f.getvalue())
+
+
+class Mempool(collections.abc.MutableMapping):
+    def __init__(self, max_bytes=300*1024*1024, max_age=14*24*3600, fee_f=lambda tx: 0):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fee_f = fee_f
+        # key: hash; value: MempoolEntry, oldest first
+        self.entries = collections.OrderedDict()
+        # heap of (fee_rate, sequence, hash)
+        self._by_fee_rate = []
+        self._sequence = 0
+        self.total_bytes = 0
+
+        ## stats
+        self.evicted_count = 0
+        self.expired_count = 0
+
+    def __getitem__(self, the_hash):
+        return self.entries[the_hash].tx
+
+    def __setitem__(self, the_hash, tx):
+        self.add(tx, the_hash=the_hash)
+
+    def __delitem__(self, the_hash):
+        entry = self.entries.pop(the_hash)
+        self.total_bytes -= entry.size
+        self._compact()
+
+    def __contains__(self, the_hash):
+        return the_hash in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, tx, fee=None, the_hash=None, now=None):
+        """
+        Add tx, paying fee, then evict and expire txs as needed. Return False
+        if tx was evicted right away, because its fee rate is too low.
+        """
+        if the_hash is None:
+            the_hash = tx.hash()
+        if now is None:
+            now = time.time()
+        if fee is None:
+            fee = self.fee_f(tx)
+        if the_hash in self.entries:
+            del self[the_hash]
+        self._sequence += 1
+        entry = MempoolEntry(tx, _tx_size(tx), fee, now, self._sequence)
+        self.entries[the_hash] = entry
+        self.total_bytes += entry.size
+        heapq.heappush(self._by_fee_rate, (entry.fee_rate, entry.sequence, the_hash))
+        self.expire(now)
+        self._evict()
+        return the_hash in self.entries
+
+    def size_for_hash(self, the_hash):
+        return self.entries[the_hash].size
+
+    def fee_rate_for_hash(self, the_hash):
+        return self.entries[the_hash].fee_rate
+
+    def expire(self, now=None):
+        """
+        Remove txs that have been here longer than max_age seconds.
+        """
+        if now is None:
+            now = time.time()
+        cutoff = now - self.max_age
+        while self.entries:
+            the_hash, entry = next(iter(self.entries.items()))
+            if entry.added_at > cutoff:
+                break
+            del self[the_hash]
+            self.expired_count += 1
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            fee_rate, sequence, the_hash = heapq.heappop(self._by_fee_rate)
+            entry = self.entries.get(the_hash)
+            if entry is None or entry.sequence != sequence:
+                continue
+            del self[the_hash]
+            self.evicted_count += 1
+
+    def _compact(self):
+        # drop heap entries for txs that are gone, once they're the majority
+        if len(self._by_fee_rate) > 2 * len(self.entries) + 16:
+            self._by_fee_rate = [
+                (entry.fee_rate, entry.sequence, the_hash) for the_hash, entry in self.entries.items()]
+            heapq.heapify(self._by_fee_rate)
+
+    def stats(self):
+        return dict(
+            count=len(self.entries), total_bytes=self.total_bytes,
+            evicted_count=self.evicted_count, expired_count=self.expired_count)
@@ -0,0 +1,29 @@
+"""
+A set that remembers roughly the last `capacity` items added to it.
+
+Items are added to the current generation. When it holds capacity/2
+items, it becomes the old generation, and the old one is dropped. So
+between capacity/2 and capacity of the most recently added items are
+remembered, and adding and lookups are O(1).
+"""
+
+
+class RollingHashSet:
+    def __init__(self, capacity=50000):
+        self.generation_size = max(1, capacity // 2)
+        self.current = set()
+        self.old = set()
+
+    def add(self, item):
+        if item in self.current:
+            return
+        self.current.add(item)
+        if len(self.current) >= self.generation_size:
+            self.old = self.current
+            self.current = set()
+
+    def __contains__(self, item):
+        return item in self.current or item in self.old
+
+    def __len__(self):
+        return len(self.current) + len(self.old)
@@ -1,4 +1,6 @@
 
+import asyncio
+
 from pycoinnet.util.BlockChain import BlockChain
 
 
@@ -145,6 +147,36 @@ def test_fork():
     assert set(BC.chain_finder.missing_parents()) == set([parent_for_0])
 
 
+def test_change_q():
+    BC = BlockChain(parent_for_0)
+    ITEMS = dict((i, (i, i-1, 1)) for i in range(7))
+    ITEMS[0] = (0, parent_for_0, 1)
+    ITEMS.update(dict((i, (i, i-1, 1)) for i in range(301, 306)))
+    ITEMS[301] = (301, 3, 1)
+
+    change_q = BC.new_change_q()
+    get_task = asyncio.Task(change_q.get())
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0))
+    assert not get_task.done()
+
+    BC.add_nodes(ITEMS[i] for i in range(7))
+    assert asyncio.get_event_loop().run_until_complete(get_task) == ("add", 0, 0)
+    assert change_q.qsize() == 6
+
+    # the fork's removes cancel out the adds not consumed yet
+    BC.add_nodes(ITEMS[i] for i in range(301, 306))
+    r = []
+    while change_q.qsize() > 0:
+        r.append(change_q.get_nowait())
+    assert r == [("add", i, i) for i in range(1, 4)] + [("add", i, i+4-301) for i in range(301, 306)]
+    assert change_q.empty()
+
+    # removes with nothing to cancel out are queued
+    get_task = asyncio.Task(change_q.get())
+    BC.add_nodes([(306, 5, 1), (307, 306, 1), (308, 307, 1), (309, 308, 1), (310, 309, 1), (311, 310, 1)])
+    assert asyncio.get_event_loop().run_until_complete(get_task) == ("remove", 305, 8)
+
+
 def test_large():
     SIZE = 3000
     ITEMS = [(i, i-1, 1) for i in range(SIZE)]
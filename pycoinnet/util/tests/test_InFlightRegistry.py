@@ -0,0 +1,48 @@
+import asyncio
+
+from pycoinnet.peer.tests.helper import make_tx
+from pycoinnet.util.InFlightRegistry import InFlightRegistry, _item_size
+
+
+def test_InFlightRegistry():
+    registry = InFlightRegistry()
+    tx = make_tx(1)
+    started = []
+
+    def start_f():
+        started.append(1)
+        return asyncio.Future()
+
+    f1 = registry.get_or_start(tx.hash(), start_f)
+    f2 = registry.get_or_start(tx.hash(), start_f)
+    f3 = registry.get_or_start(tx.hash(), start_f)
+    assert f1 is f2 is f3
+    assert len(started) == 1
+    assert tx.hash() in registry
+    f1.set_result(tx)
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0))
+    assert len(registry) == 0
+    assert registry.stats() == dict(
+        in_flight_count=0, started_count=1, duplicate_count=2, duplicate_bytes=2*_item_size(tx))
+
+    # once it's done, it can be started again
+    f4 = registry.get_or_start(tx.hash(), start_f)
+    assert f4 is not f1
+    assert len(started) == 2
+
+
+def test_InFlightRegistry_sizes_item_once():
+    class Item:
+        as_bin_calls = 0
+
+        def as_bin(self):
+            self.as_bin_calls += 1
+            return b'\0' * 1000
+
+    registry = InFlightRegistry()
+    futures = [registry.get_or_start(b'h', asyncio.Future) for i in range(4)]
+    item = Item()
+    futures[0].set_result(item)
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0))
+    assert registry.stats()["duplicate_bytes"] == 3000
+    assert item.as_bin_calls == 1
@@ -0,0 +1,62 @@
+from pycoinnet.util.InvItemIndex import InvItemIndex
+
+
+def test_add_remove():
+    index = InvItemIndex()
+    assert index.add("h1", "peer1", when=100)
+    assert not index.add("h1", "peer2", when=101)
+    assert index.add("h2", "peer1", when=102)
+    assert "h1" in index
+    assert len(index) == 2
+    assert index.get("h1") == {"peer1": 100, "peer2": 101}
+    assert index.get("h3") is None
+
+    index.remove("h1", "peer2")
+    assert index.get("h1") == {"peer1": 100}
+
+    index.remove_peer("peer1")
+    assert index.get("h1") == {}
+    assert index.get("h2") == {}
+    r = index.memory_usage()
+    assert r["hash_count"] == 2
+    assert r["peer_count"] == 0
+    assert r["peer_entry_count"] == 0
+
+
+def test_expire():
+    index = InvItemIndex(max_age=60)
+    for i in range(10):
+        index.add(i, "peer1", when=100+i)
+    # announcing 0 again keeps it around
+    index.add(0, "peer2", when=130)
+    index.add(100, "peer2", when=165)
+    assert sorted(index._peers_by_hash.keys()) == [0, 6, 7, 8, 9, 100]
+    assert index._hashes_by_peer["peer1"] == set([0, 6, 7, 8, 9])
+    index.expire(now=191)
+    assert sorted(index._peers_by_hash.keys()) == [100]
+    assert "peer1" not in index._hashes_by_peer
+    assert index.expired_count == 10
+
+
+def test_max_count():
+    index = InvItemIndex(max_count=5)
+    for i in range(10):
+        index.add(i, "peer%d" % (i % 2), when=100)
+    assert len(index) == 5
+    assert sorted(index._peers_by_hash.keys()) == [5, 6, 7, 8, 9]
+    assert index._hashes_by_peer["peer0"] == set([6, 8])
+    assert index.evicted_count == 5
+    r = index.memory_usage()
+    assert r["peer_entry_count"] == 5
+    assert r["approximate_bytes"] > 0
+
+
+def test_did_drop_hash_f():
+    dropped = []
+    index = InvItemIndex(max_count=2, max_age=60, did_drop_hash_f=dropped.append)
+    index.add("h1", "peer1", when=100)
+    index.add("h2", "peer1", when=101)
+    index.add("h3", "peer1", when=102)
+    assert dropped == ["h1"]
+    index.expire(now=200)
+    assert sorted(dropped) == ["h1", "h2", "h3"]
@@ -0,0 +1,56 @@
+from pycoinnet.peer.tests.helper import make_tx
+from pycoinnet.util.Mempool import Mempool, _tx_size
+
+
+def test_Mempool_simple():
+    TX_LIST = [make_tx(i) for i in range(5)]
+    mempool = Mempool()
+    for tx in TX_LIST:
+        mempool[tx.hash()] = tx
+    assert len(mempool) == 5
+    assert set(mempool.keys()) == set(tx.hash() for tx in TX_LIST)
+    assert mempool[TX_LIST[2].hash()] is TX_LIST[2]
+    assert mempool.get(b'\0' * 32) is None
+    assert mempool.total_bytes == sum(_tx_size(tx) for tx in TX_LIST)
+    assert mempool.size_for_hash(TX_LIST[0].hash()) == _tx_size(TX_LIST[0])
+    del mempool[TX_LIST[0].hash()]
+    assert TX_LIST[0].hash() not in mempool
+    assert mempool.total_bytes == sum(_tx_size(tx) for tx in TX_LIST[1:])
+
+
+def test_Mempool_evict_by_fee_rate():
+    TX_LIST = [make_tx(i) for i in range(10)]
+    size = _tx_size(TX_LIST[0])
+    assert all(_tx_size(tx) == size for tx in TX_LIST)
+    mempool = Mempool(max_bytes=5*size)
+    fees = [50, 10, 90, 30, 70, 20, 80, 60, 40, 100]
+    for tx, fee in zip(TX_LIST, fees):
+        mempool.add(tx, fee=fee, now=1000)
+    assert len(mempool) == 5
+    assert mempool.total_bytes == 5 * size
+    assert sorted(mempool.fee_rate_for_hash(h) * size for h in mempool) == [60, 70, 80, 90, 100]
+    assert mempool.evicted_count == 5
+    # a tx paying too little goes straight out
+    assert not mempool.add(make_tx(10), fee=1, now=1000)
+    assert len(mempool) == 5
+
+    # removals leave stale heap entries, which get cleaned up
+    for the_hash in list(mempool.keys()):
+        del mempool[the_hash]
+    for i in range(20):
+        mempool.add(make_tx(20+i), fee=i, now=1000)
+        del mempool[make_tx(20+i).hash()]
+    assert len(mempool._by_fee_rate) <= 16
+
+
+def test_Mempool_expire():
+    TX_LIST = [make_tx(i) for i in range(5)]
+    mempool = Mempool(max_age=60)
+    for i, tx in enumerate(TX_LIST):
+        mempool.add(tx, now=1000+10*i)
+    mempool.expire(now=1075)
+    assert list(mempool.keys()) == [tx.hash() for tx in TX_LIST[2:]]
+    # adding expires old ones too
+    mempool.add(make_tx(5), now=1095)
+    assert list(mempool.keys()) == [TX_LIST[-1].hash(), make_tx(5).hash()]
+    assert mempool.stats()["expired_count"] == 4
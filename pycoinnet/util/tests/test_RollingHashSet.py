@@ -0,0 +1,25 @@
+from pycoinnet.util.RollingHashSet import RollingHashSet
+
+
+def test_RollingHashSet():
+    s = RollingHashSet(capacity=10)
+    for i in range(8):
+        s.add(i)
+    assert len(s) == 8
+    assert all(i in s for i in range(8))
+    assert 8 not in s
+    # adding something already there doesn't push anything out
+    s.add(7)
+    assert len(s) == 8
+    # 0-4 are the old generation, and go when 5-9 fill the current one
+    s.add(8)
+    s.add(9)
+    assert len(s) == 5
+    assert all(i not in s for i in range(5))
+    assert all(i in s for i in range(5, 10))
+    # adding an old one again keeps it around longer
+    s.add(5)
+    for i in range(10, 14):
+        s.add(i)
+    assert 5 in s
+    assert 6 not in s